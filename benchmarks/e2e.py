@@ -0,0 +1,185 @@
+"""End-to-end benchmark of Query.execute against a local mock DHuS mirror
+
+Starts benchmarks/mock_dhus.py in-process, then runs search, selection,
+download and extraction once per concurrency level and reports
+products/s, MB/s and p50/p99 per-product download latency.
+
+    python benchmarks/e2e.py --parallel 1 2 4 8 --latency 0.1 --bandwidth 10
+
+Each run works in a fresh temporary directory, zip files served by the
+mock are built before the first run.
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from mock_dhus import Catalogue, MockDHuS, DEFAULT_TILES  # noqa: E402
+from single_mirror_manager import SentinelAPIManager  # noqa: E402
+from query import Query  # noqa: E402
+from download_state import DownloadState  # noqa: E402
+
+
+class BenchmarkQuery(Query):
+    """Query keeping its download list for evaluation
+    """
+
+    def _finish_downloads(self, tic):
+        self.finished = list(self._download_list)
+        super()._finish_downloads(tic)
+
+
+def run(url, tiles, parallel, options, verbose=False):
+    """Run Query.execute once
+
+    Returns
+    -------
+    dict
+        Throughput and latency of the run
+    """
+    workdir = tempfile.mkdtemp(prefix="e2e-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    logger = logging.getLogger("single-mirror")
+    manager = None
+    try:
+        # no background probes, they would outlive the run and load the mock
+        manager = SentinelAPIManager(
+            user="user",
+            password="password",
+            url=url,
+            order=",".join(tiles),
+            parallel=parallel,
+            probe_interval=0,
+            **options,
+        )
+        query = BenchmarkQuery(manager=manager, order=manager.config["order"])
+        if not verbose:
+            logger.setLevel(logging.WARNING)
+        tic = perf_counter()
+        query.execute()
+        elapsed = perf_counter() - tic
+    finally:
+        if manager is not None:
+            # pools are left running if the query failed
+            if manager.health_monitor is not None:
+                manager.health_monitor.stop()
+            manager.extractor.shutdown()
+            if manager._downloader is not None:
+                manager._downloader.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    finished = getattr(query, "finished", [])
+    done = [d for d in finished if d.state != DownloadState.FAILED]
+    latency = [d._stop_time - d._start_time for d in done if d._stop_time]
+    size = sum(d.size for d in done if d.size)
+    return {
+        "parallel": parallel,
+        "products": len(done),
+        "failed": len(finished) - len(done),
+        "seconds": elapsed,
+        "products_per_sec": len(done) / elapsed,
+        "mb_per_sec": size / elapsed,
+        "p50": float(np.percentile(latency, 50)) if latency else float("nan"),
+        "p99": float(np.percentile(latency, 99)) if latency else float("nan"),
+    }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="End-to-end download benchmark")
+    parser.add_argument("--parallel", nargs="+", type=int, default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", default=1, type=int, help="Runs per level")
+    parser.add_argument("--tiles", nargs="+", default=DEFAULT_TILES)
+    parser.add_argument("--per-tile", default=10, type=int, help="Products per tile")
+    parser.add_argument("--size", default=2.0, type=float, help="Mean product size in MB")
+    parser.add_argument("--latency", default=0.05, type=float, help="Seconds per request")
+    parser.add_argument("--bandwidth", type=float, help="MB/s per download")
+    parser.add_argument("--error-rate", default=0.0, type=float)
+    parser.add_argument("--max-downloads", type=int, help="Concurrent download limit")
+    parser.add_argument("--retry", default=3, type=int)
+    parser.add_argument("--retry-delay", default=0.5, type=float)
+    parser.add_argument("--selection", default="season", type=str)
+    parser.add_argument("--selection-k", type=int)
+    parser.add_argument("--cloud", default=100.0, type=float)
+    parser.add_argument("--pipeline", action="store_true", help="Download while searching")
+    parser.add_argument("--verify", action="store_true", help="Verify manifest checksums")
+    parser.add_argument("--output", type=str, help="Write results as JSON")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    cache = tempfile.mkdtemp(prefix="mock-dhus-")
+    catalogue = Catalogue(args.tiles, args.per_tile, args.size, workdir=cache)
+    server = MockDHuS(
+        catalogue,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        max_downloads=args.max_downloads,
+    )
+    server.start()
+    print("Mock DHuS at %s, building %d products ..." % (server.url, len(catalogue)))
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(catalogue.zip_file, catalogue.products.values()))
+
+    options = {
+        "from_date": "20170101",
+        "to_date": "NOW",
+        "cloud": args.cloud,
+        "retry": args.retry,
+        "retry_delay": args.retry_delay,
+        "selection": args.selection,
+        "selection_k": args.selection_k,
+        "pipeline": args.pipeline,
+        "verify": args.verify,
+    }
+    results = []
+    header = "%8s %8s %6s %8s %10s %8s %8s %8s" % (
+        "parallel", "products", "failed", "sec", "products/s", "MB/s", "p50 s", "p99 s"
+    )
+    rows = []
+    try:
+        for parallel in args.parallel:
+            for _ in range(args.repeat):
+                result = run(server.url, args.tiles, parallel, options, args.verbose)
+                results.append(result)
+                rows.append(
+                    "%8d %8d %6d %8.2f %10.2f %8.2f %8.3f %8.3f"
+                    % (
+                        result["parallel"],
+                        result["products"],
+                        result["failed"],
+                        result["seconds"],
+                        result["products_per_sec"],
+                        result["mb_per_sec"],
+                        result["p50"],
+                        result["p99"],
+                    )
+                )
+                print(rows[-1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache, ignore_errors=True)
+
+    print("")
+    print(header)
+    print("\n".join(rows))
+    print("Server: %s" % server.stats)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "server": server.stats, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""Micro-benchmarks of the per-product helpers in utils
+
+Every case runs on synthetic metadata of 1k, 100k or 1M products. The
+make_plan cases plan the selection of every policy in selection.POLICIES
+and fail if a chosen product is missing from the plan:
+
+    python benchmarks/micro.py run --sizes 1k 100k --save results.json
+    python benchmarks/micro.py compare --baseline benchmarks/baseline.json
+    python benchmarks/micro.py compare --results results.json --threshold 0.2
+
+compare exits with status 1 if a case got slower than its baseline by
+more than the threshold, both on the fastest repeat and relative to a
+fixed reference loop timed right before every repeat, and by more than
+the spread of the repeats of either run. A case only slowed down by the
+CPU frequency and steal time swings of shared machines fails one of
+these.
+Baselines still depend on the machine, record one with many repeats
+before comparing:
+
+    python benchmarks/micro.py run --repeat 20 --save benchmarks/baseline.json
+"""
+import os
+import sys
+import csv
+import json
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+from functools import partial
+from statistics import median
+from time import perf_counter
+from uuid import UUID
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import utils  # noqa: E402
+import product_name  # noqa: E402
+from metadata_table import MetadataTable  # noqa: E402
+from plan import make_plan  # noqa: E402
+from selection import POLICIES, Selector, get_policy  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SIZES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+# Products per MGRS tile, about two years of revisits
+PER_TILE = 150
+
+
+def make_products(num, seed=0, tileid=True):
+    """Return a mapping of UUID to OpenSearch product dict
+
+    Parameters
+    ----------
+    num : int
+        Number of products
+    tileid : bool
+        If False, products have no "tileid" and the tile has to be read
+        from the filename
+    """
+    rnd = random.Random(seed)
+    start = datetime.datetime(2016, 1, 1)
+    products = OrderedDict()
+    for idx in range(num):
+        uuid = str(UUID(int=rnd.getrandbits(128), version=4))
+        cell = idx // PER_TILE
+        tile = "%02d%s%sA" % (
+            1 + cell % 60, "CDEFGHJKLMNPQRSTUVWX"[cell // 60 % 20], "ABCDEFGH"[cell // 1200 % 8]
+        )
+        date = start + datetime.timedelta(seconds=rnd.randrange(3 * 365 * 86400))
+        stamp = date.strftime("%Y%m%dT%H%M%S")
+        title = "S2A_MSIL1C_%s_N0206_R%03d_T%s_%s" % (stamp, rnd.randint(1, 143), tile, stamp)
+        product = {
+            "title": title,
+            "filename": title + ".SAFE",
+            "ingestiondate": date,
+            "beginposition": date,
+            "cloudcoverpercentage": round(rnd.uniform(0, 100), 4),
+            "size": "%.2f MB" % rnd.uniform(500, 900),
+            "uuid": uuid,
+        }
+        if tileid:
+            product["tileid"] = tile
+        products[uuid] = product
+    return products
+
+
+def make_meta(num, seed=0):
+    """Return a mapping of MGRS tile to UUID to product dict
+    """
+    return utils.order_by_utm(make_products(num, seed))
+
+
+def make_json_dicts(num, seed=0):
+    """Return product dicts with dates as strings, as parsed from JSON
+    """
+    out = []
+    for product in make_products(num, seed).values():
+        product = dict(product)
+        for key in ("ingestiondate", "beginposition"):
+            product[key] = product[key].strftime("%Y-%m-%d %H:%M:%S.%f")
+        out.append(product)
+    return out
+
+
+def make_csv(num, fpath, seed=0):
+    """Write a CSV file with a header and a tile id per row
+    """
+    products = make_products(num, seed)
+    with open(fpath, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["tileid", "uuid"])
+        for product in products.values():
+            writer.writerow([product["tileid"], product["uuid"]])
+    return fpath
+
+
+def _reference():
+    """Fixed pure Python workload, the unit of relative timings
+    """
+    tic = perf_counter()
+    names = {}
+    for idx in range(20000):
+        names[idx % 500] = "%05d" % idx
+    return perf_counter() - tic
+
+
+def calibrate(rounds=3):
+    """Return the fastest of a few reference timings in seconds
+    """
+    return min(_reference() for _ in range(rounds))
+
+
+class Case(object):
+    """Function to time with optional untimed hooks
+
+    Parameters
+    ----------
+    fn : callable
+        Timed once per repeat
+    reset : callable, optional
+        Called before every repeat, e.g. to clear caches
+    close : callable, optional
+        Called once timing is done, e.g. to remove files
+    """
+
+    def __init__(self, fn, reset=None, close=None):
+        self.fn = fn
+        self.reset = reset
+        self.close = close
+
+
+def _selection_all(meta):
+    return {tile: utils.get_year_season_selection(meta[tile]) for tile in meta}
+
+
+def _case_season_year(num):
+    dates = [p["ingestiondate"] for p in make_products(num).values()]
+    return lambda: [utils.get_season_year(date) for date in dates]
+
+
+def _case_selection(num):
+    meta = make_meta(num)
+    return lambda: _selection_all(meta)
+
+
+def _case_selection_all(num):
+    meta = make_meta(num)
+    return lambda: utils.get_year_season_selection_all(meta)
+
+
+def _case_order_by_utm(num):
+    response = make_products(num)
+    return lambda: utils.order_by_utm(response)
+
+
+def _clear_name_caches():
+    product_name.get_tile.cache_clear()
+    product_name.decode.cache_clear()
+
+
+def _case_order_by_name(num):
+    products = make_products(num, tileid=False)
+    # order_by_utm caches the tile in the product, start from a copy, and
+    # decoded names in lru_caches, measure decoding instead of cache hits
+    return Case(
+        lambda: utils.order_by_utm({uuid: dict(p) for uuid, p in products.items()}),
+        reset=_clear_name_caches,
+    )
+
+
+def _case_get_keys_meta(num):
+    meta = make_meta(num)
+    return lambda: utils.get_keys(meta)
+
+
+def _case_get_keys_selection(num):
+    selection = _selection_all(make_meta(num))
+    return lambda: utils.get_keys(selection)
+
+
+def _case_is_selection(num):
+    selection = _selection_all(make_meta(num))
+    return lambda: [utils.is_selection({tile: selection[tile]}) for tile in selection]
+
+
+def _case_datetime_parser(num):
+    dicts = make_json_dicts(num)
+    return lambda: [utils.datetime_parser(dict(d)) for d in dicts]
+
+
+def _case_parse_dates(num):
+    dicts = make_json_dicts(num)
+    hook = utils._date_hook(utils.DATE_FIELDS)
+    return lambda: [hook(dict(d)) for d in dicts]
+
+
+def _case_load_csv(num):
+    tmp = tempfile.TemporaryDirectory(prefix="micro-")
+    fpath = make_csv(num, os.path.join(tmp.name, "targets.csv"))
+    return Case(partial(utils.load_csv, fpath), close=tmp.cleanup)
+
+
+def _case_make_plan(policy):
+    def setup(num):
+        meta = make_meta(num)
+        table = MetadataTable.from_meta(meta)
+        selection = Selector(get_policy(policy)).select_all(meta)
+        # every chosen product must end up in the plan
+        chosen = {uuid for _, uuid in utils.get_keys(selection)}
+        planned, info = make_plan(table, selection, {}, 4)
+        assert info["products"] == len(chosen), (policy, info["products"], len(chosen))
+        return lambda: make_plan(table, selection, {}, 4)
+    return setup
+
+
+# Name -> setup(num) returning the function to time
+CASES = OrderedDict(
+    [
+        ("get_season_year", _case_season_year),
+        ("get_year_season_selection", _case_selection),
+        ("get_year_season_selection_all", _case_selection_all),
+        ("order_by_utm", _case_order_by_utm),
+        ("order_by_utm/filename", _case_order_by_name),
+        ("get_keys/meta", _case_get_keys_meta),
+        ("get_keys/selection", _case_get_keys_selection),
+        ("is_selection", _case_is_selection),
+        ("datetime_parser", _case_datetime_parser),
+        ("date_hook", _case_parse_dates),
+        ("load_csv", _case_load_csv),
+    ]
+    + [("make_plan/%s" % policy, _case_make_plan(policy)) for policy in POLICIES]
+)
+
+
+def run(sizes, cases=None, repeat=5):
+    """Time every case at every size
+
+    Returns
+    -------
+    dict
+        Mapping of "<case>@<size>" to {"median": s, "min": s, "spread": s,
+        "relative": r, "per_item_ns": ns}. spread is the difference between
+        the median and the fastest repeat, relative the median repeat in
+        units of the reference loop
+    """
+    results = OrderedDict()
+    for size in sizes:
+        num = SIZES[size]
+        for name in cases or CASES:
+            case = CASES[name](num)
+            if not isinstance(case, Case):
+                case = Case(case)
+            times = []
+            relative = []
+            try:
+                for _ in range(repeat):
+                    if case.reset is not None:
+                        case.reset()
+                    reference = calibrate()
+                    tic = perf_counter()
+                    case.fn()
+                    times.append(perf_counter() - tic)
+                    relative.append(times[-1] / reference)
+            finally:
+                if case.close is not None:
+                    case.close()
+            key = "%s@%s" % (name, size)
+            results[key] = {
+                "median": median(times),
+                "min": min(times),
+                "spread": median(times) - min(times),
+                "relative": median(relative),
+                "per_item_ns": median(times) / num * 1e9,
+            }
+            print("%-40s %10.4f s %10.1f ns/product" % (key, median(times), results[key]["per_item_ns"]))
+            del case
+    return results
+
+
+def compare(results, baseline, threshold, min_delta=0.002):
+    """Print fastest repeats next to the baseline
+
+    The fastest repeats are compared, the median of a few repeats moves
+    with scheduler and frequency noise. Slowdowns are ignored if they are
+    below min_delta seconds, within the spread of the baseline or current
+    repeats (the noise band of the case) or below the threshold relative
+    to the reference loop.
+
+    Returns
+    -------
+    list
+        Keys of cases slower than baseline by more than threshold
+    """
+    regressions = []
+    print("%-40s %10s %10s %8s" % ("case", "baseline", "current", "change"))
+    for key in results:
+        if key not in baseline:
+            print("%-40s %10s %10.4f %8s" % (key, "-", results[key]["min"], "new"))
+            continue
+        old = baseline[key]["min"]
+        new = results[key]["min"]
+        change = new / old - 1 if old else 0.0
+        noise = max(min_delta, baseline[key].get("spread", 0.0), results[key].get("spread", 0.0))
+        # older results have no relative timing, the check passes
+        ref = baseline[key].get("relative")
+        cur = results[key].get("relative", ref)
+        relative = cur / ref - 1 if ref else change
+        flag = ""
+        if change > threshold and new - old > noise and relative > threshold:
+            regressions.append(key)
+            flag = " REGRESSION"
+        print("%-40s %10.4f %10.4f %+7.1f%%%s" % (key, old, new, 100 * change, flag))
+    return regressions
+
+
+def _load(fpath):
+    with open(fpath, "r") as f:
+        return json.load(f)["results"]
+
+
+def _save(fpath, results, repeat):
+    info = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "repeat": repeat,
+    }
+    with open(fpath, "w") as f:
+        json.dump({"info": info, "results": results}, f, indent=2)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="utils micro-benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("run", "compare"):
+        command = commands.add_parser(name)
+        command.add_argument("--sizes", nargs="+", default=["1k", "100k"], choices=list(SIZES))
+        command.add_argument("--cases", nargs="+", choices=list(CASES))
+        command.add_argument("--repeat", default=5, type=int)
+    commands.choices["run"].add_argument("--save", type=str, help="Write results as JSON")
+    compare_parser = commands.choices["compare"]
+    compare_parser.add_argument("--baseline", default=BASELINE, type=str)
+    compare_parser.add_argument("--results", type=str, help="Compare a saved run")
+    compare_parser.add_argument(
+        "--threshold", default=0.25, type=float, help="Allowed relative slowdown"
+    )
+    compare_parser.add_argument(
+        "--min-delta", default=0.002, type=float, help="Ignored slowdown in seconds"
+    )
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.command == "run":
+        results = run(args.sizes, args.cases, args.repeat)
+        if args.save:
+            _save(args.save, results, args.repeat)
+        return 0
+
+    baseline = _load(args.baseline)
+    if args.results:
+        results = _load(args.results)
+    else:
+        results = run(args.sizes, args.cases, args.repeat)
+        print("")
+    regressions = compare(results, baseline, args.threshold, args.min_delta)
+    if regressions:
+        print("\n%d regression(s) over %.0f%%" % (len(regressions), 100 * args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
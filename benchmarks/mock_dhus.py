@@ -0,0 +1,571 @@
+"""Local stand-in for a DHuS mirror
+
+Serves the endpoints used by sentinelsat:
+
+    POST search?format=json&rows=<n>&start=<offset>      OpenSearch
+    GET  odata/v1/Products('<uuid>')?$format=json        OData metadata
+    GET  odata/v1/Products('<uuid>')/$value              download, supports Range
+
+Products are synthetic Sentinel-2 L1C products of a fixed set of MGRS
+tiles. Their zip files are built on first request: a SAFE folder with a
+manifest.safe listing MD5 checksums and stored JP2 band files of random
+bytes. Latency, bandwidth, concurrent download limit and error rate can
+be set to emulate a real hub.
+
+Run standalone:
+
+    python benchmarks/mock_dhus.py --port 8080 --latency 0.2 --bandwidth 20
+
+and point the manager at http://localhost:8080/ with any user/password.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import zipfile
+import datetime
+from uuid import UUID
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from mgrs_index import tile_ring, tiles_for_footprint  # noqa: E402
+
+# Capitals of config.yaml "test"
+DEFAULT_TILES = ["31UES", "32UQD", "32VNM", "33UWP", "34SGH", "35VLG", "32TQM"]
+BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"]
+
+_TERM = re.compile(r'(\w+):(\[[^\]]*\]|"[^"]*"|\S+)')
+_ODATA = re.compile(r"^/odata/v1/Products\('([0-9a-f-]{36})'\)(/\$value)?$")
+_NOW = re.compile(r"^NOW(?:-(\d+)DAYS?)?$")
+_CHUNK = 1 << 16
+
+
+def _timestamp(date):
+    return date.strftime("%Y%m%dT%H%M%S")
+
+
+def _iso(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (date.microsecond // 1000)
+
+
+def _odata_date(date):
+    epoch = datetime.datetime(1970, 1, 1)
+    return "/Date(%d)/" % ((date - epoch).total_seconds() * 1000)
+
+
+def _parse_date(value, now):
+    """Parse an OpenSearch date bound, None for "*"
+    """
+    if value == "*":
+        return None
+    match = _NOW.match(value)
+    if match:
+        return now - datetime.timedelta(days=int(match.group(1) or 0))
+    value = value.rstrip("Z")
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date %s" % value)
+
+
+def _range(value):
+    """Split "[a TO b]" into (a, b)
+    """
+    lower, upper = value.strip("[]").split(" TO ")
+    return lower.strip(), upper.strip()
+
+
+class Catalogue(object):
+    """Synthetic Sentinel-2 products of a set of MGRS tiles
+
+    Parameters
+    ----------
+    tiles : list
+        MGRS tile ids
+    per_tile : int
+        Number of products per tile
+    size_mb : float
+        Mean zip size in MB, actual sizes vary by +-20%
+    start : datetime.datetime
+        First sensing date
+    days : int
+        Sensing dates are spread over this many days
+    max_cloud : float
+        Cloud cover is uniform between 0 and max_cloud
+    workdir : str
+        Zip files are cached here, a temporary folder by default
+    seed : int
+        Products and their content are reproducible for a given seed
+    """
+
+    def __init__(self, tiles=None, per_tile=20, size_mb=5.0,
+                 start=datetime.datetime(2017, 1, 1), days=420, max_cloud=20.0,
+                 workdir=None, seed=0):
+        self.workdir = workdir or tempfile.mkdtemp(prefix="mock-dhus-")
+        self.seed = seed
+        self.products = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+        rnd = random.Random(seed)
+        for tile in tiles or DEFAULT_TILES:
+            ring = tile_ring(tile)
+            if ring is None:
+                raise ValueError("%s is not a valid MGRS tile" % tile)
+            for _ in range(per_tile):
+                uuid = str(UUID(int=rnd.getrandbits(128), version=4))
+                sensing = start + datetime.timedelta(
+                    days=rnd.randrange(days), seconds=rnd.randrange(86400)
+                )
+                title = "S2%s_MSIL1C_%s_N0206_R%03d_T%s_%s" % (
+                    rnd.choice("AB"),
+                    _timestamp(sensing),
+                    rnd.randint(1, 143),
+                    tile,
+                    _timestamp(sensing + datetime.timedelta(hours=2)),
+                )
+                self.products[uuid] = {
+                    "uuid": uuid,
+                    "title": title,
+                    "tile": tile,
+                    "sensing": sensing,
+                    "ingestion": sensing + datetime.timedelta(hours=3),
+                    "cloud": round(rnd.uniform(0, max_cloud), 4),
+                    "size": int(size_mb * rnd.uniform(0.8, 1.2) * 1048576),
+                    "ring": ring + ring[:1],
+                }
+
+    def __len__(self):
+        return len(self.products)
+
+    def search(self, query, now=None):
+        """Return products matching an OpenSearch query string, in catalogue order
+        """
+        now = now or datetime.datetime.utcnow()
+        terms = {key.lower(): value for key, value in _TERM.findall(query)}
+        tiles = None
+        if "tileid" in terms:
+            tiles = {terms["tileid"]}
+        elif "filename" in terms:
+            match = re.search(r"T(\d{2}[A-Z]{3})", terms["filename"])
+            tiles = {match.group(1)} if match else set()
+        if "footprint" in terms:
+            area = re.search(r"\((.*)\)", terms["footprint"].strip('"')).group(1)
+            found = set(tiles_for_footprint(area))
+            tiles = found if tiles is None else tiles & found
+        lower = upper = None
+        if "beginposition" in terms:
+            lower, upper = (_parse_date(v, now) for v in _range(terms["beginposition"]))
+        cloud = None
+        if "cloudcoverpercentage" in terms:
+            cloud = [None if v == "*" else float(v) for v in _range(terms["cloudcoverpercentage"])]
+        platform = terms.get("platformname", "Sentinel-2").replace("\\", "")
+        producttype = terms.get("producttype", "S2MSI1C")
+        if platform != "Sentinel-2" or producttype != "S2MSI1C":
+            return []
+
+        out = []
+        for product in self.products.values():
+            if tiles is not None and product["tile"] not in tiles:
+                continue
+            if lower and product["sensing"] < lower or upper and product["sensing"] > upper:
+                continue
+            if cloud and (
+                cloud[0] is not None and product["cloud"] < cloud[0]
+                or cloud[1] is not None and product["cloud"] > cloud[1]
+            ):
+                continue
+            out.append(product)
+        return out
+
+    def entry(self, product, base):
+        """Return the OpenSearch JSON entry of a product
+        """
+        odata = "%sodata/v1/Products('%s')" % (base, product["uuid"])
+        footprint = "MULTIPOLYGON (((%s)))" % ", ".join("%f %f" % p for p in product["ring"])
+        return {
+            "id": product["uuid"],
+            "title": product["title"],
+            "link": [
+                {"href": odata + "/$value"},
+                {"rel": "alternative", "href": odata + "/"},
+                {"rel": "icon", "href": odata + "/Products('Quicklook')/$value"},
+            ],
+            "summary": "Date: %s, Instrument: MSI, Mode: , Satellite: Sentinel-2, Size: %s"
+            % (_iso(product["sensing"]), self.size_string(product)),
+            "date": [
+                {"name": "ingestiondate", "content": _iso(product["ingestion"])},
+                {"name": "beginposition", "content": _iso(product["sensing"])},
+                {"name": "endposition", "content": _iso(product["sensing"])},
+            ],
+            "int": [
+                {"name": "orbitnumber", "content": "1"},
+                {"name": "relativeorbitnumber", "content": str(int(product["title"][34:37]))},
+            ],
+            "double": {"name": "cloudcoverpercentage", "content": str(product["cloud"])},
+            "str": [
+                {"name": "filename", "content": product["title"] + ".SAFE"},
+                {"name": "format", "content": "SAFE"},
+                {"name": "identifier", "content": product["title"]},
+                {"name": "platformname", "content": "Sentinel-2"},
+                {"name": "producttype", "content": "S2MSI1C"},
+                {"name": "processingbaseline", "content": "02.06"},
+                {"name": "tileid", "content": product["tile"]},
+                {"name": "size", "content": self.size_string(product)},
+                {"name": "footprint", "content": footprint},
+                {"name": "uuid", "content": product["uuid"]},
+            ],
+        }
+
+    @staticmethod
+    def size_string(product):
+        return "%.2f MB" % (product["size"] / 1048576)
+
+    def odata(self, product, base):
+        """Return the OData JSON record of a product, builds its zip file
+        """
+        path, md5 = self.zip_file(product)
+        coordinates = " ".join("%f,%f" % (lat, lon) for lon, lat in product["ring"])
+        url = "%sodata/v1/Products('%s')" % (base, product["uuid"])
+        return {
+            "__metadata": {
+                "id": url,
+                "uri": url,
+                "type": "DHuS.Product",
+                "content_type": "application/octet-stream",
+                "media_src": url + "/$value",
+            },
+            "Id": product["uuid"],
+            "Name": product["title"],
+            "ContentType": "application/octet-stream",
+            "ContentLength": str(os.path.getsize(path)),
+            "ChildrenNumber": "1",
+            "Value": None,
+            "CreationDate": _odata_date(product["ingestion"]),
+            "IngestionDate": _odata_date(product["ingestion"]),
+            "EvictionDate": None,
+            "Online": True,
+            "OnDemand": False,
+            "ContentDate": {
+                "__metadata": {"type": "DHuS.TimeRange"},
+                "Start": _odata_date(product["sensing"]),
+                "End": _odata_date(product["sensing"]),
+            },
+            "Checksum": {
+                "__metadata": {"type": "DHuS.Checksum"},
+                "Algorithm": "MD5",
+                "Value": md5.upper(),
+            },
+            "ContentGeometry": (
+                '<gml:Polygon srsName="http://www.opengis.net/gml/srs/epsg.xml#4326" '
+                'xmlns:gml="http://www.opengis.net/gml"><gml:outerBoundaryIs>'
+                "<gml:LinearRing><gml:coordinates>%s</gml:coordinates></gml:LinearRing>"
+                "</gml:outerBoundaryIs></gml:Polygon>" % coordinates
+            ),
+            "Attributes": {"__deferred": {"uri": url + "/Attributes"}},
+        }
+
+    def zip_file(self, product):
+        """Return path and MD5 of the zip file of a product, built on first call
+        """
+        with self._lock:
+            lock = self._locks.setdefault(product["uuid"], threading.Lock())
+        path = os.path.join(self.workdir, product["title"] + ".zip")
+        with lock:
+            if "md5" not in product:
+                if not os.path.exists(path):
+                    self._build_zip(product, path)
+                with open(path, "rb") as f:
+                    md5 = hashlib.md5()
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        md5.update(chunk)
+                product["md5"] = md5.hexdigest()
+        return path, product["md5"]
+
+    def _build_zip(self, product, path):
+        """Write a SAFE zip with stored JP2 bands and a matching manifest.safe
+        """
+        rnd = random.Random("%d/%s" % (self.seed, product["uuid"]))
+        safe = product["title"] + ".SAFE"
+        granule = "GRANULE/L1C_T%s_A000000_%s/IMG_DATA/" % (
+            product["tile"], _timestamp(product["sensing"])
+        )
+        band_size = max(product["size"] // len(BANDS), 1)
+        checksums = []
+        tmp = path + ".tmp"
+        with zipfile.ZipFile(tmp, "w") as zf:
+            zf.writestr(safe + "/", b"")
+            for band in BANDS:
+                name = "%sT%s_%s_%s.jp2" % (
+                    granule, product["tile"], _timestamp(product["sensing"]), band
+                )
+                data = rnd.getrandbits(8 * band_size).to_bytes(band_size, "little")
+                zf.writestr(safe + "/" + name, data, compress_type=zipfile.ZIP_STORED)
+                checksums.append((name, hashlib.md5(data).hexdigest()))
+            metadata = ("<n1:Level-1C_User_Product><Product_Info><PRODUCT_URI>%s"
+                        "</PRODUCT_URI></Product_Info></n1:Level-1C_User_Product>" % safe)
+            zf.writestr(safe + "/MTD_MSIL1C.xml", metadata, compress_type=zipfile.ZIP_DEFLATED)
+            checksums.append(("MTD_MSIL1C.xml", hashlib.md5(metadata.encode()).hexdigest()))
+            objects = "".join(
+                '<dataObject ID="%d"><byteStream mimeType="application/octet-stream">'
+                '<fileLocation locatorType="URL" href="./%s"/>'
+                '<checksum checksumName="MD5">%s</checksum></byteStream></dataObject>'
+                % (idx, name, md5)
+                for idx, (name, md5) in enumerate(checksums)
+            )
+            manifest = (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">'
+                "<dataObjectSection>%s</dataObjectSection></xfdu:XFDU>" % objects
+            )
+            zf.writestr(safe + "/manifest.safe", manifest, compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(tmp, path)
+
+
+class MockDHuS(ThreadingHTTPServer):
+    """HTTP server emulating a DHuS mirror
+
+    Parameters
+    ----------
+    catalogue : Catalogue
+    address : tuple
+        (host, port), port 0 picks a free port
+    latency : float
+        Seconds to wait before answering a request
+    bandwidth : float or None
+        Download rate per connection in MB/s, unlimited if None
+    error_rate : float
+        Probability of answering a request with 503
+    max_downloads : int or None
+        Concurrent downloads above this limit are answered with 429,
+        like the per-user limit of the public hubs
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalogue, address=("127.0.0.1", 0), latency=0.0, bandwidth=None,
+                 error_rate=0.0, max_downloads=None, seed=0):
+        super().__init__(address, _Handler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.max_downloads = max_downloads
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.stats = {"search": 0, "odata": 0, "value": 0, "errors": 0, "bytes": 0}
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server_address[:2]
+
+    def start(self):
+        """Serve from a daemon thread, returns the thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections are not an error
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def inject_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _base(self):
+        return "http://%s/" % self.headers.get("Host", "%s:%d" % self.server.server_address[:2])
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self.server.count("errors")
+        body = json.dumps({"error": {"code": None, "message": {"lang": "en", "value": message}}})
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("cause-message", message)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _prologue(self):
+        """Apply latency and error injection, return False if the request failed
+        """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.inject_error():
+            self._send_error(503, "Service temporarily unavailable (injected)")
+            return False
+        return True
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if url.path != "/search":
+            self._send_error(404, "Not found")
+            return
+        if not self._prologue():
+            return
+        self.server.count("search")
+        params = parse_qs(url.query)
+        rows = int(params.get("rows", ["10"])[0])
+        start = int(params.get("start", ["0"])[0])
+        try:
+            found = self.server.catalogue.search(form.get("q", [""])[0])
+        except ValueError as err:
+            self._send_error(400, str(err))
+            return
+        base = self._base()
+        page = [self.server.catalogue.entry(p, base) for p in found[start : start + rows]]
+        feed = {"opensearch:totalResults": str(len(found)), "opensearch:startIndex": str(start)}
+        if page:
+            feed["entry"] = page[0] if len(page) == 1 else page
+        self._send_json({"feed": feed})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = _ODATA.match(url.path)
+        if not match:
+            self._send_error(404, "Not found")
+            return
+        product = self.server.catalogue.products.get(match.group(1))
+        if product is None:
+            self._send_error(404, "Invalid key (%s) to access Products" % match.group(1))
+            return
+        if not self._prologue():
+            return
+        if match.group(2):
+            self._send_value(product)
+            return
+        self.server.count("odata")
+        self._send_json({"d": self.server.catalogue.odata(product, self._base())})
+
+    def _send_value(self, product):
+        server = self.server
+        with server._lock:
+            if server.max_downloads and server.downloads >= server.max_downloads:
+                busy = True
+            else:
+                busy = False
+                server.downloads += 1
+        if busy:
+            self._send_error(429, "Too many concurrent downloads")
+            return
+        try:
+            server.count("value")
+            path, _ = server.catalogue.zip_file(product)
+            size = os.path.getsize(path)
+            start = 0
+            match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if match and int(match.group(1)) < size:
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, size - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size - start))
+            self.send_header(
+                "Content-Disposition", 'inline; filename="%s.zip"' % product["title"]
+            )
+            self.end_headers()
+            self._stream(path, start)
+        finally:
+            with server._lock:
+                server.downloads -= 1
+
+    def _stream(self, path, start):
+        """Write a file from start, throttled to the server bandwidth
+        """
+        rate = self.server.bandwidth and self.server.bandwidth * 1048576
+        sent = 0
+        tic = time.perf_counter()
+        with open(path, "rb") as f:
+            f.seek(start)
+            for chunk in iter(lambda: f.read(_CHUNK), b""):
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    break
+                sent += len(chunk)
+                if rate:
+                    ahead = sent / rate - (time.perf_counter() - tic)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        self.server.count("bytes", sent)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Local stand-in for a DHuS mirror")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--tiles", nargs="+", default=DEFAULT_TILES, help="MGRS tiles")
+    parser.add_argument("--per-tile", default=20, type=int, help="Products per tile")
+    parser.add_argument("--size", default=5.0, type=float, help="Mean product size in MB")
+    parser.add_argument("--latency", default=0.0, type=float, help="Seconds per request")
+    parser.add_argument("--bandwidth", type=float, help="MB/s per download")
+    parser.add_argument("--error-rate", default=0.0, type=float, help="Share of 503 responses")
+    parser.add_argument("--max-downloads", type=int, help="Concurrent download limit")
+    parser.add_argument("--workdir", type=str, help="Zip cache directory")
+    parser.add_argument("--seed", default=0, type=int)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    catalogue = Catalogue(
+        args.tiles, args.per_tile, args.size, workdir=args.workdir, seed=args.seed
+    )
+    server = MockDHuS(
+        catalogue,
+        (args.host, args.port),
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        max_downloads=args.max_downloads,
+        seed=args.seed,
+    )
+    print("Serving %d products at %s (zip cache %s)" % (len(catalogue), server.url, catalogue.workdir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
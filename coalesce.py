@@ -0,0 +1,114 @@
+"""Coalescing of product transfers shared by queries
+
+Queries on one manager, e.g. concurrent or consecutive daemon orders,
+claim a product before downloading it. The first claim owns the transfer
+(download, extraction and verification), later claims attach to the
+transfer's future and get the owner's ProductDownload with its zip and
+SAFE paths once it is done. Finished transfers are kept as long as their
+files exist, so orders overlapping a previous one reuse its products, up
+to the "max_transfers" option of the manager; the oldest are dropped
+first.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from download_state import DownloadState
+
+# Finished transfers remembered for later orders
+MAX_DONE = 10000
+
+
+class TransferRegistry(object):
+    """Transfers in flight or done, by product UUID
+
+    Parameters
+    ----------
+    max_done : int
+        Number of finished transfers kept, oldest are dropped first
+    """
+
+    def __init__(self, max_done=MAX_DONE):
+        self.max_done = max_done
+        self.coalesced = 0  # claims attached to an existing transfer
+        self._transfers = OrderedDict()  # UUID -> (owner, Future)
+        self._done = 0  # resolved transfers in _transfers
+        self._lock = threading.Lock()
+
+    def claim(self, uuid, owner):
+        """Claim the transfer of a product
+
+        Parameters
+        ----------
+        uuid : str
+            Product UUID
+        owner : ProductDownload
+            Download of the claiming query
+
+        Returns
+        -------
+        tuple
+            (Future, bool) the transfer's future, resolving to the owning
+            ProductDownload, and True if owner owns the transfer
+        """
+        with self._lock:
+            entry = self._transfers.get(uuid)
+            if entry is not None:
+                _owner, future = entry
+                if _owner is owner:
+                    return future, True
+                if not future.done() or _present(_owner):
+                    self.coalesced += 1
+                    return future, False
+                # files are gone, transfer again
+                self._done -= 1
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._transfers[uuid] = (owner, future)
+            self._transfers.move_to_end(uuid)
+            return future, True
+
+    def resolve(self, uuid, owner):
+        """End the transfer of owner, attached claims get owner as result
+
+        Failed transfers are forgotten, the next claim starts a new one.
+        """
+        with self._lock:
+            entry = self._transfers.get(uuid)
+            if entry is None or entry[0] is not owner or entry[1].done():
+                return
+            if owner.state == DownloadState.FAILED:
+                del self._transfers[uuid]
+            else:
+                self._done += 1
+            excess = self._done - self.max_done
+            if excess > 0:
+                # oldest first, in flight transfers are few
+                stale = []
+                for key, (_, future) in self._transfers.items():
+                    if len(stale) == excess:
+                        break
+                    if future.done():
+                        stale.append(key)
+                for key in stale:
+                    del self._transfers[key]
+                self._done -= len(stale)
+        entry[1].set_result(owner)
+
+    def in_flight(self):
+        """Return number of transfers not done yet
+        """
+        with self._lock:
+            return sum(1 for _, future in self._transfers.values() if not future.done())
+
+    def __len__(self):
+        return len(self._transfers)
+
+
+def _present(download):
+    """Return True if the files of a finished download still exist
+    """
+    if download.state == DownloadState.FAILED:
+        return False
+    path = download.safe_path or download.index_path
+    return bool(path) and os.path.exists(path)
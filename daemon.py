@@ -0,0 +1,363 @@
+"""Long-running service downloading a queue of orders
+
+    python daemon.py --config config.yaml --queue orders.jsonl
+    python daemon.py --config config.yaml --socket /tmp/single-mirror.sock
+
+Orders are JSON objects, one per line:
+
+    {"id": "berlin-2017", "order": "32UQD,33UUU", "cloud": 20, "from_date": "20170101"}
+
+"order" is anything Query accepts as order (MGRS tiles, CSV, GeoJSON,
+metadata table or saved plan). Other keys override the config for this
+order only, see SentinelAPIManager.order_config. All orders share one
+manager: mirror connections, extraction workers, metrics, the mirror
+health history and the download budget ("parallel") of all orders.
+
+Lines appended to the queue file are picked up while the daemon runs.
+The read offset and the orders read but not finished are kept in
+<queue>.offset, a restarted daemon runs the unfinished orders again and
+continues after the last order read. Socket clients send orders the same
+way and get a JSON line with the order id back per order.
+
+The status of the newest "max_finished" finished orders is kept, older
+ones are only in the results file.
+"""
+import os
+import sys
+import json
+import tempfile
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+from itertools import count
+from time import perf_counter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from single_mirror_manager import SentinelAPIManager
+from product_download_list import ProductDownloadList
+from query import Query
+
+# Finished orders kept by status()
+MAX_FINISHED = 1000
+# Trace events kept of all orders
+MAX_TRACE_EVENTS = 100000
+
+
+class OrderDaemon(object):
+    """Run orders concurrently on a shared manager
+
+    Parameters
+    ----------
+    manager : SentinelAPIManager
+    max_orders : int
+        Orders run at the same time, their downloads share the manager's
+        download budget
+    results : str, optional
+        JSON Lines file the status of finished orders is appended to
+    max_finished : int
+        Finished orders kept by status, the oldest are dropped
+    """
+
+    def __init__(self, manager, max_orders=2, results=None, max_finished=MAX_FINISHED):
+        self.manager = manager
+        # extraction workers stay up between orders
+        self.manager.config["keep_pools"] = True
+        self.manager.tracer.set_limit(MAX_TRACE_EVENTS)
+        self.max_orders = max_orders
+        self.results = results
+        self.max_finished = max_finished
+        self.orders = OrderedDict()  # order id -> status dict, changed under _lock
+        self._finished = 0
+        self._ids = count(1)
+        # orders of the queue file not finished yet, see watch
+        self._state_path = None
+        self._offset = 0
+        self._unfinished = OrderedDict()  # order id -> order
+        self.logger = logging.getLogger("single-mirror")
+        self._executor = ThreadPoolExecutor(max_workers=max_orders, thread_name_prefix="order")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    def submit(self, order):
+        """Queue an order
+
+        Parameters
+        ----------
+        order : dict
+            "order" and optional "id" and config overrides
+
+        Returns
+        -------
+        str
+            Order id
+
+        Raises
+        ------
+        ValueError
+            If the order has no "order" key or its id is taken
+        """
+        return self._submit(order)
+
+    def _submit(self, order, offset=None):
+        """Queue an order, with offset recorded as unfinished order of the
+        queue file read up to offset
+        """
+        order = dict(order)
+        if not order.get("order"):
+            raise ValueError("Order without 'order' key: %s" % order)
+        with self._lock:
+            order_id = order.pop("id", None)
+            if order_id:
+                order_id = str(order_id)
+                if order_id in self.orders:
+                    raise ValueError("Duplicate order id %s" % order_id)
+            else:
+                order_id = "order-%d" % next(self._ids)
+                while order_id in self.orders:
+                    order_id = "order-%d" % next(self._ids)
+            self.orders[order_id] = {"id": order_id, "order": order["order"], "state": "queued"}
+            if offset is not None:
+                # saved before the order can finish and leave the state
+                self._unfinished[order_id] = dict(order, id=order_id)
+                self._offset = offset
+                self._save_state()
+        self.logger.info("Order %s | Queued %s", order_id, order["order"])
+        self._executor.submit(self._run, order_id, order)
+        return order_id
+
+    def _run(self, order_id, order):
+        with self._lock:
+            status = self.orders[order_id]
+            status["state"] = "running"
+        target = order.pop("order")
+        tic = perf_counter()
+        query = None
+        try:
+            config = self.manager.order_config(order=target, **order)
+            query = Query(
+                manager=self.manager,
+                order=target,
+                config=config,
+                download_list=ProductDownloadList(),
+            )
+            query.execute()
+        except Exception as err:
+            error = "%s: %s" % (err.__class__.__name__, err)
+            with self._lock:
+                status.update(state="failed", error=error)
+            self.logger.error("Order %s | Failed: %s", order_id, error)
+        else:
+            with self._lock:
+                status.update(query.summary or {})
+                status["state"] = "done"
+        finally:
+            if query is not None:
+                query.close()
+        with self._lock:
+            status["seconds"] = perf_counter() - tic
+            line = json.dumps(status)
+            if self.results:
+                with open(self.results, "a") as f:
+                    f.write(line + "\n")
+            if self._unfinished.pop(order_id, None) is not None:
+                self._save_state()
+            self._finished += 1
+            self._trim()
+        self.logger.info("Order %s | %s in %.1f sec", order_id, status["state"], status["seconds"])
+
+    def _trim(self):
+        """Drop the oldest finished orders beyond max_finished
+
+        Call with self._lock held
+        """
+        if self._finished <= self.max_finished:
+            return
+        for order_id in list(self.orders):
+            if self.orders[order_id]["state"] in ("done", "failed"):
+                del self.orders[order_id]
+                self._finished -= 1
+                if self._finished <= self.max_finished:
+                    return
+
+    def _save_state(self):
+        """Write the read offset and unfinished orders of the queue file
+
+        Call with self._lock held
+        """
+        if self._state_path is None:
+            return
+        state = {"offset": self._offset, "unfinished": list(self._unfinished.values())}
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self._state_path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self._state_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _load_state(self, fpath):
+        """Return read offset and unfinished orders of a queue file
+        """
+        if not os.path.exists(fpath):
+            return 0, []
+        with open(fpath, "r") as f:
+            text = f.read().strip()
+        if not text.startswith("{"):
+            return int(text or 0), []  # plain offset of older versions
+        state = json.loads(text)
+        return state["offset"], state["unfinished"]
+
+    def status(self, order_id=None):
+        """Return a copy of the status of an order, or of all orders
+        """
+        with self._lock:
+            if order_id is not None:
+                return dict(self.orders[order_id])
+            return [dict(status) for status in self.orders.values()]
+
+    def watch(self, fpath, poll=1.0):
+        """Submit orders appended to a JSON Lines file until stop is called
+
+        Blocks, lines without a trailing newline are read once complete.
+        Orders left unfinished by a previous daemon are submitted first.
+        """
+        offset, unfinished = self._load_state(fpath + ".offset")
+        with self._lock:
+            self._state_path = fpath + ".offset"
+            self._offset = offset
+        for order in unfinished:
+            self.logger.info("Order %s | Not finished by the last run", order["id"])
+            self._submit(order, offset)
+        self.logger.info("Watching %s for orders", fpath)
+        while not self._stop.is_set():
+            if os.path.exists(fpath):
+                if os.path.getsize(fpath) < offset:
+                    self.logger.info("%s was truncated, reading from the start", fpath)
+                    offset = 0
+                with open(fpath, "rb") as f:
+                    f.seek(offset)
+                    for line in iter(f.readline, b""):
+                        if not line.endswith(b"\n"):
+                            break
+                        offset = f.tell()
+                        reply = self._submit_line(line, offset)
+                        if reply is None or "error" in reply:
+                            # nothing to run, skip the line after a restart
+                            with self._lock:
+                                self._offset = offset
+                                self._save_state()
+            self._stop.wait(poll)
+
+    def _submit_line(self, line, offset=None):
+        """Submit a JSON order line, return the reply dict
+
+        offset is the read offset of the queue file after the line
+        """
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            return {"id": self._submit(json.loads(line), offset), "state": "queued"}
+        except ValueError as err:
+            self.logger.error("Invalid order %r: %s", line[:200], err)
+            return {"error": str(err)}
+
+    def serve(self, address):
+        """Accept orders on a Unix socket in a background thread
+        """
+        if os.path.exists(address):
+            os.remove(address)
+        self._server = _OrderServer(address, self)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.logger.info("Accepting orders on %s", address)
+
+    def stop(self):
+        """Stop accepting orders, running orders finish
+        """
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if os.path.exists(self._server.server_address):
+                os.remove(self._server.server_address)
+
+    def wait(self):
+        """Block until stop is called and all orders finished
+        """
+        self._stop.wait()
+        self._executor.shutdown(wait=True)
+        self.manager.extractor.shutdown()
+        # the downloader property would start shards to shut down
+        if self.manager._downloader is not None:
+            self.manager._downloader.shutdown()
+        self.manager.health.save()
+
+
+class _OrderHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            reply = self.server.daemon._submit_line(line)
+            if reply is not None:
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class _OrderServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, daemon):
+        super().__init__(address, _OrderHandler)
+        self.daemon = daemon
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Download a queue of orders")
+    parser.add_argument("--config", help="YAML config file with mirrors", type=str)
+    parser.add_argument("--user", help="Datahub username", type=str)
+    parser.add_argument("--password", help="Datahub password", type=str)
+    parser.add_argument("--url", help="Datahub URL", type=str)
+    parser.add_argument("--queue", help="JSON Lines file of orders to watch", type=str)
+    parser.add_argument("--socket", help="Unix socket to accept orders on", type=str)
+    parser.add_argument("--orders", help="Orders run at the same time", default=2, type=int)
+    parser.add_argument("--parallel", help="Concurrent downloads of all orders", type=int)
+    parser.add_argument("--results", help="JSON Lines file of finished orders", type=str)
+    parser.add_argument("--metrics-port", help="Serve live metrics on this port", type=int)
+    parser.add_argument("--poll", help="Seconds between queue file reads", default=1.0, type=float)
+    args = parser.parse_args(args)
+    if not args.queue and not args.socket:
+        parser.error("one of --queue or --socket is required")
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    manager = SentinelAPIManager(
+        config_file=args.config,
+        user=args.user,
+        password=args.password,
+        url=args.url,
+        parallel=args.parallel,
+        metrics_port=args.metrics_port,
+    )
+    daemon = OrderDaemon(manager, max_orders=args.orders, results=args.results)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    if args.socket:
+        daemon.serve(args.socket)
+    try:
+        if args.queue:
+            daemon.watch(args.queue, args.poll)
+        daemon.wait()
+    except KeyboardInterrupt:
+        daemon.stop()
+        daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
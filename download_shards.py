@@ -0,0 +1,303 @@
+"""Product downloads sharded over worker processes
+
+Every shard is a process with its own mirror sessions and a pool of
+download threads, so chunk writing and checksumming of many concurrent
+streams is spread over several interpreters instead of contending for
+one GIL. Every shard has its own task queue, tasks go to the shard with
+the fewest outstanding downloads, so the tasks of a shard that died are
+known and requeued. Shards send retry and completion events back over a
+shared queue; a listener thread in the main process resolves the Future
+of every task, so callbacks such as Query.unzip_callback run as for
+thread pool downloads.
+
+Shards are started with the "spawn" method: the main process runs
+threads (metrics server, mirror probes), forking it could copy locks
+held by them.
+"""
+import os
+import queue
+import logging
+import threading
+import multiprocessing
+from itertools import count
+from time import time, sleep
+from concurrent.futures import Future
+
+# Shards a download may be lost with before it fails, e.g. if the
+# product itself crashes the process
+MAX_SHARD_ATTEMPTS = 2
+
+
+class ShardError(Exception):
+    """Download failure raised in a shard
+
+    Exceptions of sentinelsat and requests do not survive pickling, the
+    original class name is kept in kind.
+    """
+
+    def __init__(self, kind, message):
+        super().__init__("%s: %s" % (kind, message))
+        self.kind = kind
+
+
+def _download(apis, task, events):
+    """Try mirrors in order, retrying each, return the download info
+    """
+    from sentinelsat import InvalidChecksumError, SentinelAPIError
+    from requests.exceptions import RequestException
+
+    task_id, uuid, img_dir, mirrors, retry, retry_delay = task
+    last_error = None
+    for name in mirrors:
+        for trial in range(retry + 1):
+            start = time()
+            try:
+                result = apis(name).download(uuid, img_dir)
+            except (RequestException, SentinelAPIError, InvalidChecksumError) as err:
+                last_error = err
+                events.put(
+                    ("span", task_id, "attempt", start, time(), os.getpid(), threading.get_ident(),
+                     {"uuid": uuid, "mirror": name, "trial": trial, "error": err.__class__.__name__})
+                )
+                if trial < retry:
+                    events.put(("retry", task_id, name, uuid, err.__class__.__name__))
+                    sleep(retry_delay)
+                continue
+            events.put(
+                ("span", task_id, "attempt", start, time(), os.getpid(), threading.get_ident(),
+                 {"uuid": uuid, "mirror": name, "trial": trial})
+            )
+            result["mirror"] = name
+            return result
+    raise last_error
+
+
+def _shard_main(mirrors, threads, timeout, tasks, events):
+    """Entry point of a shard process
+    """
+    from sentinelsat import SentinelAPI
+
+    sessions = {}
+    lock = threading.Lock()
+
+    def apis(name):
+        # one SentinelAPI per mirror and thread, sessions are not shared
+        key = (name, threading.get_ident())
+        with lock:
+            if key not in sessions:
+                mirror = mirrors[name]
+                sessions[key] = SentinelAPI(
+                    mirror["user"], mirror["password"], api_url=mirror["url"],
+                    show_progressbars=False, timeout=timeout,
+                )
+            return sessions[key]
+
+    def run():
+        while True:
+            task = tasks.get()
+            if task is None:
+                tasks.put(None)  # wake the next thread
+                return
+            try:
+                result = _download(apis, task, events)
+            except Exception as err:
+                events.put(("error", task[0], err.__class__.__name__, str(err)))
+            else:
+                events.put(("done", task[0], result))
+
+    pool = [threading.Thread(target=run, daemon=True) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+
+class ShardedDownloader(object):
+    """Pool of download processes with threads
+
+    Parameters
+    ----------
+    mirrors : dict
+        Mirror name to dict with "url", "user" and "password"
+    processes : int
+        Shards
+    threads : int
+        Download threads per shard
+    timeout : float
+        Request timeout of the shards' SentinelAPI
+    metrics : metrics.Metrics, optional
+        Retries and downloaded bytes are recorded, shards do not run the
+        session hooks of the main process
+    tracer : tracing.Tracer, optional
+        Download attempts are traced on one track per shard thread
+    """
+
+    def __init__(self, mirrors, processes, threads, timeout=15.0, metrics=None, tracer=None):
+        self.mirrors = mirrors
+        self.processes = processes
+        self.threads = threads
+        self.timeout = timeout
+        self._metrics = metrics
+        self._tracer = tracer
+        self._context = multiprocessing.get_context("spawn")
+        self._events = self._context.Queue()
+        self._futures = {}  # task id -> Future
+        self._tasks = {}  # task id -> [task, shard index, shards lost with]
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.logger = logging.getLogger("single-mirror")
+        self._queues = [None] * processes
+        self._shards = [self._start_shard(idx) for idx in range(processes)]
+        self._listener = threading.Thread(target=self._listen, name="shard-events", daemon=True)
+        self._listener.start()
+
+    def _start_shard(self, idx):
+        # a fresh queue, a killed shard may hold the lock of its old one
+        self._queues[idx] = self._context.Queue()
+        process = self._context.Process(
+            target=_shard_main,
+            args=(self.mirrors, self.threads, self.timeout, self._queues[idx], self._events),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _dispatch(self, task_id):
+        """Queue a task on the shard with the fewest outstanding tasks
+
+        Call with self._lock held
+        """
+        load = [0] * self.processes
+        for _, idx, _ in self._tasks.values():
+            if idx is not None:
+                load[idx] += 1
+        idx = load.index(min(load))
+        entry = self._tasks[task_id]
+        entry[1] = idx
+        self._queues[idx].put(entry[0])
+
+    def submit(self, uuid, img_dir, mirrors, retry=0, retry_delay=10):
+        """Queue a download
+
+        Parameters
+        ----------
+        uuid : str
+            Product UUID
+        img_dir : str
+            Directory to download to
+        mirrors : list
+            Mirror names to try in order
+        retry : int
+            Retries per mirror
+        retry_delay : float
+            Seconds between retries
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the download info of sentinelsat with the mirror
+            name under "mirror", or raises ShardError
+        """
+        if self._closed:
+            raise RuntimeError("cannot submit after shutdown")
+        future = Future()
+        future.set_running_or_notify_cancel()
+        task_id = next(self._ids)
+        with self._lock:
+            self._futures[task_id] = future
+            self._tasks[task_id] = [
+                (task_id, uuid, img_dir, list(mirrors), retry, retry_delay), None, 0
+            ]
+            self._dispatch(task_id)
+        return future
+
+    def _listen(self):
+        checked = time()
+        while True:
+            try:
+                event = self._events.get(timeout=1.0)
+            except queue.Empty:
+                if self._closed:
+                    return
+                event = None
+            if not self._closed and time() - checked >= 1.0:
+                self._check_shards()
+                checked = time()
+            if event is None:
+                continue
+            kind, task_id = event[0], event[1]
+            if kind == "retry":
+                self.logger.info("UUID %s | Raised '%s', trying again '%s'", event[3], event[4], event[2])
+                if self._metrics:
+                    self._metrics.retries.inc(mirror=event[2])
+            elif kind == "span":
+                if self._tracer:
+                    name, start, stop, pid, tid, args = event[2:]
+                    self._tracer.complete(
+                        name, "download", start, stop, pid=pid, tid=tid,
+                        process="download shard", **args
+                    )
+            else:
+                with self._lock:
+                    future = self._futures.pop(task_id, None)
+                    self._tasks.pop(task_id, None)
+                if future is None:
+                    continue
+                if kind == "done":
+                    result = event[2]
+                    if self._metrics and result.get("downloaded_bytes"):
+                        self._metrics.bytes.inc(result["downloaded_bytes"], mirror=result["mirror"])
+                    future.set_result(result)
+                else:
+                    future.set_exception(ShardError(event[2], event[3]))
+
+    def _check_shards(self):
+        """Restart shards that died, requeue or fail the tasks they held
+
+        Tasks taken but not finished by a dead shard are queued again,
+        up to MAX_SHARD_ATTEMPTS shards per task.
+        """
+        for idx, process in enumerate(self._shards):
+            if process.is_alive():
+                continue
+            self.logger.error(
+                "Download process %d exited (%s), restarting it", process.pid, process.exitcode
+            )
+            failed = []
+            with self._lock:
+                self._shards[idx] = self._start_shard(idx)
+                lost = [task_id for task_id, entry in self._tasks.items() if entry[1] == idx]
+                for task_id in lost:
+                    entry = self._tasks[task_id]
+                    entry[1] = None
+                    entry[2] += 1
+                for task_id in lost:
+                    if self._tasks[task_id][2] >= MAX_SHARD_ATTEMPTS:
+                        del self._tasks[task_id]
+                        failed.append(self._futures.pop(task_id))
+                    else:
+                        self._dispatch(task_id)
+            if len(lost) > len(failed):
+                self.logger.info("Requeued %d downloads of the process", len(lost) - len(failed))
+            for future in failed:
+                future.set_exception(
+                    ShardError("ShardDied", "exit code %s" % process.exitcode)
+                )
+
+    def pending(self):
+        """Return number of queued or running downloads
+        """
+        with self._lock:
+            return len(self._futures)
+
+    def shutdown(self, wait=True):
+        """Stop shards once queued downloads are done
+        """
+        self._closed = True
+        for tasks in self._queues:
+            tasks.put(None)
+        if wait:
+            for process in self._shards:
+                process.join()
+            self._listener.join()
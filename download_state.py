@@ -10,4 +10,6 @@ class DownloadState(Enum):
     DL_ACTIVE = 1  # Download active
     DL_DONE = 2  # Download finished
     EXTRACT_ACTIVE = 3  # Extraction active
-    EXTRACT_DONE = 4  # Extraction finished
\ No newline at end of file
+    EXTRACT_DONE = 4  # Extraction finished
+    VERIFY_ACTIVE = 5  # Checksum verification active
+    VERIFIED = 6  # Checksums match manifest.safe
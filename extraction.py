@@ -0,0 +1,179 @@
+import os
+import threading
+from time import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def _timed(fn, *args):
+    """Run fn in a worker process, return result with start/stop timestamps
+    and the worker's pid
+    """
+    start = time()
+    result = fn(*args)
+    return result, start, time(), os.getpid()
+
+
+class ExtractionStage(object):
+    """Bounded process pool for extracting downloaded products
+
+    Keeps track of the number of pending (queued or running) jobs so the
+    download loop can pause while extraction falls behind, and collects
+    queue and latency metrics. Worker processes are started by the first
+    submit, a stage that is shut down starts a new pool when used again.
+    A pool broken by a killed worker is replaced by the next submit.
+    """
+
+    def __init__(self, workers=None, max_pending=None, metrics=None, tracer=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._metrics = metrics  # metrics.Metrics or None
+        self._tracer = tracer  # tracing.Tracer or None
+        self.max_pending = max_pending or 2 * self.workers
+        self._executor = None
+
+        self._cond = threading.Condition()
+        self._pending = 0
+        self.max_depth = 0  # highest number of pending jobs
+        self.completed = 0
+        self.failed = 0
+        self._wait_time = 0.0  # summed seconds between submit and start
+        self._run_time = 0.0  # summed seconds of extraction
+        self._max_latency = 0.0
+
+    @property
+    def executor(self):
+        with self._cond:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def submit(self, fn, *args, tags=None):
+        """Submit fn(*args) to the pool
+
+        Parameters
+        ----------
+        tags : dict, optional
+            Arguments of the job's trace span, e.g. the product UUID
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the return value of fn
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        submitted = time()
+        with self._cond:
+            self._pending += 1
+            self.max_depth = max(self.max_depth, self._pending)
+            if self._metrics:
+                self._metrics.queue_depth.set(self._pending)
+        try:
+            executor = self.executor
+            try:
+                job = executor.submit(_timed, fn, *args)
+            except BrokenProcessPool:
+                self._discard(executor)
+                job = self.executor.submit(_timed, fn, *args)
+        except Exception as err:
+            # callers run in done callbacks, an exception would be lost
+            self._failed(future, err)
+            return future
+        name = getattr(fn, "__name__", "job")
+        job.add_done_callback(lambda job: self._done(job, future, submitted, name, tags))
+        return future
+
+    def _discard(self, executor):
+        """Drop a broken pool, the next submit starts a new one
+        """
+        with self._cond:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _failed(self, future, err):
+        future.set_exception(err)
+        with self._cond:
+            self._pending -= 1
+            self.failed += 1
+            if self._metrics:
+                self._metrics.queue_depth.set(self._pending)
+            self._cond.notify_all()
+
+    def _done(self, job, future, submitted, name, tags):
+        try:
+            result, start, stop, pid = job.result()
+        except BrokenProcessPool as err:
+            with self._cond:
+                broken = self._executor
+            if broken is not None and getattr(broken, "_broken", False):
+                self._discard(broken)
+            self._failed(future, err)
+            return
+        except Exception as err:
+            self._failed(future, err)
+            return
+        if self._tracer:
+            self._tracer.complete(name, "extract", start, stop, pid=pid, tid=pid, **(tags or {}))
+        # resolve first, so jobs submitted by done callbacks are counted
+        # before wait() can see an empty queue
+        future.set_result(result)
+        with self._cond:
+            self._pending -= 1
+            self.completed += 1
+            self._wait_time += max(start - submitted, 0.0)
+            self._run_time += stop - start
+            self._max_latency = max(self._max_latency, stop - submitted)
+            if self._metrics:
+                self._metrics.queue_depth.set(self._pending)
+                self._metrics.jobs.observe(stop - start, job=name)
+                self._metrics.job_wait.observe(max(start - submitted, 0.0), job=name)
+            self._cond.notify_all()
+
+    def pending(self):
+        """Return number of queued or running jobs
+        """
+        return self._pending
+
+    def saturated(self):
+        """Return True if the queue depth limit is reached
+        """
+        return self._pending >= self.max_pending
+
+    def wait_for_capacity(self, timeout=None):
+        """Block until the queue depth drops below the limit
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending < self.max_pending, timeout)
+
+    def wait(self, timeout=None):
+        """Block until all jobs are done
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def metrics(self):
+        """Return queue and latency metrics
+
+        Returns
+        -------
+        dict
+            Latencies in seconds, averaged over completed jobs
+        """
+        with self._cond:
+            done = max(self.completed, 1)
+            return {
+                "pending": self._pending,
+                "max_depth": self.max_depth,
+                "completed": self.completed,
+                "failed": self.failed,
+                "mean_wait": self._wait_time / done,
+                "mean_extract": self._run_time / done,
+                "max_latency": self._max_latency,
+            }
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
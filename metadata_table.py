@@ -0,0 +1,213 @@
+import json
+import datetime
+from collections import OrderedDict
+import numpy as np
+from utils import select_year_season, parse_size, SEASON_NAMES, EPOCH_ORDINAL
+from product_name import extension
+
+# Characters of the title column, Sentinel-3 titles are the longest with 94
+TITLE_WIDTH = 100
+
+
+def product_dtype(title_width=TITLE_WIDTH):
+    """Return the fixed width record of a product
+    """
+    return np.dtype(
+        [
+            ("uuid", "S36"),
+            ("tile", "S5"),
+            ("ingestiondate", "datetime64[ms]"),
+            ("cloud", "f8"),
+            ("size", "i8"),  # bytes
+            ("title", "S%d" % title_width),
+            ("mirrors", "u8"),  # bit mask over MetadataTable.mirrors
+        ]
+    )
+
+
+PRODUCT_DTYPE = product_dtype()
+
+class MetadataTable(object):
+    """Compact table of product metadata
+
+    Holds one fixed width row per product (see product_dtype) instead of
+    a nested dict of OpenSearch records. Tables can be saved as .npy file
+    and loaded memory-mapped. Mirror names are stored in a JSON sidecar
+    file next to it.
+
+    to_dict provides the nested MGRS tile -> UUID -> product dict view
+    used by the rest of the pipeline. info holds JSON serializable
+    annotations saved in the sidecar file, e.g. the estimates of a plan.
+    """
+
+    def __init__(self, data, mirrors=(), info=None):
+        self.data = data
+        self.mirrors = list(mirrors)
+        self.info = info or {}
+        self._rows = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"MetadataTable({len(self)} products, {len(self.tiles())} tiles)"
+
+    @classmethod
+    def from_meta(cls, meta):
+        """Build a table from a mapping of MGRS tile to UUID to product dict
+
+        The title column is widened for titles longer than TITLE_WIDTH, so
+        they are not truncated.
+        """
+        return cls.from_tiles(meta.items())
+
+    @classmethod
+    def from_tiles(cls, items):
+        """Build a table from (MGRS tile, mapping of UUID to product dict)
+        pairs, e.g. streamed from a large JSON document
+
+        Every tile is converted to rows before the next pair is read, so
+        only the product dicts of one tile are held at a time.
+        """
+        mirrors = []
+        chunks = []
+        width = TITLE_WIDTH
+        for tile, products in items:
+            width = max([width] + [len(product.get("title", "")) for product in products.values()])
+            data = np.zeros(len(products), dtype=product_dtype(width))
+            for row, uuid in enumerate(products):
+                product = products[uuid]
+                mask = 0
+                for mirror in product.get("mirrors", [product.get("mirror")]):
+                    if mirror is None:
+                        continue
+                    if mirror not in mirrors:
+                        mirrors.append(mirror)
+                    mask |= 1 << mirrors.index(mirror)
+                data[row] = (
+                    uuid,
+                    tile,
+                    product.get("ingestiondate", "NaT"),
+                    product.get("cloudcoverpercentage", np.nan),
+                    parse_size(product["size"]) if "size" in product else 0,
+                    product.get("title", ""),
+                    mask,
+                )
+            chunks.append(data)
+        dtype = product_dtype(width)
+        data = np.concatenate([chunk.astype(dtype) for chunk in chunks]) if chunks else np.zeros(0, dtype)
+        return cls(data, mirrors)
+
+    @classmethod
+    def load(cls, fpath, mmap=True):
+        """Load a table saved with save, memory-mapped by default
+        """
+        data = np.load(fpath, mmap_mode="r" if mmap else None)
+        with open(fpath + ".json", "r") as f:
+            sidecar = json.load(f)
+        return cls(data, sidecar["mirrors"], sidecar.get("info"))
+
+    def save(self, fpath):
+        """Save table to fpath (.npy), mirror names and info to fpath + ".json"
+        """
+        np.save(fpath, self.data, allow_pickle=False)
+        if not fpath.endswith(".npy"):
+            fpath += ".npy"
+        with open(fpath + ".json", "w") as f:
+            json.dump({"mirrors": self.mirrors, "info": self.info}, f)
+
+    def tiles(self):
+        """Return MGRS tiles in order of first appearance
+        """
+        tiles, first = np.unique(self.data["tile"], return_index=True)
+        return [tile.decode() for tile in tiles[np.argsort(first)]]
+
+    def keys(self):
+        """Return (utm, UUID) pairs of all products
+        """
+        return [
+            (tile.decode(), uuid.decode())
+            for tile, uuid in zip(self.data["tile"], self.data["uuid"])
+        ]
+
+    def filenames(self):
+        """Return mapping of UUID to product filename
+        """
+        return {
+            uuid.decode(): title.decode() + extension(title.decode())
+            for uuid, title in zip(self.data["uuid"], self.data["title"])
+            if title
+        }
+
+    def _mirror_names(self, mask):
+        return [name for bit, name in enumerate(self.mirrors) if mask >> bit & 1]
+
+    def mirror_map(self):
+        """Return mapping of UUID to list of mirrors holding the product
+        """
+        return {
+            uuid.decode(): self._mirror_names(int(mask))
+            for uuid, mask in zip(self.data["uuid"], self.data["mirrors"])
+        }
+
+    def record(self, uuid):
+        """Return the product dict of a UUID
+        """
+        if self._rows is None:
+            self._rows = {uuid.decode(): row for row, uuid in enumerate(self.data["uuid"])}
+        return self._record(self.data[self._rows[uuid]])
+
+    def _record(self, row):
+        mirrors = self._mirror_names(int(row["mirrors"]))
+        product = {
+            "uuid": row["uuid"].decode(),
+            "title": row["title"].decode(),
+            "filename": row["title"].decode() + extension(row["title"].decode()),
+            "tileid": row["tile"].decode(),
+            "cloudcoverpercentage": float(row["cloud"]),
+            "size": "%.2f MB" % (row["size"] / 1048576),
+            "mirrors": mirrors,
+        }
+        if mirrors:
+            product["mirror"] = mirrors[0]
+        if not np.isnat(row["ingestiondate"]):
+            product["ingestiondate"] = row["ingestiondate"].astype(datetime.datetime)
+        return product
+
+    def to_dict(self):
+        """Return mapping of MGRS tile to UUID to product dict
+        """
+        meta = OrderedDict((tile, OrderedDict()) for tile in self.tiles())
+        for row in self.data:
+            meta[row["tile"].decode()][row["uuid"].decode()] = self._record(row)
+        return meta
+
+    def select(self):
+        """Year/season product selection over all tiles
+
+        Same ranking as utils.get_year_season_selection, file sizes are
+        compared in bytes.
+
+        Returns
+        -------
+        dict
+            Nested dict with tile, year and season as keys
+        """
+        tiles = self.tiles()
+        selection = {tile: {} for tile in tiles}
+        valid = np.flatnonzero(~np.isnat(self.data["ingestiondate"]))
+        if not len(valid):
+            return selection
+        data = self.data[valid]
+        tile_idx = np.unique(data["tile"], return_inverse=True)[1].ravel()
+        # map sorted tile index to order of appearance
+        order = {tile.encode(): idx for idx, tile in enumerate(tiles)}
+        lookup = np.array([order[tile] for tile in np.unique(data["tile"])])
+        day = data["ingestiondate"].astype("datetime64[D]").astype(np.int64) + EPOCH_ORDINAL
+        best, tile_pos, year, season = select_year_season(
+            lookup[tile_idx], day, data["cloud"], data["size"]
+        )
+        for row, idx, _year, _season in zip(best, tile_pos, year, season):
+            years = selection[tiles[idx]]
+            years.setdefault(int(_year), {})[SEASON_NAMES[_season]] = data["uuid"][row].decode()
+        return selection
@@ -0,0 +1,315 @@
+"""Live run metrics in Prometheus text format
+
+Counters, gauges and histograms are kept in a Registry and served over
+HTTP by MetricsServer while a run is in progress, e.g. for a Prometheus
+scrape job feeding Grafana:
+
+    curl http://localhost:9100/metrics
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from fast OData responses to slow product downloads
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DURATION_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+
+
+class _Metric(object):
+    """Metric with optional labels, values are kept per label combination
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                "%s expects labels %s, got %s" % (self.name, self.labels, tuple(labels))
+            )
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def expose(self):
+        """Return lines in Prometheus text format
+        """
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._expose(key, self._values[key]))
+        return lines
+
+    def _expose(self, key, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.labels, key), _format_value(value))]
+
+
+class Counter(_Metric):
+    """Monotonically increasing value
+    """
+
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """Value that can go up and down
+    """
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self._values[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _expose(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, num in zip(self.buckets, counts):
+            cumulative += num
+            lines.append(
+                "%s_bucket%s %d"
+                % (self.name, _format_labels(self.labels, key, [("le", _format_value(bound))]), cumulative)
+            )
+        labels = _format_labels(self.labels, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, _format_value(total)))
+        lines.append("%s_count%s %d" % (self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+    """Collection of metrics
+
+    Collectors are called before every exposition, e.g. to set gauges
+    from the current state of a download list.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector):
+        """Register a function called without arguments before exposition
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def exposition(self):
+        """Return all metrics in Prometheus text format
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics)
+        for collector in collectors:
+            collector()
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    """Metrics of the download pipeline
+
+    Parameters
+    ----------
+    registry : Registry, optional
+        Registry to add the metrics to, a new one by default
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.bytes = r.counter(
+            "sentinel_download_bytes_total", "Bytes received from product downloads", ["mirror"]
+        )
+        self.requests = r.counter(
+            "sentinel_requests_total", "HTTP requests by endpoint and status", ["mirror", "endpoint", "status"]
+        )
+        self.ttfb = r.histogram(
+            "sentinel_time_to_first_byte_seconds", "Time until response headers arrived",
+            ["mirror", "endpoint"],
+        )
+        self.retries = r.counter("sentinel_download_retries_total", "Retried downloads", ["mirror"])
+        self.downloads = r.counter(
+            "sentinel_downloads_total", "Finished downloads by result", ["mirror", "result"]
+        )
+        self.download_seconds = r.histogram(
+            "sentinel_download_duration_seconds", "Product download duration", ["mirror"],
+            DURATION_BUCKETS,
+        )
+        self.products = r.gauge("sentinel_products", "Products of the current run by state", ["state"])
+        self.jobs = r.histogram(
+            "sentinel_extraction_job_seconds", "Run time of extraction pool jobs", ["job"],
+            DURATION_BUCKETS,
+        )
+        self.job_wait = r.histogram(
+            "sentinel_extraction_wait_seconds", "Time jobs spent queued in the extraction pool", ["job"]
+        )
+        self.queue_depth = r.gauge("sentinel_extraction_queue_depth", "Queued or running extraction jobs")
+
+    def instrument(self, mirror, session):
+        """Record requests of a requests.Session under a mirror name
+
+        Adds a response hook recording status and time to first byte, and
+        counting the bytes read from product downloads as they stream in.
+        """
+        metrics = self
+
+        def hook(response, *args, **kwargs):
+            endpoint = _endpoint(response.url)
+            metrics.requests.inc(mirror=mirror, endpoint=endpoint, status=response.status_code)
+            metrics.ttfb.observe(response.elapsed.total_seconds(), mirror=mirror, endpoint=endpoint)
+            if endpoint == "download" and response.raw is not None:
+                _count_reads(response.raw, metrics.bytes, mirror)
+            return response
+
+        session.hooks.setdefault("response", []).append(hook)
+
+
+def _endpoint(url):
+    if "/$value" in url:
+        return "download"
+    if "/odata/" in url:
+        return "odata"
+    if "/search" in url:
+        return "search"
+    return "other"
+
+
+def _count_reads(raw, counter, mirror):
+    """Wrap read of a urllib3 response so streamed bytes are counted live
+    """
+    read = raw.read
+
+    def counted(*args, **kwargs):
+        data = read(*args, **kwargs)
+        if data:
+            counter.inc(len(data), mirror=mirror)
+        return data
+
+    raw.read = counted
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serve a Registry at /metrics from a daemon thread
+
+    Parameters
+    ----------
+    registry : Registry
+    port : int
+        0 picks a free port
+    host : str
+        Interface to listen on, local only by default
+    """
+
+    daemon_threads = True
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        super().__init__((host, port), _Handler)
+        self.registry = registry
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://%s:%d/metrics" % self.server_address[:2]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,361 @@
+"""Local spatial index of the Sentinel-2 MGRS tiling grid
+
+Resolves a footprint to the intersecting Sentinel-2 tile IDs without
+querying DHuS. The grid is not shipped as a data file, it is derived from
+the MGRS definition instead:
+
+    - every 100 km MGRS square intersecting a UTM zone / latitude band cell
+      is a Sentinel-2 tile
+    - a tile extends the square by 9.8 km to the east and to the south
+      (109.8 km x 109.8 km)
+
+Tile bounding boxes are precomputed per zone and latitude band on first use
+and kept in flat arrays, so lookups only project a handful of points.
+
+Tiles crossing the antimeridian are not handled.
+"""
+import re
+from array import array
+from functools import lru_cache
+from math import (
+    asin,
+    atan,
+    atan2,
+    atanh,
+    cos,
+    cosh,
+    degrees,
+    floor,
+    radians,
+    sin,
+    sinh,
+    sqrt,
+)
+
+# WGS84 ellipsoid and UTM constants
+_A = 6378137.0
+_F = 1 / 298.257223563
+_K0 = 0.9996
+_E0 = 500000.0
+_N0_SOUTH = 10000000.0
+
+_N = _F / (2 - _F)
+_RECT = _A / (1 + _N) * (1 + _N ** 2 / 4 + _N ** 4 / 64)
+_ALPHA = (
+    _N / 2 - 2 * _N ** 2 / 3 + 5 * _N ** 3 / 16,
+    13 * _N ** 2 / 48 - 3 * _N ** 3 / 5,
+    61 * _N ** 3 / 240,
+)
+_BETA = (
+    _N / 2 - 2 * _N ** 2 / 3 + 37 * _N ** 3 / 96,
+    _N ** 2 / 48 + _N ** 3 / 15,
+    17 * _N ** 3 / 480,
+)
+_DELTA = (
+    2 * _N - 2 * _N ** 2 / 3 - 2 * _N ** 3,
+    7 * _N ** 2 / 3 - 8 * _N ** 3 / 5,
+    56 * _N ** 3 / 15,
+)
+_ECC = 2 * sqrt(_N) / (1 + _N)
+
+# MGRS lettering
+_BANDS = "CDEFGHJKLMNPQRSTUVWX"
+_COLUMNS = ("ABCDEFGH", "JKLMNPQR", "STUVWXYZ")
+_ROWS = "ABCDEFGHJKLMNPQRSTUV"
+
+SQUARE = 100000.0  # MGRS square edge in m
+TILE = 109800.0  # Sentinel-2 tile edge in m
+
+# Zones that differ from the regular 6 degree layout (Norway / Svalbard)
+_SPECIAL_ZONES = {
+    ("V", 31): (0.0, 3.0),
+    ("V", 32): (3.0, 12.0),
+    ("X", 31): (0.0, 9.0),
+    ("X", 32): None,
+    ("X", 33): (9.0, 21.0),
+    ("X", 34): None,
+    ("X", 35): (21.0, 33.0),
+    ("X", 36): None,
+    ("X", 37): (33.0, 42.0),
+}
+
+_COORDS = re.compile(r"\(([^()]+)\)")
+
+
+def _central_meridian(zone):
+    return -183.0 + 6.0 * zone
+
+
+def to_utm(lat, lon, zone, south=None):
+    """Project geographic coordinates into a given UTM zone
+
+    Parameters
+    ----------
+    lat : float
+        Latitude in degrees
+    lon : float
+        Longitude in degrees
+    zone : int
+        UTM zone number
+    south : bool
+        Apply the southern false northing, defaults to lat < 0
+
+    Returns
+    -------
+    tuple
+        (easting, northing) in m
+    """
+    phi = radians(lat)
+    lam = radians(lon - _central_meridian(zone))
+    t = sinh(atanh(sin(phi)) - _ECC * atanh(_ECC * sin(phi)))
+    xi = atan2(t, cos(lam))
+    eta = atanh(sin(lam) / sqrt(1 + t * t))
+    easting = eta
+    northing = xi
+    for j, alpha in enumerate(_ALPHA, start=1):
+        easting += alpha * cos(2 * j * xi) * sinh(2 * j * eta)
+        northing += alpha * sin(2 * j * xi) * cosh(2 * j * eta)
+    easting = _E0 + _K0 * _RECT * easting
+    northing = _K0 * _RECT * northing
+    if south or (south is None and lat < 0):
+        northing += _N0_SOUTH
+    return easting, northing
+
+
+def from_utm(easting, northing, zone, south=False):
+    """Inverse of to_utm
+
+    Returns
+    -------
+    tuple
+        (lat, lon) in degrees
+    """
+    if south:
+        northing -= _N0_SOUTH
+    xi = northing / (_K0 * _RECT)
+    eta = (easting - _E0) / (_K0 * _RECT)
+    _xi = xi
+    _eta = eta
+    for j, beta in enumerate(_BETA, start=1):
+        _xi -= beta * sin(2 * j * xi) * cosh(2 * j * eta)
+        _eta -= beta * cos(2 * j * xi) * sinh(2 * j * eta)
+    chi = asin(sin(_xi) / cosh(_eta))
+    phi = chi
+    for j, delta in enumerate(_DELTA, start=1):
+        phi += delta * sin(2 * j * chi)
+    lam = atan(sinh(_eta) / cos(_xi))
+    return degrees(phi), _central_meridian(zone) + degrees(lam)
+
+
+def _band_lat_bounds(band):
+    idx = _BANDS.index(band)
+    lat0 = -80.0 + 8.0 * idx
+    return lat0, (84.0 if band == "X" else lat0 + 8.0)
+
+
+def _zone_lon_bounds(zone, band):
+    key = (band, zone)
+    if key in _SPECIAL_ZONES:
+        return _SPECIAL_ZONES[key]
+    lon0 = -180.0 + 6.0 * (zone - 1)
+    return lon0, lon0 + 6.0
+
+
+def _square_id(zone, band, easting, northing):
+    column = _COLUMNS[(zone - 1) % 3][int(easting // SQUARE) - 1]
+    row = _ROWS[(int(northing // SQUARE) + (5 if zone % 2 == 0 else 0)) % 20]
+    return "%02d%s%s%s" % (zone, band, column, row)
+
+
+def _edge_samples(x0, y0, x1, y1, num=4):
+    """Sample the boundary of an axis-aligned rectangle counter-clockwise
+    """
+    points = []
+    for k in range(num):
+        points.append((x0 + (x1 - x0) * k / num, y0))
+    for k in range(num):
+        points.append((x1, y0 + (y1 - y0) * k / num))
+    for k in range(num):
+        points.append((x1 - (x1 - x0) * k / num, y1))
+    for k in range(num):
+        points.append((x0, y1 - (y1 - y0) * k / num))
+    return points
+
+
+@lru_cache(maxsize=None)
+def _cell_index(zone, band):
+    """Build tile ids, lon/lat rings and bounding boxes for a zone/band cell
+
+    Returns
+    -------
+    tuple
+        (ids, rings, minlon, minlat, maxlon, maxlat)
+        bounding boxes are array("d") with one entry per tile
+    """
+    ids = []
+    rings = []
+    bbox = tuple(array("d") for _ in range(4))
+    lon_bounds = _zone_lon_bounds(zone, band)
+    if lon_bounds is None:
+        return (ids, rings) + bbox
+    lon0, lon1 = lon_bounds
+    lat0, lat1 = _band_lat_bounds(band)
+    south = lat1 <= 0
+
+    cell = [to_utm(lat, lon, zone, south) for lon, lat in _edge_samples(lon0, lat0, lon1, lat1, 8)]
+    e_min = min(e for e, _ in cell)
+    e_max = max(e for e, _ in cell)
+    n_min = min(n for _, n in cell)
+    n_max = max(n for _, n in cell)
+
+    def in_cell(lat, lon):
+        return lat0 <= lat <= lat1 and lon0 <= lon <= lon1
+
+    for i in range(int(floor(e_min / SQUARE)), int(floor(e_max / SQUARE)) + 1):
+        for j in range(int(floor(n_min / SQUARE)), int(floor(n_max / SQUARE)) + 1):
+            e0 = i * SQUARE
+            n0 = j * SQUARE
+            if not 1 <= i <= 8:
+                continue
+            square = _edge_samples(e0, n0, e0 + SQUARE, n0 + SQUARE, 2)
+            square.append((e0 + SQUARE / 2, n0 + SQUARE / 2))
+            inside = any(
+                in_cell(*from_utm(e, n, zone, south)) for e, n in square
+            ) or any(
+                e0 <= e <= e0 + SQUARE and n0 <= n <= n0 + SQUARE for e, n in cell
+            )
+            if not inside:
+                continue
+            ring = [
+                from_utm(e, n, zone, south)[::-1]
+                for e, n in _edge_samples(e0, n0 + SQUARE - TILE, e0 + TILE, n0 + SQUARE, 3)
+            ]
+            ids.append(_square_id(zone, band, e0, n0))
+            rings.append(ring)
+            bbox[0].append(min(p[0] for p in ring))
+            bbox[1].append(min(p[1] for p in ring))
+            bbox[2].append(max(p[0] for p in ring))
+            bbox[3].append(max(p[1] for p in ring))
+    return (ids, rings) + bbox
+
+
+def _point_in_ring(x, y, ring):
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i]
+        xj, yj = ring[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _segments_cross(p1, p2, q1, q2):
+    def orient(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+    d1 = orient(q1, q2, p1)
+    d2 = orient(q1, q2, p2)
+    d3 = orient(p1, p2, q1)
+    d4 = orient(p1, p2, q2)
+    return (d1 > 0) != (d2 > 0) and (d3 > 0) != (d4 > 0)
+
+
+def _rings_intersect(ring, tile):
+    if any(_point_in_ring(x, y, tile) for x, y in ring):
+        return True
+    if len(ring) > 2 and any(_point_in_ring(x, y, ring) for x, y in tile):
+        return True
+    for k in range(len(ring) - 1):
+        for m in range(len(tile)):
+            if _segments_cross(ring[k], ring[k + 1], tile[m - 1], tile[m]):
+                return True
+    return False
+
+
+def parse_wkt(wkt):
+    """Extract coordinate rings from a WKT string
+
+    Works for (MULTI)POINT, (MULTI)LINESTRING and (MULTI)POLYGON as produced
+    by sentinelsat.geojson_to_wkt. Holes are treated as outer rings.
+
+    Returns
+    -------
+    list
+        List of rings, each a list of (lon, lat) tuples
+    """
+    rings = []
+    for group in _COORDS.findall(wkt):
+        ring = []
+        for pair in group.split(","):
+            lon, lat = pair.split()[:2]
+            ring.append((float(lon), float(lat)))
+        rings.append(ring)
+    return rings
+
+
+def tiles_for_bbox(minlon, minlat, maxlon, maxlat):
+    """Return all tiles whose bounding box intersects a lon/lat bounding box
+
+    Returns
+    -------
+    list
+        Sorted list of (tile id, tile ring) tuples
+    """
+    lat_lo = max(minlat, -80.0)
+    lat_hi = min(maxlat, 84.0)
+    if lat_lo > lat_hi:
+        return []
+    bands = _BANDS[
+        min(int((lat_lo + 80.0) // 8), 19):min(int((lat_hi + 80.0) // 8), 19) + 1
+    ]
+    # tiles reach up to ~1.5 degree beyond their zone at high latitudes
+    zone_lo = max(int((minlon + 180.0 - 1.5) // 6) + 1, 1)
+    zone_hi = min(int((maxlon + 180.0 + 1.5) // 6) + 1, 60)
+    found = {}
+    for zone in range(zone_lo, zone_hi + 1):
+        for band in bands:
+            ids, rings, x0, y0, x1, y1 = _cell_index(zone, band)
+            for k in range(len(ids)):
+                if x0[k] <= maxlon and x1[k] >= minlon and y0[k] <= maxlat and y1[k] >= minlat:
+                    found[ids[k]] = rings[k]
+    return sorted(found.items())
+
+
+def tile_ring(tile):
+    """Return the lon/lat ring of a Sentinel-2 tile, None for unknown ids
+    """
+    match = re.match(r"^([0-9]{1,2})([C-X])([A-Z]{2})$", tile)
+    if not match:
+        return None
+    zone, band, _ = match.groups()
+    ids, rings = _cell_index(int(zone), band)[:2]
+    if tile.zfill(5) not in ids:
+        return None
+    return rings[ids.index(tile.zfill(5))]
+
+
+def tiles_for_footprint(wkt):
+    """Resolve a WKT footprint to the intersecting Sentinel-2 tile IDs
+
+    Parameters
+    ----------
+    wkt : str
+        Footprint as WKT, e.g. output of sentinelsat.geojson_to_wkt
+
+    Returns
+    -------
+    list
+        Sorted list of MGRS tile IDs
+    """
+    tiles = set()
+    for ring in parse_wkt(wkt):
+        minlon = min(p[0] for p in ring)
+        maxlon = max(p[0] for p in ring)
+        minlat = min(p[1] for p in ring)
+        maxlat = max(p[1] for p in ring)
+        for tile, tile_ring in tiles_for_bbox(minlon, minlat, maxlon, maxlat):
+            if tile not in tiles and _rings_intersect(ring, tile_ring):
+                tiles.add(tile)
+    return sorted(tiles)
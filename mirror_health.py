@@ -0,0 +1,230 @@
+"""Mirror health and throughput history
+
+Probes measure latency, small-range download throughput and
+availability of every mirror. Results, and the throughput of real
+downloads, are kept as time-decaying averages in a JSON file, so a run
+starts with the ranking of previous runs instead of opening connections
+blind.
+"""
+import os
+import json
+import random
+import logging
+import tempfile
+import threading
+from time import time, perf_counter
+
+# Weight of a sample halves after this many seconds
+HALF_LIFE = 7 * 24 * 3600.0
+# Bytes read by a throughput probe
+PROBE_BYTES = 4 * 1048576
+# Assumed values of mirrors without history
+DEFAULT_THROUGHPUT = 1.0  # MB/s
+DEFAULT_AVAILABILITY = 0.5
+
+
+class MirrorHealth(object):
+    """Decaying history of mirror latency, throughput and availability
+
+    Keyed by mirror URL, so history survives renaming a mirror in the
+    config. Every metric is an average in which a sample's weight halves
+    every half_life seconds.
+
+    Parameters
+    ----------
+    path : str or None
+        JSON file the history is loaded from and saved to
+    half_life : float
+        Seconds
+    """
+
+    def __init__(self, path=None, half_life=HALF_LIFE):
+        self.path = path
+        self.half_life = half_life
+        self.mirrors = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.mirrors = json.load(f).get("mirrors", {})
+            except (OSError, ValueError) as err:
+                logging.getLogger("single-mirror").warning(
+                    "Ignoring mirror health file %s: %s", path, err
+                )
+
+    def _update(self, url, metric, value, now=None):
+        now = now or time()
+        entry = self.mirrors.setdefault(url, {})
+        value_old, weight, updated = entry.get(metric, (0.0, 0.0, now))
+        weight *= 0.5 ** (max(now - updated, 0.0) / self.half_life)
+        entry[metric] = ((value_old * weight + value) / (weight + 1), weight + 1, now)
+
+    def record(self, url, latency=None, throughput=None, available=True):
+        """Add a probe or download result
+
+        Parameters
+        ----------
+        url : str
+            Mirror URL
+        latency : float, optional
+            Seconds until the response to a small request
+        throughput : float, optional
+            MB/s
+        available : bool
+            False if the request failed
+        """
+        with self._lock:
+            now = time()
+            self._update(url, "availability", 1.0 if available else 0.0, now)
+            if latency is not None:
+                self._update(url, "latency", latency, now)
+            if throughput is not None:
+                self._update(url, "throughput", throughput, now)
+
+    def get(self, url, metric, default=None):
+        """Return the decayed average of a metric or default without history
+        """
+        with self._lock:
+            entry = self.mirrors.get(url, {})
+            return entry[metric][0] if metric in entry else default
+
+    def score(self, url):
+        """Expected useful throughput in MB/s, throughput times availability
+        """
+        return self.get(url, "throughput", DEFAULT_THROUGHPUT) * self.get(
+            url, "availability", DEFAULT_AVAILABILITY
+        )
+
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            data = json.dumps({"half_life": self.half_life, "mirrors": self.mirrors}, indent=1)
+        # a unique temporary file, threads and processes may save at once
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def probe(api, query, probe_bytes=PROBE_BYTES, uuid=None):
+    """Measure latency and small-range throughput of a mirror
+
+    Parameters
+    ----------
+    api : sentinelsat.SentinelAPI
+    query : dict
+        Query keywords matching at least one product, e.g. a test tile
+    uuid : str, optional
+        Product to probe, skips the query
+
+    Returns
+    -------
+    tuple
+        (latency in s, throughput in MB/s, probed UUID)
+
+    Raises
+    ------
+    SentinelAPIError, RequestException
+        If the mirror is not available
+    """
+    from sentinelsat import SentinelAPIError
+    if uuid is None:
+        products = api.query(limit=1, **query)
+        if not products:
+            raise SentinelAPIError("No product matches the probe query")
+        uuid = next(iter(products))
+    tic = perf_counter()
+    info = api.get_product_odata(uuid)
+    latency = perf_counter() - tic
+
+    size = min(probe_bytes, info["size"])
+    tic = perf_counter()
+    received = 0
+    response = api.session.get(
+        info["url"],
+        headers={"Range": "bytes=0-%d" % (size - 1)},
+        stream=True,
+        auth=api.session.auth,
+        timeout=api.timeout,
+    )
+    try:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            received += len(chunk)
+            if received >= size:
+                break
+    finally:
+        response.close()
+    elapsed = max(perf_counter() - tic, 1e-6)
+    return latency, received / 1048576 / elapsed, uuid
+
+
+class HealthMonitor(object):
+    """Probe mirrors in a background thread
+
+    Parameters
+    ----------
+    health : MirrorHealth
+    apis : dict
+        Mapping of mirror URL to SentinelAPI
+    queries : list
+        Query keyword dicts to probe with, one is picked per probe
+    interval : float
+        Seconds between probe rounds
+    """
+
+    def __init__(self, health, apis, queries, interval=600.0):
+        self.health = health
+        self.apis = apis
+        self.queries = queries
+        self.interval = interval
+        self.logger = logging.getLogger("single-mirror")
+        self._uuids = {}  # mirror URL -> probed product
+        self._stop = threading.Event()
+        self._thread = None
+
+    def probe_all(self):
+        """Probe every mirror once and save the history
+        """
+        from sentinelsat import SentinelAPIError
+        from requests.exceptions import RequestException
+        for url, api in list(self.apis.items()):
+            if self._stop.is_set():
+                break
+            try:
+                latency, throughput, uuid = probe(
+                    api, random.choice(self.queries), uuid=self._uuids.get(url)
+                )
+            except (SentinelAPIError, RequestException, KeyError, ValueError) as err:
+                self._uuids.pop(url, None)
+                self.health.record(url, available=False)
+                self.logger.debug("Probe of %s raised '%s'", url, err.__class__.__name__)
+                continue
+            self._uuids[url] = uuid
+            self.health.record(url, latency=latency, throughput=throughput)
+            self.logger.debug(
+                "Probe of %s: %.3f sec latency, %.2f MB/s", url, latency, throughput
+            )
+        self.health.save()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Start probing, the first round runs immediately
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mirror-probe", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,109 @@
+"""Dry-run plans of an order
+
+A plan is the selected subset of an order's MetadataTable together with
+estimates of download size, wall time and disk usage. Plans are saved as
+metadata table (.npy) with the estimates in its JSON sidecar; passing the
+saved table as order downloads exactly the planned products without
+searching or selecting again.
+"""
+import datetime
+import numpy as np
+from metadata_table import MetadataTable
+
+# Size of an extracted SAFE relative to its zip, JP2 bands are stored
+EXTRACT_RATIO = 1.0
+
+
+def aggregate_throughput(scores, parallel):
+    """Expected MB/s of parallel downloads spread over mirrors
+
+    Query.find_mirror gives mirrors download slots in proportion to their
+    score, so a slot runs on average at the score-weighted mean score.
+
+    Parameters
+    ----------
+    scores : dict
+        Mirror name to expected MB/s per download
+    parallel : int
+        Concurrent downloads
+    """
+    total = sum(scores.values())
+    if not total:
+        return 0.0
+    return parallel * sum(score * score for score in scores.values()) / total
+
+
+def make_plan(table, selection, scores, parallel):
+    """Return the planned table and the estimates of downloading it
+
+    Parameters
+    ----------
+    table : MetadataTable
+        Searched products
+    selection : dict
+        Selected products as returned by Query.select
+    scores : dict
+        Mirror name to expected MB/s per download, see
+        SentinelAPIManager.mirror_score
+    parallel : int
+        Concurrent downloads
+
+    Returns
+    -------
+    tuple
+        (MetadataTable of selected products, dict of estimates)
+    """
+    selected = set()
+    for tile in selection:
+        for year in selection[tile]:
+            for choice in selection[tile][year].values():
+                # policies choose a UUID or a list of UUIDs per bucket
+                if isinstance(choice, list):
+                    selected.update(uuid.encode() for uuid in choice)
+                else:
+                    selected.add(choice.encode())
+    data = table.data[np.isin(table.data["uuid"], list(selected))]
+    planned = MetadataTable(np.array(data), table.mirrors)
+
+    tiles = {}
+    for tile, size in zip(data["tile"], data["size"]):
+        entry = tiles.setdefault(tile.decode(), {"products": 0, "bytes": 0})
+        entry["products"] += 1
+        entry["bytes"] += int(size)
+    total = int(data["size"].sum())
+    rate = aggregate_throughput(
+        {name: score for name, score in scores.items() if name in table.mirrors}, parallel
+    )
+    planned.info = {
+        "plan": True,
+        "products": len(data),
+        "bytes": total,
+        "tiles": tiles,
+        "throughput": rate,  # MB/s
+        "seconds": total / 1048576 / rate if rate else None,
+        # peak disk usage, zips stay next to the extracted SAFE
+        "disk_keep_zip": total,
+        "disk_extract": int(total * (1 + EXTRACT_RATIO)),
+    }
+    return planned, planned.info
+
+
+def format_plan(info):
+    """Return report lines of plan estimates
+    """
+    gb = 1024.0 ** 3
+    lines = ["%-8s %8s %10s" % ("MGRS", "products", "GB")]
+    for tile, entry in info["tiles"].items():
+        lines.append("%-8s %8d %10.2f" % (tile, entry["products"], entry["bytes"] / gb))
+    lines.append("%-8s %8d %10.2f" % ("total", info["products"], info["bytes"] / gb))
+    lines.append("")
+    if info["seconds"] is None:
+        lines.append("Wall time: unknown, no mirror throughput available")
+    else:
+        lines.append(
+            "Wall time: %s at %.2f MB/s"
+            % (datetime.timedelta(seconds=round(info["seconds"])), info["throughput"])
+        )
+    lines.append("Peak disk with zip retention (keep_zip): %.2f GB" % (info["disk_keep_zip"] / gb))
+    lines.append("Peak disk with extraction: %.2f GB" % (info["disk_extract"] / gb))
+    return lines
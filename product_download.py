@@ -26,6 +26,12 @@ class ProductDownload(object):
     into ProductDownload and ProductDownloadList
     """
 
+    # no per-instance __dict__, orders keep one record per product
+    __slots__ = (
+        "uuid", "utm", "index", "state", "mirror", "future", "zip_path", "safe_path",
+        "index_path", "_start_time", "_stop_time", "size", "speed",
+    )
+
     def __init__(self, uuid, index, utm=None):
         self.uuid = uuid  # Product UUID
         self.utm = utm  # Product MGRS tile
@@ -33,14 +39,14 @@ class ProductDownload(object):
         self.state = DownloadState.SCHEDULED  # Download state
 
         self.mirror = None  # best mirror available or None
-        self.future = None  # future object or None
+        self.future = None  # future object while the download is active or None
         self.zip_path = None  # path to zip file or None
         self.safe_path = None  # path to extracted SAFE folder or None
+        self.index_path = None  # path to zip member index or None (keep_zip)
         self._start_time = None  # time of download start
         self._stop_time = None  # time of download stop
         self.size = None  # file size of zip file
         self.speed = None  # download speed
-        self.odata = None  # OData for completed download
 
     def __str__(self):
         return f"UUID: {self.uuid}\nMirror: {self.mirror}\nState: {self.state}"
@@ -54,15 +60,17 @@ class ProductDownload(object):
         self.future.add_done_callback(self._done_callback)
 
     def _done_callback(self, future):
-        """Update state to DL_DONE, calculate download speed, assign OData response
+        """Update state to DL_DONE, calculate download speed and zip path
 
-        Invoked when a download is completed
+        Invoked when a download is completed. The future, holding the
+        OData response or the exception, is released afterwards.
         """
         self._stop_time = perf_counter()
         try:
-            self.odata = future.result()
+            odata = future.result()
         except Exception as err:
             self.state = DownloadState.FAILED
+            self.future = None
             self.size = 0
             self.speed = 0
             self.zip_path = ""
@@ -77,10 +85,11 @@ class ProductDownload(object):
             logger.error(str(err))
             return
 
-        self.size = byte_to_MB(self.odata["size"])
+        self.size = byte_to_MB(odata["size"])
         self.speed = MB_per_sec(self._start_time, self._stop_time, self.size)
-        self.zip_path = self.odata["path"]
+        self.zip_path = odata["path"]
         self.state = DownloadState.DL_DONE
+        self.future = None
 
     def _unzip_callback(self, future):
         """Update ProductDownload state to EXTRACT_DONE
@@ -101,4 +110,25 @@ class ProductDownload(object):
             )
             logger.error(str(err))
             return
-        self.state = DownloadState.EXTRACT_DONE
\ No newline at end of file
+        self.state = DownloadState.EXTRACT_DONE
+
+    def _index_callback(self, future):
+        """Update ProductDownload state to EXTRACT_DONE, product stays zipped
+
+        Invoked when the zip member index is written
+        """
+        try:
+            self.index_path = future.result()
+        except Exception as err:
+            self.state = DownloadState.FAILED
+            # manually acquire module logger
+            logger = logging.getLogger("single-mirror")
+            logger.info(
+                "[%d/%d] UUID %s | Indexing failed",
+                self.index[0],
+                self.index[1],
+                self.uuid,
+            )
+            logger.error(str(err))
+            return
+        self.state = DownloadState.EXTRACT_DONE
@@ -1,3 +1,4 @@
+from time import sleep
 from download_state import DownloadState
 from concurrent.futures import (
     ThreadPoolExecutor,
@@ -21,6 +22,8 @@ class ProductDownloadList(list):
             f"Downloaded: {len(self.get_downloaded())}\n"
             f"Extracting: {len(self.get_extracting())}\n"
             f"Extracted: {len(self.get_extracted())}\n"
+            f"Verifying: {len(self.get_verifying())}\n"
+            f"Verified: {len(self.get_verified())}\n"
             f"Total: {len(self)}\n"
         )
 
@@ -33,7 +36,8 @@ class ProductDownloadList(list):
 
         Returns
         -------
-        ProductDownload object with matching future object
+        ProductDownload object with matching future object, only active
+        downloads hold their future
         """
         for download in self:
             if download.future == future:
@@ -42,7 +46,12 @@ class ProductDownloadList(list):
     def wait_for_completed(self):
         """Wait until first download completes
         """
-        wait(self.get_active_futures(), return_when="FIRST_COMPLETED")
+        futures = self.get_active_futures()
+        if futures:
+            wait(futures, return_when="FIRST_COMPLETED")
+        else:
+            # only attached transfers active, they finish via their callback
+            sleep(1)
 
     def get(self, state):
         """Return all elements with matching state
@@ -65,8 +74,12 @@ class ProductDownloadList(list):
 
     def get_active_futures(self):
         """Return future object to all currently active downloads
+
+        Downloads attached to a transfer of another query have none, the
+        future of finished downloads is released by their done callback.
         """
-        return [active.future for active in self.get_active()]
+        futures = (active.future for active in self.get_active())
+        return [future for future in futures if future is not None]
 
     def get_downloaded(self):
         """Return all elements that have been downloaded but not yet extracted
@@ -83,6 +96,16 @@ class ProductDownloadList(list):
         """
         return self.get(DownloadState.EXTRACT_DONE)
 
+    def get_verifying(self):
+        """Return all elements that are currently being verified
+        """
+        return self.get(DownloadState.VERIFY_ACTIVE)
+
+    def get_verified(self):
+        """Return all elements that passed verification
+        """
+        return self.get(DownloadState.VERIFIED)
+
     def get_failed(self):
         """Return all elements that have failed
         """
@@ -98,6 +121,11 @@ class ProductDownloadList(list):
             + len(self.get_failed())
         ) == len(self)
 
+    def all_verified(self):
+        """Return true if all scheduled downloads have been verified or failed
+        """
+        return len(self.get_verified()) + len(self.get_failed()) == len(self)
+
     def size(self):
         """Return sum of downloads in MB
         """
@@ -0,0 +1,146 @@
+"""Decode Sentinel-1/2/3 product names into typed fields
+
+Product titles already encode sensing time, orbit, MGRS tile and
+processing baseline, so these do not have to be fetched via OData.
+"""
+import re
+import datetime
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
+
+ProductName = namedtuple(
+    "ProductName",
+    [
+        "mission",  # e.g. "S2A"
+        "product_type",  # e.g. "MSIL1C", "IW_SLC__1SDV", "SR_1_SRA___"
+        "sensing_start",  # datetime.datetime
+        "sensing_stop",  # datetime.datetime or None
+        "relative_orbit",  # int or None
+        "absolute_orbit",  # int or None
+        "tile",  # MGRS tile id or None
+        "baseline",  # processing baseline as int, e.g. 204, or None
+    ],
+)
+
+_S1 = re.compile(
+    r"^(S1[AB])_((?:IW|EW|WV|S[1-6])_(?:SLC|GRD|RAW|OCN)[FHM_]_[0-2][SA][A-Z]{2})_"
+    r"(\d{8}T\d{6})_(\d{8}T\d{6})_(\d{6})_[0-9A-F]{6}_[0-9A-F]{4}"
+)
+_S2 = re.compile(
+    r"^(S2[AB])_(MSIL1C|MSIL2A)_(\d{8}T\d{6})_N(\d{4})_R(\d{3})_T(\d{2}[A-Z]{3})_\d{8}T\d{6}"
+)
+_S3 = re.compile(
+    r"^(S3[AB])_([A-Z]{2}_[0-2_]_[A-Z0-9_]{6})_(\d{8}T\d{6})_(\d{8}T\d{6})_\d{8}T\d{6}_"
+    r"(.{4})_(.{3})_(.{3})_.{4}_[A-Z0-9_]{3}_[A-Z0-9_]{8}"
+)
+# MGRS tile in older Sentinel-2 names and granule names
+_TILE = re.compile(r"_T([0-9]{1,2}[A-Z]{3})_")
+_SUFFIX = re.compile(r"\.(SAFE|SEN3|zip)$")
+
+# Sentinel-1 absolute orbit of relative orbit 1 per platform
+_S1_ORBIT_OFFSET = {"S1A": 73, "S1B": 27}
+
+
+def _timestamp(value):
+    """Parse "YYYYMMDDThhmmss"
+    """
+    return datetime.datetime(
+        int(value[0:4]),
+        int(value[4:6]),
+        int(value[6:8]),
+        int(value[9:11]),
+        int(value[11:13]),
+        int(value[13:15]),
+    )
+
+
+def _int(value):
+    return int(value) if value.isdigit() else None
+
+
+@lru_cache(maxsize=1 << 16)
+def decode(name):
+    """Decode a product title or file name
+
+    Parameters
+    ----------
+    name : str
+        Product title, optionally with .SAFE, .SEN3 or .zip suffix
+
+    Returns
+    -------
+    ProductName or None
+        None if name is not a known Sentinel product name
+    """
+    name = _SUFFIX.sub("", name)
+    match = _S2.match(name)
+    if match:
+        mission, ptype, start, baseline, orbit, tile = match.groups()
+        return ProductName(
+            mission, ptype, _timestamp(start), None, int(orbit), None, tile, int(baseline)
+        )
+    match = _S1.match(name)
+    if match:
+        mission, ptype, start, stop, absolute = match.groups()
+        absolute = int(absolute)
+        relative = (absolute - _S1_ORBIT_OFFSET[mission]) % 175 + 1
+        return ProductName(
+            mission, ptype, _timestamp(start), _timestamp(stop), relative, absolute, None, None
+        )
+    match = _S3.match(name)
+    if match:
+        mission, ptype, start, stop, _, _, orbit = match.groups()
+        return ProductName(
+            mission, ptype, _timestamp(start), _timestamp(stop), _int(orbit), None, None, None
+        )
+    return None
+
+
+def extension(name):
+    """Return the file extension of a product's folder, ".SEN3" for
+    Sentinel-3 and ".SAFE" for other missions
+    """
+    decoded = decode(name)
+    mission = decoded.mission if decoded else name[:3]
+    return ".SEN3" if mission.startswith("S3") else ".SAFE"
+
+
+@lru_cache(maxsize=1 << 16)
+def get_tile(name):
+    """Return MGRS tile id of a Sentinel-2 product or granule name or None
+    """
+    decoded = decode(name)
+    if decoded and decoded.tile:
+        return decoded.tile
+    match = _TILE.search(name)
+    return match.group(1) if match else None
+
+
+def dedupe(meta):
+    """Drop reprocessed duplicates of a product
+
+    Products with equal mission, product type, sensing start and tile are
+    acquisitions of the same scene, only the one with the latest
+    processing baseline is kept.
+
+    Parameters
+    ----------
+    meta : dict
+        Mapping of UUID to product dict with "title"
+
+    Returns
+    -------
+    OrderedDict
+        meta without duplicates, in original order
+    """
+    latest = {}
+    for uuid in meta:
+        decoded = decode(meta[uuid].get("title", ""))
+        if decoded is None:
+            latest[uuid] = (uuid, None)
+            continue
+        key = (decoded.mission, decoded.product_type, decoded.sensing_start, decoded.tile)
+        if key not in latest or (decoded.baseline or 0) > (latest[key][1] or 0):
+            latest[key] = (uuid, decoded.baseline)
+    keep = {uuid for uuid, _ in latest.values()}
+    return OrderedDict((uuid, meta[uuid]) for uuid in meta if uuid in keep)
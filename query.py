@@ -1,7 +1,11 @@
 from os import path
 import os
+import shutil
+from functools import partial
 from collections import OrderedDict
-from time import perf_counter, sleep
+from time import perf_counter, sleep, time
+import threading
+import queue
 from concurrent.futures import (
     ThreadPoolExecutor,
     as_completed,
@@ -12,35 +16,112 @@ from sentinelsat import InvalidChecksumError, SentinelAPIError, read_geojson, ge
 from requests.exceptions import RequestException
 from product_download import ProductDownload
 from download_state import DownloadState
-from utils import get_year_season_selection, unzip, get_keys, is_utm, order_by_utm, load_csv, load_json, load_yaml
+from mgrs_index import tiles_for_footprint
+from metadata_table import MetadataTable
+from selection import Selector, SeasonPolicy, get_policy
+from product_name import dedupe
+from zip_index import build_index, index_path
+from verify import verify_product
+from plan import make_plan, format_plan
+from work_queue import open_queue, Coordinator, Worker
+from utils import get_year_season_selection_all, unzip, get_keys, is_utm, order_by_utm, load_csv, iter_json_items, iter_json_lines, load_yaml, \
+    split_date_range, merge_mirrors
+
+# Number of results DHuS returns per OpenSearch page
+PAGE_SIZE = 100
+# Times a date subrange of a split query is split again
+MAX_SPLIT_DEPTH = 3
 
 
 class Query(object):
 
     def down_a_level(self, meta):
-        short_meta = OrderedDict()
-        for idx, tile in enumerate(meta, start=1):
-            for id2, mirror_url in enumerate(meta[tile], start=1):
-                if(mirror_url):
-                    short_meta[tile] = meta[tile][mirror_url]
-                    # print('putting: ', tile, " : ", meta[tile][mirror_url])
-                # short_meta.update({tile, meta[tile][mirror_url]})
+        """Merge the mirror level of a search result, see _merge_tile
+
+        Parameters
+        ----------
+        meta : dict
+            Mapping of MGRS tile to mirror name to query response dict
 
+        Returns
+        -------
+        OrderedDict
+            Mapping of MGRS tile to UUID to product dict, every product
+            lists the mirrors holding it under "mirrors"
+        """
+        short_meta = OrderedDict()
+        for tile in meta:
+            short_meta[tile] = self._merge_tile(meta[tile])
         return short_meta
 
+    def _merge_tile(self, tile_meta):
+        """Merge the mirror level of a tile, drop duplicates with "dedupe"
+        """
+        products = merge_mirrors(tile_meta)
+        if self.config.get("dedupe"):
+            # drop reprocessed duplicates, decoded from product titles
+            products = dedupe(products)
+        return products
+
+    def find_mirror(self, uuid):
+        """Return the mirror holding a product with the least load
+
+        Load is the number of active downloads per MB/s the mirror is
+        expected to deliver according to its health history, so faster
+        mirrors get more concurrent downloads. Returns None if no
+        connected mirror holds the product
+        """
+        candidates = [
+            mirror
+            for mirror in self._mirror_map.get(uuid, self.apis)
+            if mirror in self.apis
+        ]
+        if not candidates:
+            return None
+        scores = {m: max(self.manager.mirror_score(m), 1e-3) for m in candidates}
+        with self.manager._connections_lock:
+            return min(candidates, key=lambda m: (self.manager._connections[m] + 1) / scores[m])
+
 
     def select(self, meta):
+        """Select products per MGRS tile according to the selection policy
+
+        The default season policy runs the columnar selection, other
+        policies go through self.selector
 
-        selection = {}
+        Parameters
+        ----------
+        meta : MetadataTable or dict
+            Metadata table or mapping of MGRS tile to query response dict
+
+        Returns
+        -------
+        dict
+            Nested dict with tile, year and season as keys
+        """
         tic = perf_counter()
         self.logger.info("Starting product selection")
-        tic = perf_counter()
-        for idx, tile in enumerate(meta, start=1):
+        if isinstance(meta, MetadataTable):
+            tiles = meta.tiles()
+            cloud = lambda tile, uuid: meta.record(uuid)["cloudcoverpercentage"]
+        else:
+            tiles = list(meta)
+            cloud = lambda tile, uuid: meta[tile][uuid]["cloudcoverpercentage"]
+        with self.tracer.span("select", "select", tiles=len(tiles)):
+            if type(self.selector.policy) is SeasonPolicy:
+                if isinstance(meta, MetadataTable):
+                    selection = meta.select()
+                else:
+                    selection = get_year_season_selection_all(meta)
+            elif isinstance(meta, MetadataTable):
+                selection = self.selector.select_all(meta.to_dict())
+            else:
+                selection = self.selector.select_all(meta)
+        for tile in tiles:
             self.logger.info("\nMGRS %s:", tile)
-            if not meta[tile]:
+            if tile not in selection:
                 self.logger.info("Nothing to select")
                 continue
-            selection[tile] = get_year_season_selection(meta[tile])
             for year in selection[tile]:
                 self.logger.info("")
                 self.logger.info("    YEAR: %d", year)
@@ -49,31 +130,45 @@ class Query(object):
                     if not selection[tile][year][season]:
                         self.logger.info("    %s: NONE", season.upper())
                         continue
-                    uuid = selection[tile][year][season]
-                    cloud = meta[tile][uuid]["cloudcoverpercentage"]
-                    self.logger.info("    %s: %s (%f%%)", season.upper(), uuid, cloud)
+                    choice = selection[tile][year][season]
+                    for uuid in choice if isinstance(choice, list) else [choice]:
+                        self.logger.info(
+                            "    %s: %s (%f%%)", season.upper(), uuid, cloud(tile, uuid)
+                        )
         elapsed = perf_counter() - tic
         self.logger.info("\nProduct selection completed in %f sec", elapsed)
         return selection
 
-    def unzip_callback(self, future):
+    def unzip_callback(self, download, future):
         """Unzip a downloaded product
 
-        Attach this via add_done_callback to a Future object
+        Attach this via add_done_callback to a Future object, with the
+        download bound by functools.partial
 
         Parameters
         ----------
+        download : ProductDownload
+            Download the future belongs to
         future : concurrent.futures.Future object
             Object that the callback was attached to
             Future status is either Done or Canceled
         """
-        download = self._download_list.find(future)
-        # TODO What will we do with the connections var
-        # self.connections -= 1
+        with self.manager._connections_lock:
+            self.manager._connections[download.mirror] -= 1
+        self.manager.download_slots.release()
+        if not future.exception():
+            # charge the fallback mirror that served the product, if any
+            download.mirror = future.result().get("mirror", download.mirror)
+        result = "failed" if future.exception() else "ok"
+        self.metrics.downloads.inc(mirror=download.mirror, result=result)
+        self.metrics.download_seconds.observe(
+            download._stop_time - download._start_time, mirror=download.mirror
+        )
+        url = self.config["mirrors"][download.mirror]["url"]
         try:
             response = future.result()
         except Exception as err:
-            self.state = DownloadState.FAILED
+            self.manager.health.record(url, available=False)
             self.logger.info(
                 "[%d/%d] UUID %s | Download failed",
                 download.index[0],
@@ -81,7 +176,11 @@ class Query(object):
                 download.uuid,
             )
             self.logger.error(str(err))
+            self._end_transfer(download)
             return
+        if response.get("downloaded_bytes"):
+            # files already on disk say nothing about the mirror
+            self.manager.health.record(url, throughput=download.speed)
         self.logger.info(
             "[%d/%d] UUID %s | Download complete (%s) @ %.2f MB/s",
             download.index[0],
@@ -92,17 +191,151 @@ class Query(object):
         )
         # print('response')
         # print(response)
-        img_dir = os.path.split(response["path"])[0]
-        _future = self._proc_executor.submit(unzip, response["path"], img_dir)
         download.state = DownloadState.EXTRACT_ACTIVE
-        fname = response["title"] + ".SAFE"
-        # download.safe_path = os.path.join(img_dir, fname)
-        _future.add_done_callback(download._unzip_callback)
-        self._proc_futures[future] = fname
+        if self.keep_zip:
+            # index members for in-place reads instead of extracting
+            _future = self._extractor.submit(
+                build_index, response["path"], tags={"uuid": download.uuid, "tile": download.utm}
+            )
+            _future.add_done_callback(download._index_callback)
+        else:
+            img_dir = os.path.split(response["path"])[0]
+            _future = self._extractor.submit(
+                unzip, response["path"], img_dir, tags={"uuid": download.uuid, "tile": download.utm}
+            )
+            _future.add_done_callback(download._unzip_callback)
+        _future.add_done_callback(partial(self._end_transfer, download))
+        if self.verify:
+            _future.add_done_callback(partial(self._verify, download))
+
+    def _end_transfer(self, download, future=None):
+        """Hand a product to queries waiting for it, once it is finished
+        or failed for this query
+        """
+        done = DownloadState.VERIFIED if self.verify else DownloadState.EXTRACT_DONE
+        if download.state in (done, DownloadState.FAILED):
+            self.manager.transfers.resolve(download.uuid, download)
+            self._forget(download.uuid)
+
+    def _forget(self, uuid):
+        """Drop the per-product state of a finished product
+        """
+        with self._lock:
+            self._mirror_map.pop(uuid, None)
+            self._verify_failures.pop(uuid, None)
+
+    def _attach(self, download, transfer):
+        """Wait for the transfer of another query instead of downloading
+        """
+        download.state = DownloadState.DL_ACTIVE
+        self.logger.info(
+            "[%d/%d] UUID %s | Attached to transfer of another order",
+            download.index[0],
+            download.index[1],
+            download.uuid,
+        )
+        transfer.add_done_callback(partial(self._attach_callback, download))
+
+    def _attach_callback(self, download, transfer):
+        """Take over paths and state of the transfer's download
+
+        Products keep the form of the owning query, e.g. extracted SAFE
+        folders for queries with "keep_zip". Products not verified by the
+        owner are verified if this query verifies.
+        """
+        owner = transfer.result()
+        if owner.state == DownloadState.FAILED:
+            # the owner gave up, download it again in this query
+            download.state = DownloadState.SCHEDULED
+            return
+        download.mirror = owner.mirror
+        download.size = owner.size
+        download.speed = owner.speed
+        download.zip_path = owner.zip_path
+        download.safe_path = owner.safe_path
+        download.index_path = owner.index_path
+        if self.verify and owner.state != DownloadState.VERIFIED:
+            download.state = DownloadState.EXTRACT_DONE
+            self._verify(download, transfer)
+            return
+        if self.verify:
+            download.state = DownloadState.VERIFIED
+        else:
+            download.state = DownloadState.EXTRACT_DONE
+        self._forget(download.uuid)
+
+    def _verify(self, download, future):
+        """Submit checksum verification of an extracted or indexed product
+
+        Runs in the extraction pool while other downloads continue
+        """
+        if download.state != DownloadState.EXTRACT_DONE:
+            return
+        download.state = DownloadState.VERIFY_ACTIVE
+        _future = self._extractor.submit(
+            verify_product,
+            download.safe_path or download.zip_path,
+            tags={"uuid": download.uuid, "tile": download.utm},
+        )
+        _future.add_done_callback(partial(self._verify_callback, download))
+
+    def _verify_callback(self, download, future):
+        """Mark a product as verified or schedule it for download again
+
+        Files of a product failing verification are removed. Products
+        failing more than "verify_retries" times are marked as failed.
+        """
+        try:
+            _, bad = future.result()
+        except Exception as err:
+            # e.g. missing or malformed manifest.safe
+            bad = [str(err)]
+        if not bad:
+            download.state = DownloadState.VERIFIED
+            self.logger.info(
+                "[%d/%d] UUID %s | Verified",
+                download.index[0],
+                download.index[1],
+                download.uuid,
+            )
+            self._end_transfer(download)
+            return
+        self.logger.info(
+            "[%d/%d] UUID %s | Verification failed: %s",
+            download.index[0],
+            download.index[1],
+            download.uuid,
+            ", ".join(bad[:5]) + (" ..." if len(bad) > 5 else ""),
+        )
+        if download.safe_path:
+            shutil.rmtree(download.safe_path, ignore_errors=True)
+        if download.zip_path and os.path.exists(download.zip_path):
+            os.remove(download.zip_path)
+        with self._lock:
+            failures = self._verify_failures.get(download.uuid, 0) + 1
+            self._verify_failures[download.uuid] = failures
+        if failures > self.verify_retries:
+            download.state = DownloadState.FAILED
+            self._end_transfer(download)
+            return
+        self.tracer.instant("requeue", "verify", uuid=download.uuid, tile=download.utm)
+        download.safe_path = None
+        download.index_path = None
+        download.state = DownloadState.SCHEDULED
+
+    def _all_done(self):
+        """Return True once no download, extraction or verification is left
+        """
+        if self.verify:
+            return self._download_list.all_verified()
+        return self._download_list.all_downloaded()
 
     def _download_thread(self, mirror, uuid, utm):
         """Download a Copernicus product
 
+        Falls back to the other mirrors holding the product once all
+        retries on the chosen mirror failed.
+
         Parameters
         ----------
         mirror : str
@@ -113,42 +346,68 @@ class Query(object):
             MGRS tile id
             'None' if platformname not Sentinel-2
         """
-        retry = self.retry
+        img_dir, mirrors = self._download_target(mirror, uuid, utm)
+        with self.tracer.span("download", "download", uuid=uuid, tile=utm, mirror=mirror):
+            return self._download_attempts(uuid, img_dir, mirrors)
+
+    def _download_target(self, mirror, uuid, utm):
+        """Create the directory of a product, return it and the mirrors to
+        try in order
+        """
         if utm:
             img_dir = os.path.join(self.img_dir, utm)
         else:
             img_dir = self.img_dir
         if not os.path.exists(img_dir):
-            os.mkdir(img_dir)
-        api = self.api
-        try:
-            return api.download(uuid, img_dir)
-        except (RequestException, SentinelAPIError, InvalidChecksumError) as err:
-            self.logger.info("UUID %s | Raised '%s'", uuid, err.__class__.__name__)
-            for trial in range(retry):
+            os.makedirs(img_dir, exist_ok=True)
+        fallback = [
+            name
+            for name in self._mirror_map.get(uuid, self.apis)
+            if name in self.apis and name != mirror
+        ]
+        return img_dir, [mirror] + fallback
+
+    def _download_attempts(self, uuid, img_dir, mirrors):
+        """Try to download a product from mirrors in order, retrying each
+
+        Returns the download info of sentinelsat with the name of the
+        mirror that served it under "mirror", as download_shards does.
+        Raises the last error once all attempts failed
+        """
+        retry = self.retry
+        last_error = None
+        for name in mirrors:
+            api = self.apis[name]
+            for trial in range(retry + 1):
                 try:
-                    self.logger.info(
-                        "UUID %s | Trying again '%s' [%d/%d] ...",
-                        uuid,
-                        mirror,
-                        trial + 1,
-                        retry,
-                    )
-                    return api.download(uuid, img_dir)
+                    if trial:
+                        self.logger.info(
+                            "UUID %s | Trying again '%s' [%d/%d] ...",
+                            uuid,
+                            name,
+                            trial,
+                            retry,
+                        )
+                    with self.tracer.span("attempt", "download", uuid=uuid, mirror=name, trial=trial):
+                        result = api.download(uuid, img_dir)
+                    result["mirror"] = name
+                    return result
                 except (
                         RequestException,
                         SentinelAPIError,
                         InvalidChecksumError,
                 ) as err:
+                    last_error = err
                     self.logger.info(
                         "UUID %s | Raised '%s'", uuid, err.__class__.__name__
                     )
-                    sleep(10)
-                    continue
-            self.logger.error("UUID %s | Unable to download from '%s'", uuid, mirror)
-            return None
+                    if trial < retry:
+                        self.metrics.retries.inc(mirror=name)
+                        sleep(self.retry_delay)
+            self.logger.error("UUID %s | Unable to download from '%s'", uuid, name)
+        raise last_error
 
-    def get(self, meta):
+    def get(self, meta, filenames=None):
         """Download and unzip raw data
 
         Maximize download speed by:
@@ -158,7 +417,11 @@ class Query(object):
               been ranked before)
 
         Files are automatically unziped once a download completes. Unzip jobs
-        are run in parallel via concurrent.futures.ProcessPoolExecutor.
+        are run in parallel by the manager's ExtractionStage. New downloads
+        are paused while its queue is full. With the "keep_zip" option zip
+        files are indexed instead, see zip_index.ZipReader. With the "verify"
+        option products are checked against their manifest.safe in the same
+        pool, failed products are downloaded again.
 
         For Sentinel-2, data is organized as follows:
 
@@ -174,14 +437,27 @@ class Query(object):
 
         Parameters
         ----------
-        meta : dict
+        meta : dict or MetadataTable
             Sentinel-2: Mapping of MGRS tile to query response dict
             Sentinel-1/3: Mapping of UUID to query response dict
+            Metadata table: every product in the table is downloaded
+        filenames : dict, optional
+            Mapping of UUID to product filename, e.g. "<title>.SAFE".
+            Products found on disk are not downloaded again, extracted
+            SAFE folders (zip indexes with "keep_zip") are assumed to be
+            complete. Taken from the table if meta is a MetadataTable
         """
         tic = perf_counter()
+        started = time()
         self.logger.info("Starting product download")
 
-        if self.manager.config["platformname"] == "Sentinel-2":
+        if isinstance(meta, MetadataTable):
+            keys = meta.keys()
+            filenames = filenames or meta.filenames()
+            uuids = [uuid for utm, uuid in keys]
+            utm_map = {uuid: utm for utm, uuid in keys}
+            retry_map = {uuid: 0 for _, uuid in keys}
+        elif self.config["platformname"] == "Sentinel-2":
             keys = get_keys(meta)
             uuids = [uuid for utm, uuid in keys]
             utm_map = {uuid: utm for utm, uuid in keys}
@@ -191,16 +467,23 @@ class Query(object):
             retry_map = {uuid: 0 for uuid in uuids}
         num_products = len(uuids)
         info = OrderedDict()
+        # mirrors of searched products that were not selected
+        with self._lock:
+            self._mirror_map = {
+                uuid: self._mirror_map[uuid] for uuid in uuids if uuid in self._mirror_map
+            }
 
         # schedule all products
         download_list = self._download_list
         download_list.clear()
         for idx, uuid in enumerate(uuids, start=1):
-            if self.manager.config["platformname"] == "Sentinel-2":
+            if isinstance(meta, MetadataTable) or self.config["platformname"] == "Sentinel-2":
                 utm = utm_map[uuid]
                 download_list.append(ProductDownload(uuid, (idx, num_products), utm))
             else:
                 download_list.append(ProductDownload(uuid, (idx, num_products)))
+            if filenames and uuid in filenames:
+                self._skip_present(download_list[-1], filenames[uuid])
 
         # for elem in download_list:
         #     print("START ELEM")
@@ -208,97 +491,302 @@ class Query(object):
         #     print("END ELEM")
         # sys.exit()
 
-        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
-            while not download_list.all_downloaded():
-                for download in download_list.get_scheduled():
-                    if not download.state == DownloadState.SCHEDULED:
-                        continue
+        if self.config.get("work_queue"):
+            self._get_distributed(filenames)
+        else:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                while not self._all_done():
+                    for download in download_list.get_scheduled():
+                        self._schedule(download, executor)
+                        if len(self._download_list.get_active()) >= self.parallel:
+                            self._download_list.wait_for_completed()
+                    sleep(2)
+                self._wait_for_extraction()
 
-                    # TODO Used to be the one with more connections available
-                    download.mirror = 'NOT USE THIS'
-                    # download.mirror = self.find_mirror(download.uuid)
-                    # download.mirror = self.api
-                    # if download.mirror == "NONE":
-                    #     if retry_map[download.uuid] >= self.retry:
-                    #         download.state = DownloadState.FAILED
-                    #         self.logger.info(
-                    #             "[%d/%d] UUID %s | Download failed, retry limit exceeded",
-                    #             download.index[0],
-                    #             num_products,
-                    #             download.uuid,
-                    #         )
-                    #     else:
-                    #         retry_map[download.uuid] += 1
-                    #     continue
-                    # if download.mirror == "BUSY":
-                    #     # wait indefinately
-                    #     continue
-                    future = executor.submit(
-                        self._download_thread,
-                        download.mirror,
-                        download.uuid,
-                        download.utm,
-                    )
-                    # self.connections += 1
-                    download.register(future)
-                    future.add_done_callback(self.unzip_callback)
-                    self.logger.info(
-                        "[%d/%d] UUID %s | Download starting (%s)",
-                        download.index[0],
-                        num_products,
-                        download.uuid,
-                        download.mirror,
+        self.tracer.complete("get", "download", started, time(), products=num_products)
+        self._finish_downloads(tic)
+
+    def _get_distributed(self, filenames=None):
+        """Download scheduled products by the workers of a work queue
+
+        Puts one item per product into the queue of the "work_queue"
+        option and waits for workers (see work_queue.Worker) to download
+        and extract them. Paths reported by the workers are taken over.
+        With the "memory" queue nobody else can reach the items, a worker
+        of this process downloads them.
+        """
+        work = open_queue(self.config["work_queue"])
+        coordinator = Coordinator(work)
+        local = None
+        scheduled = self._download_list.get_scheduled()
+        options = {"keep_zip": self.keep_zip, "verify": self.verify}
+        coordinator.submit(
+            [
+                {
+                    "uuid": download.uuid,
+                    "utm": download.utm,
+                    "index": download.index,
+                    "mirrors": self._mirror_map.get(download.uuid),
+                    "filename": (filenames or {}).get(download.uuid),
+                    "options": options,
+                }
+                for download in scheduled
+            ]
+        )
+        for download in scheduled:
+            download.state = DownloadState.DL_ACTIVE
+        self.logger.info(
+            "Queued %d products as job %s, waiting for workers", len(scheduled), coordinator.job
+        )
+        if work.local:
+            local = Worker(work, self.manager, name="local", parallel=self.parallel)
+            threading.Thread(target=local.run, name="local-worker", daemon=True).start()
+        try:
+            with self.tracer.span("work queue", "download", job=coordinator.job, products=len(scheduled)):
+                items = {
+                    item["uuid"]: item
+                    for item in coordinator.wait(
+                        interval=5.0 if local is None else 1.0,
+                        max_idle=self.config.get("work_queue_idle"),
                     )
-                    if len(self._download_list.get_active()) >= self.parallel:
-                        self._download_list.wait_for_completed()
-                sleep(2)
-            self.logger.info("")
-            for future in as_completed(self._proc_futures):
-                fname = self._proc_futures[future]
-                try:
-                    self.logger.info("PRODUCT %s [x]", fname)
-                except FileExistsError as err:
-                    self.logger.info("PRODUCT %s [o]", fname)
-            self._proc_futures.clear()
+                }
+        finally:
+            if local is not None:
+                local.stop()
+        for download in scheduled:
+            item = items.get(download.uuid)
+            if item is None or item["state"] != "done":
+                download.state = DownloadState.FAILED
+                self.logger.info(
+                    "[%d/%d] UUID %s | Failed: %s",
+                    download.index[0],
+                    download.index[1],
+                    download.uuid,
+                    item["error"] if item else "not in queue",
+                )
+                continue
+            result = item["result"]
+            download.mirror = result["mirror"]
+            download.size = result["size"]
+            download.zip_path = result["zip_path"]
+            download.safe_path = result["safe_path"]
+            download.index_path = result["index_path"]
+            download.state = DownloadState.VERIFIED if self.verify else DownloadState.EXTRACT_DONE
+            self.logger.info(
+                "PRODUCT %s [x] (%s)", download.safe_path or download.zip_path, result["node"]
+            )
 
+    def _skip_present(self, download, filename):
+        """Mark a download as done if the product is already on disk
+
+        Products present are not verified again.
+        """
+        img_dir = os.path.join(self.img_dir, download.utm) if download.utm else self.img_dir
+        zip_path = os.path.join(img_dir, os.path.splitext(filename)[0] + ".zip")
+        safe_path = os.path.join(img_dir, filename)
+        if self.keep_zip:
+            if not os.path.exists(index_path(zip_path)):
+                return False
+            download.index_path = index_path(zip_path)
+        elif os.path.isdir(safe_path):
+            download.safe_path = safe_path
+        else:
+            return False
+        download.zip_path = zip_path
+        download.state = DownloadState.VERIFIED if self.verify else DownloadState.EXTRACT_DONE
+        self._forget(download.uuid)
+        self.logger.info(
+            "[%d/%d] UUID %s | Already present",
+            download.index[0],
+            download.index[1],
+            download.uuid,
+        )
+        return True
+
+    def _schedule(self, download, executor):
+        """Submit a scheduled download to executor
+
+        Marks the download as failed if no mirror holds the product
+        """
+        if not download.state == DownloadState.SCHEDULED:
+            return
+        transfer, owner = self.manager.transfers.claim(download.uuid, download)
+        if not owner:
+            self._attach(download, transfer)
+            return
+        if self._extractor.saturated():
+            self.logger.info(
+                "Extraction queue full (%d products), pausing downloads",
+                self._extractor.pending(),
+            )
+            with self.tracer.span("wait for extraction", "download"):
+                self._extractor.wait_for_capacity()
+
+        # shared with the other queries of the manager
+        self.manager.download_slots.acquire()
+        download.mirror = self.find_mirror(download.uuid)
+        if download.mirror is None:
+            self.manager.download_slots.release()
+            download.state = DownloadState.FAILED
+            self.logger.info(
+                "[%d/%d] UUID %s | No mirror holds this product",
+                download.index[0],
+                download.index[1],
+                download.uuid,
+            )
+            self._end_transfer(download)
+            return
+        with self.manager._connections_lock:
+            self.manager._connections[download.mirror] += 1
+        downloader = self.manager.downloader
+        if downloader is None:
+            future = executor.submit(
+                self._download_thread,
+                download.mirror,
+                download.uuid,
+                download.utm,
+            )
+        else:
+            img_dir, mirrors = self._download_target(download.mirror, download.uuid, download.utm)
+            future = downloader.submit(
+                download.uuid, img_dir, mirrors, retry=self.retry, retry_delay=self.retry_delay
+            )
+        download.register(future)
+        future.add_done_callback(partial(self.unzip_callback, download))
+        self.logger.info(
+            "[%d/%d] UUID %s | Download starting (%s)",
+            download.index[0],
+            download.index[1],
+            download.uuid,
+            download.mirror,
+        )
+
+    def _wait_for_extraction(self):
+        self.logger.info("")
+        self._extractor.wait()
+        ready = self._download_list.get_extracted() + self._download_list.get_verified()
+        for download in ready:
+            self.logger.info("PRODUCT %s [x]", download.safe_path or download.zip_path)
+        metrics = self._extractor.metrics()
+        self.logger.info(
+            "Extraction: %d done, %d failed, max queue depth %d, "
+            "mean wait %.2f sec, mean extraction %.2f sec, max latency %.2f sec",
+            metrics["completed"],
+            metrics["failed"],
+            metrics["max_depth"],
+            metrics["mean_wait"],
+            metrics["mean_extract"],
+            metrics["max_latency"],
+        )
+
+    def _finish_downloads(self, tic):
+        """Log download summary, clear download list and shut down pools
+
+        Pools are kept running with the "keep_pools" option, e.g. for the
+        next order of a daemon.
+        """
+        download_list = self._download_list
         elapsed = perf_counter() - tic
         self.logger.info("\nProduct download completed in %f sec", elapsed)
         self.logger.info("Total size: %s MB", download_list.size())
         num_failed = len(download_list.get_failed())
         if num_failed > 0:
-            self.logger.info("Failed: %d / %d", num_failed, num_products)
+            self.logger.info("Failed: %d / %d", num_failed, len(download_list))
+        self.summary = {
+            "products": len(download_list),
+            "failed": num_failed,
+            "size": download_list.size(),  # MB
+            "seconds": elapsed,
+        }
         self._download_list.clear()
-        self.logger.info("Shutting down processor pool. This might take some time..")
-        self._proc_executor.shutdown()
+        with self._lock:
+            # e.g. products searched by the pipeline but never selected
+            self._mirror_map = {}
+            self._verify_failures = {}
+        self.close()
+        if not self.config.get("keep_pools"):
+            self.logger.info("Shutting down processor pool. This might take some time..")
+            self._extractor.shutdown()
+            if self.manager.downloader is not None:
+                self.manager.downloader.shutdown()
+                self.manager._downloader = None
+        self.manager.health.save()
+        if self.config.get("trace"):
+            self.tracer.save(self.config["trace"])
+            self.logger.info("Trace written to %s", self.config["trace"])
 
-    def _query_thread(self, **kwargs):
-        api = self.api
-        retry = 2
+    def _query_thread(self, mirror, **kwargs):
+        api = self.apis[mirror]
+        tags = {key: str(value) for key, value in kwargs.items()}
 
         try:
-            sentinel_response = api.query(**kwargs)
+            with self.tracer.span("query", "search", mirror=mirror, **tags) as span:
+                sentinel_response = api.query(**kwargs)
+                span.tag(products=len(sentinel_response))
             return sentinel_response
         except (RequestException, SentinelAPIError) as err:
             self.logger.info(
-                "Request to mirror '%s' raised '%s'", 'Greece API', err.__class__.__name__
+                "Request to mirror '%s' raised '%s'", mirror, err.__class__.__name__
             )
-            # for trial in range(retry):
-            #     try:
-            #         self.logger.info(
-            #             "Trying again '%s' [%d/%d] ...", 'Greece API', trial + 1, retry
-            #         )
-            #         return api.query(**kwargs)
-            #     except (RequestException, SentinelAPIError) as err:
-            #         self.logger.info(
-            #             "Request to mirror '%s' raised '%s'",
-            #             'Greece API',
-            #             err.__class__.__name__,
-            #         )
-            #         sleep(1)
-            #         continue
-            # self.logger.error("Unable to query mirror '%s'", 'Greece API')
             return None
 
+    def _count_thread(self, mirror, **kwargs):
+        """Return number of products matching a query or None on failure
+        """
+        try:
+            with self.tracer.span("count", "search", mirror=mirror):
+                return self.apis[mirror].count(**kwargs)
+        except (RequestException, SentinelAPIError) as err:
+            self.logger.info(
+                "Count request to mirror '%s' raised '%s'",
+                mirror,
+                err.__class__.__name__,
+            )
+            return None
+
+    def _plan_query(self, mirror, depth=0, count=None, **kwargs):
+        """Split a query into date subqueries of at most self.query_pages pages
+
+        Calls count first. Products are rarely spread evenly over time, so
+        subranges are counted as well and split again while they have more
+        pages, up to MAX_SPLIT_DEPTH times. Queries with a small result set
+        or a date range that can not be split are returned unchanged.
+
+        Returns
+        -------
+        list
+            List of query keyword dicts
+        """
+        if not self.query_pages or "date" not in kwargs:
+            return [kwargs]
+        if count is None:
+            count = self._count_thread(mirror, **kwargs)
+        page_size = getattr(self.apis[mirror], "page_size", PAGE_SIZE)
+        if not count or count <= self.query_pages * page_size or depth > MAX_SPLIT_DEPTH:
+            return [kwargs]
+        pages = -(-count // page_size)
+        parts = -(-pages // self.query_pages)
+        ranges = split_date_range(*kwargs["date"], parts)
+        if not ranges:
+            return [kwargs]
+        self.logger.debug(
+            "Splitting query for %d products on '%s' into %d subqueries",
+            count,
+            mirror,
+            len(ranges),
+        )
+        subqueries = [{**kwargs, "date": date} for date in ranges]
+        if depth == MAX_SPLIT_DEPTH:
+            return subqueries
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            counts = list(
+                executor.map(lambda args: self._count_thread(mirror, **args), subqueries)
+            )
+        planned = []
+        for args, num in zip(subqueries, counts):
+            planned.extend(self._plan_query(mirror, depth=depth + 1, count=num, **args))
+        return planned
+
     # Wrap SentinelAPI query method
     def query(self, ignore_conf=False, **kwargs):
 
@@ -308,32 +796,81 @@ class Query(object):
             conf_args = kwargs
         else:
             conf_args = {
-                "date": (self.manager.config["date"]["from"], self.manager.config["date"]["to"]),
-                "platformname": self.manager.config["platformname"],
-                "producttype": self.manager.config["producttype"],
+                "date": (self.config["date"]["from"], self.config["date"]["to"]),
+                "platformname": self.config["platformname"],
+                "producttype": self.config["producttype"],
                 **kwargs,
             }
-            if self.manager.config["platformname"] == "Sentinel-2":
-                conf_args["cloudcoverpercentage"] = (0, self.manager.config["cloud"])
+            if self.config["platformname"] == "Sentinel-2":
+                conf_args["cloudcoverpercentage"] = (0, self.config["cloud"])
 
         self.logger.debug("Querying DHuS")
 
         with ThreadPoolExecutor() as executor:
             futures = {
-                executor.submit(self._query_thread, **conf_args)
+                name: executor.submit(self._query_mirror, name, **conf_args)
+                for name in self.apis
             }
-            for future in as_completed(futures):
-                name = self.manager.config['mirror']['url']
-                res = future.result()
+            # keep configured mirror order
+            for name in futures:
+                res = futures[name].result()
                 if res:
-                    for uid in res:
-                        res[uid]["mirror"] = name
                     response[name] = res
         return response
 
+    def _query_mirror(self, mirror, **kwargs):
+        """Query one mirror, running planned subqueries concurrently
+
+        Failed subqueries are tried again "retry" times.
+
+        Returns
+        -------
+        OrderedDict or None
+            Subquery responses merged by UUID, None if a subquery failed
+        """
+        subqueries = self._plan_query(mirror, **kwargs)
+        merged = OrderedDict()
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            # keep subquery order, results are merged by UUID
+            futures = [
+                executor.submit(self._query_thread, mirror, **args) for args in subqueries
+            ]
+            results = [future.result() for future in futures]
+            # a failed unsplit query leaves out the mirror as before
+            for trial in range(self.retry if len(subqueries) > 1 else 0):
+                failed = [idx for idx, res in enumerate(results) if res is None]
+                if not failed:
+                    break
+                self.logger.info(
+                    "Trying %d failed subqueries on '%s' again [%d/%d]",
+                    len(failed), mirror, trial + 1, self.retry,
+                )
+                sleep(self.retry_delay)
+                futures = {
+                    idx: executor.submit(self._query_thread, mirror, **subqueries[idx])
+                    for idx in failed
+                }
+                for idx in futures:
+                    results[idx] = futures[idx].result()
+        if len(results) > 1 and any(res is None for res in results):
+            # a partial response would look complete, drop the mirror as
+            # if the unsplit query had failed
+            self.logger.info(
+                "Subqueries on '%s' failed, leaving out the mirror's products", mirror
+            )
+            return None
+        for res in results:
+            if res is None:
+                continue
+            merged.update(res)
+        for uid in merged:
+            merged[uid]["mirror"] = mirror
+        return merged
+
     def search(self, targets):
         self.logger.info("Starting product search\n")
         tic = perf_counter()
+        started = time()
         res = OrderedDict()
         futures = {}
         with ThreadPoolExecutor(max_workers=self.parallel) as executor:
@@ -363,73 +900,139 @@ class Query(object):
                                     _idx,
                                     num_targets,
                                     _target,
-                                    len(response),
+                                    len(merge_mirrors(response)),
                                 )
                             else:
                                 self.logger.info("Footprint: %s\n", target)
-                                if self.manager.config["platformname"] == "Sentinel-2":
-                                    utms = order_by_utm(response)
-                                    for utm in utms:
-                                        res.update({utm: utms[utm]})
+                                if self.config["platformname"] == "Sentinel-2":
+                                    found = []
+                                    for mirror in response:
+                                        utms = order_by_utm(response[mirror])
+                                        for utm in utms:
+                                            res.setdefault(utm, OrderedDict())[mirror] = utms[utm]
+                                            if utm not in found:
+                                                found.append(utm)
+                                    for utm in found:
                                         self.logger.info(
                                             "[%d/%d] MGRS %s | %d products",
                                             _idx,
                                             num_targets,
                                             utm,
-                                            len(utms[utm]),
+                                            len(merge_mirrors(res[utm])),
                                         )
                                 else:
-                                    for idx, uuid in enumerate(response, start=1):
+                                    merged = merge_mirrors(response)
+                                    for idx, uuid in enumerate(merged, start=1):
                                         self.logger.info(
-                                            "[%d/%d] UUID %s", idx, len(response), uuid
+                                            "[%d/%d] UUID %s", idx, len(merged), uuid
                                         )
-                                        res.update({uuid: response[uuid]})
+                                        res.update({uuid: merged[uuid]})
                                 self.logger.info("")
                         futures.clear()
 
             # TODO add cases where only a String is received
+        self.tracer.complete("search", "search", started, time(), targets=len(targets))
         elapsed = perf_counter() - tic
         self.logger.info("\nProduct search completed in %f sec", elapsed)
         return res
 
-    def _load_meta(self, fpath):
-        """Automatically choose a parsing method and return parsed data
+    def _load_targets(self, fpath):
+        """Return search targets of an order or None if it is not searched
         """
         fext = path.splitext(fpath)[-1]
         if fext == ".csv":
             self.logger.info("Detected product as csv")
-            tile_ids = load_csv(fpath)
-            return self.search(tile_ids)
-        elif fext == ".json":
-            self.logger.info("Detected product as json")
-            return load_json(fpath)
+            return load_csv(fpath)
         elif fext == ".geojson":
             self.logger.info("Detected product as geojson")
             footprint = geojson_to_wkt(read_geojson(fpath))
-            return self.search(footprint)
+            if self.config["platformname"] == "Sentinel-2":
+                # resolve footprint locally, query tiles instead of geometry
+                tile_ids = tiles_for_footprint(footprint)
+                self.logger.info("Footprint intersects %d MGRS tiles", len(tile_ids))
+                return tile_ids
+            return [footprint]
+        elif not fext and is_utm(fpath):
+            self.logger.info("Detected product as UTM")
+            return fpath.split(",")
+        return None
+
+    def _load_meta(self, fpath):
+        """Automatically choose a parsing method and return parsed data
+        """
+        targets = self._load_targets(fpath)
+        if targets is not None:
+            return self.search(targets)
+        fext = path.splitext(fpath)[-1]
+        if fext == ".json":
+            self.logger.info("Detected product as json")
+            # stream tile by tile into the table, only one tile's product
+            # dicts are held at a time
+            return MetadataTable.from_tiles(
+                (tile, self._merge_tile(tile_meta)) for tile, tile_meta in iter_json_items(fpath)
+            )
+        elif fext == ".jsonl":
+            self.logger.info("Detected product as json lines")
+            meta = OrderedDict()
+            for record in iter_json_lines(fpath):
+                meta.update(record)
+            return meta
+        elif fext == ".npy":
+            self.logger.info("Detected product as metadata table")
+            return MetadataTable.load(fpath)
         elif fext in {".yaml", ".yml"}:
             self.logger.info("Detected product as yaml")
             return load_yaml(fpath)
-        elif not fext and is_utm(fpath):
-            self.logger.info("Detected product as UTM")
-            return self.search(fpath.split(","))
         else:
             raise ValueError(
                 "%s is not a valid target. Expected UTM grid, CSV, "
-                "YAML or JSON file" % fpath
+                "YAML, JSON, JSON Lines or metadata table file" % fpath
             )
 
+    @property
+    def apis(self):
+        """Connected mirrors of the manager, connects on first use
+        """
+        return self.manager.apis
+
+    @property
+    def api(self):
+        return self.manager.api
+
     def _parse_args(self, **kwargs):
         self.manager = kwargs.get("manager")
-        self.api = self.manager.api
+        # per-order options, see SentinelAPIManager.order_config
+        self.config = kwargs.get("config")
+        if self.config is None:
+            self.config = self.manager.config
+        self._mirror_map = {}
+        self._lock = threading.Lock()
         self.order = kwargs.get("order")
 
-        self._download_list = self.manager.download_list
-        self._proc_executor = self.manager.proc_executor
-        self._proc_futures = self.manager.proc_futures
+        # queries sharing a manager need their own download list
+        self._download_list = kwargs.get("download_list")
+        if self._download_list is None:
+            self._download_list = self.manager.download_list
+        self._extractor = self.manager.extractor
+        self.metrics = self.manager.metrics
+        self.tracer = self.manager.tracer
 
-        self.retry = 0
-        self.parallel = 4
+        self.retry = self.config.get("retry", 0)
+        self.retry_delay = self.config.get("retry_delay", 10)
+        self.parallel = self.config.get("parallel", 4)
+        self.query_pages = self.config.get("query_pages", 0)
+        self.keep_zip = bool(self.config.get("keep_zip"))
+        self.verify = bool(self.config.get("verify"))
+        self.verify_retries = self.config.get("verify_retries", 1)
+        self._verify_failures = {}
+        self.summary = None  # set once downloads finished
+
+        options = {}
+        if "selection_k" in self.config:
+            options["k"] = self.config["selection_k"]
+        self.selector = Selector(
+            get_policy(self.config.get("selection", "season"), **options)
+        )
 
     def _logger_init(self):
         self.logger = logging.getLogger("single-mirror")
@@ -452,21 +1055,226 @@ class Query(object):
         self._logger_init()
         self._parse_args(**kwargs)
         self._resolve_path()
+        # products gauge of the manager, until close
+        self._tracked = True
+        self.manager.track_downloads(self._download_list)
+
+    def close(self):
+        """Stop counting this query's products in the manager's metrics
+        """
+        if self._tracked:
+            self._tracked = False
+            self.manager.untrack_downloads(self._download_list)
 
     def execute(self):
+        """Search, select and download the order, see get
+        """
+        try:
+            self._execute()
+        finally:
+            self.close()
+
+    def _execute(self):
+
+        if (
+            self.config.get("pipeline")
+            and not self.config.get("plan")
+            and not self.config.get("work_queue")
+        ):
+            targets = self._load_targets(self.order)
+            if (
+                targets is not None
+                and self.config["platformname"] == "Sentinel-2"
+                and all(is_utm(target) for target in targets)
+            ):
+                return self.execute_pipelined(targets)
+            self.logger.info("Order can not be pipelined, running stages one after another")
 
         self.logger.debug("Getting the metadata for the order: " + str(self.order))
         metadata = self._load_meta(self.order)
+        if isinstance(metadata, MetadataTable):
+            table = metadata
+        else:
+            short = self.down_a_level(metadata)
+            table = MetadataTable.from_meta(short)
+            del short
+        del metadata
 
         self.logger.debug("Metadata obtained, resumed as follows:")
-        self.logger.debug(metadata)
+        self.logger.debug(table)
         self.logger.debug('\n')
+        if self.config.get("save_meta"):
+            table.save(self.config["save_meta"])
+            self.logger.debug("Metadata saved to %s", self.config["save_meta"])
 
-        short = self.down_a_level(metadata)
+        self._mirror_map = table.mirror_map()
+
+        if table.info.get("plan"):
+            # products of a saved plan are already selected
+            self.logger.info("Executing plan of %d products", len(table))
+            self.get(table)
+            return
 
         self.logger.debug('Selecting best products available')
-        selection = self.select(short)
+        selection = self.select(table)
         self.logger.debug(selection)
 
         self.logger.debug('\n')
-        self.get(selection)
\ No newline at end of file
+        if self.config.get("plan"):
+            self.plan(table, selection, self.config["plan"])
+            return
+        self.get(selection, filenames=table.filenames())
+
+    def plan(self, table, selection, fpath):
+        """Estimate size, wall time and disk usage instead of downloading
+
+        The plan is saved as metadata table, pass it as order to download
+        the planned products.
+
+        Parameters
+        ----------
+        table : MetadataTable
+            Searched products
+        selection : dict
+            Selected products
+        fpath : str
+            Path of the plan (.npy)
+
+        Returns
+        -------
+        dict
+            Plan estimates, see plan.make_plan
+        """
+        if not fpath.endswith(".npy"):
+            fpath += ".npy"
+        scores = {name: self.manager.mirror_score(name) for name in self.apis}
+        planned, info = make_plan(table, selection, scores, self.parallel)
+        planned.save(fpath)
+        self.logger.info("")
+        for line in format_plan(info):
+            self.logger.info(line)
+        self.logger.info("\nPlan saved to %s, pass it as order to download", fpath)
+        return info
+
+    def _search_stage(self, targets, tiles):
+        """Query targets and put (tile, response) on the tiles queue
+
+        Puts None once all targets have been queried
+        """
+        num_targets = len(targets)
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                futures = {
+                    executor.submit(self.query, tileid=target): (idx, target)
+                    for idx, target in enumerate(targets, start=1)
+                }
+                for future in as_completed(futures):
+                    idx, target = futures[future]
+                    try:
+                        response = future.result()
+                    except Exception as err:
+                        self.logger.error("MGRS %s | Search failed: %s", target, err)
+                        continue
+                    products = merge_mirrors(response)
+                    self.logger.info(
+                        "[%d/%d] MGRS %s | %d products", idx, num_targets, target, len(products)
+                    )
+                    # blocks while selection / download fall behind
+                    tiles.put((target, products))
+        finally:
+            tiles.put(None)
+
+    def _select_stage(self, tiles, downloads):
+        """Select products of every searched tile, put new (utm, UUID) pairs
+        on the downloads queue
+
+        Puts None once the tiles queue is exhausted
+        """
+        scheduled = set()
+        try:
+            while True:
+                item = tiles.get()
+                if item is None:
+                    break
+                tile, products = item
+                if self.config.get("dedupe"):
+                    products = dedupe(products)
+                with self._lock:
+                    for uuid in products:
+                        self._mirror_map[uuid] = products[uuid]["mirrors"]
+                changed = self.selector.update(tile, products)
+                for utm, uuid in get_keys(changed):
+                    if uuid in scheduled:
+                        continue
+                    scheduled.add(uuid)
+                    self._num_selected = len(scheduled)
+                    # blocks while downloads fall behind
+                    downloads.put((utm, uuid))
+        except Exception as err:
+            self.logger.error("Selection failed: %s", err)
+            # drain search stage so it does not block forever
+            while tiles.get() is not None:
+                pass
+        finally:
+            downloads.put(None)
+
+    def execute_pipelined(self, targets):
+        """Search, select and download as one streaming pipeline
+
+        Every tile's query response is passed on to selection as soon as it
+        returns, selected products go straight into the download queue.
+        Stages are connected by bounded queues (see "pipeline_depth"), so a
+        stage that falls behind throttles the stages before it.
+
+        Parameters
+        ----------
+        targets : list
+            MGRS tile ids
+        """
+        tic = perf_counter()
+        started = time()
+        self.logger.info("Starting pipelined search, selection and download\n")
+        depth = self.config.get("pipeline_depth") or 2 * self.parallel
+        tiles = queue.Queue(maxsize=depth)
+        downloads = queue.Queue(maxsize=depth)
+        self._num_selected = 0
+
+        stages = [
+            threading.Thread(target=self._search_stage, args=(targets, tiles), daemon=True),
+            threading.Thread(target=self._select_stage, args=(tiles, downloads), daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+
+        download_list = self._download_list
+        download_list.clear()
+        selected = True
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            while selected or not self._all_done():
+                for download in download_list.get_scheduled():
+                    self._schedule(download, executor)
+                if len(download_list.get_active()) >= self.parallel:
+                    download_list.wait_for_completed()
+                    continue
+                if not selected:
+                    sleep(2)
+                    continue
+                try:
+                    item = downloads.get(timeout=2)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    selected = False
+                    continue
+                utm, uuid = item
+                download_list.append(
+                    ProductDownload(uuid, (len(download_list) + 1, self._num_selected), utm)
+                )
+            self._wait_for_extraction()
+
+        for stage in stages:
+            stage.join()
+        self.tracer.complete(
+            "pipeline", "download", started, time(), products=len(download_list)
+        )
+        self._finish_downloads(tic)
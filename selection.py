@@ -0,0 +1,185 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from utils import get_season_year, rank_cloud_size
+from product_name import decode
+
+_MONTHS = (
+    "jan", "feb", "mar", "apr", "may", "jun",
+    "jul", "aug", "sep", "oct", "nov", "dec",
+)
+
+
+class SelectionPolicy(ABC):
+    """Decide which products of a MGRS tile get downloaded
+
+    Products are grouped into (year, label) buckets, e.g. (2017, "spring").
+    A policy implements bucket() to assign a product to its bucket and
+    choose() to pick from the products of one bucket.
+    """
+
+    @abstractmethod
+    def bucket(self, product):
+        """Return (year, label) bucket of a product or None to skip it
+        """
+
+    @abstractmethod
+    def choose(self, products):
+        """Return the selected UUID or list of UUIDs of a bucket
+
+        Parameters
+        ----------
+        products : OrderedDict
+            Mapping of UUID to product dict, in order of arrival
+        """
+
+
+class SeasonPolicy(SelectionPolicy):
+    """One product per year and season, see utils.get_year_season_selection
+    """
+
+    def bucket(self, product):
+        if "ingestiondate" not in product:
+            return None
+        season, year = get_season_year(product["ingestiondate"])
+        return (year, season)
+
+    def choose(self, products):
+        return rank_cloud_size(products, list(products))[0]
+
+
+class MonthlyPolicy(SelectionPolicy):
+    """Best k products per year and month
+    """
+
+    def __init__(self, k=1):
+        self.k = k
+
+    def bucket(self, product):
+        if "ingestiondate" not in product:
+            return None
+        date = product["ingestiondate"]
+        return (date.year, _MONTHS[date.month - 1])
+
+    def choose(self, products):
+        return rank_cloud_size(products, list(products))[: self.k]
+
+
+class RelativeOrbitPolicy(SelectionPolicy):
+    """Best product per year and relative orbit
+    """
+
+    def bucket(self, product):
+        if "ingestiondate" not in product:
+            return None
+        orbit = product.get("relativeorbitnumber")
+        if orbit is None:
+            # fall back to the orbit encoded in the product title
+            decoded = decode(product.get("title", ""))
+            orbit = decoded.relative_orbit if decoded else None
+        if orbit is None:
+            return None
+        return (product["ingestiondate"].year, "R%03d" % orbit)
+
+    def choose(self, products):
+        return rank_cloud_size(products, list(products))[0]
+
+
+class MinCloudPolicy(SeasonPolicy):
+    """The k least cloudy products per year and season, e.g. for composites
+
+    Ties are kept in rank_cloud_size order (1.25 x cloud rank + size
+    rank), the sort by cloud cover is stable
+    """
+
+    def __init__(self, k=3):
+        self.k = k
+
+    def choose(self, products):
+        ranked = rank_cloud_size(products, list(products))
+        ranked.sort(key=lambda uuid: products[uuid]["cloudcoverpercentage"])
+        return ranked[: self.k]
+
+
+POLICIES = {
+    "season": SeasonPolicy,
+    "monthly": MonthlyPolicy,
+    "orbit": RelativeOrbitPolicy,
+    "mincloud": MinCloudPolicy,
+}
+
+
+def get_policy(name, **kwargs):
+    """Return a selection policy by name, see POLICIES
+    """
+    if name not in POLICIES:
+        raise ValueError(
+            "%s is not a valid selection policy. Expected one of %s"
+            % (name, ", ".join(POLICIES))
+        )
+    return POLICIES[name](**kwargs)
+
+
+class Selector(object):
+    """Incremental product selection
+
+    Keeps the products of every tile in their policy buckets. update only
+    re-evaluates the buckets new products fall into and reports the
+    selections that changed.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.buckets = {}  # tile -> (year, label) -> OrderedDict of products
+        self.selection = OrderedDict()  # tile -> year -> label -> choice
+
+    def update(self, tile, products):
+        """Add products of a tile and re-select affected buckets
+
+        Parameters
+        ----------
+        tile : str
+            MGRS tile id
+        products : dict
+            Mapping of UUID to product dict
+
+        Returns
+        -------
+        dict
+            Nested dict with tile, year and label as keys, containing
+            only the selections that changed
+        """
+        buckets = self.buckets.setdefault(tile, {})
+        touched = []
+        for uuid in products:
+            key = self.policy.bucket(products[uuid])
+            if key is None:
+                continue
+            bucket = buckets.setdefault(key, OrderedDict())
+            if uuid in bucket:
+                continue
+            bucket[uuid] = products[uuid]
+            if key not in touched:
+                touched.append(key)
+
+        changed = {}
+        years = self.selection.setdefault(tile, OrderedDict())
+        for year, label in touched:
+            choice = self.policy.choose(buckets[(year, label)])
+            if years.get(year, {}).get(label) == choice:
+                continue
+            years.setdefault(year, OrderedDict())[label] = choice
+            changed.setdefault(tile, {}).setdefault(year, {})[label] = choice
+        return changed
+
+    def select_all(self, meta):
+        """Run update for every tile of a mapping of MGRS tile to products
+
+        Returns
+        -------
+        dict
+            Complete selection, tiles without products are left out
+        """
+        for tile in meta:
+            if meta[tile]:
+                self.update(tile, meta[tile])
+        return {tile: self.selection[tile] for tile in meta if meta[tile]}
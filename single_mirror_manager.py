@@ -1,89 +1,287 @@
-from requests.exceptions import RequestException
+# sentinelsat, requests, yaml and the query module are imported on first
+# use, so --help and runs without downloads start fast
 from concurrent.futures import (
     ThreadPoolExecutor,
-    ProcessPoolExecutor,
     as_completed,
 )
 import sys
 from sys import stdout
+from time import perf_counter
+import copy
 import argparse
 import logging
-from sentinelsat import SentinelAPI, SentinelAPIError
-from query import Query
+import threading
+from collections import OrderedDict, Counter
 from product_download_list import ProductDownloadList
+from download_state import DownloadState
+from extraction import ExtractionStage
+from metrics import Metrics
+from tracing import Tracer
+from mirror_health import MirrorHealth, HealthMonitor
+from coalesce import TransferRegistry, MAX_DONE
+
+# Options fixed once the manager is constructed, see order_config
+SHARED_OPTIONS = frozenset(
+    [
+        "user", "password", "url", "mirrors", "timeout", "connections", "extract_workers",
+        "extract_queue", "metrics_port", "trace", "health_db", "probe_interval", "test",
+        "download_processes", "download_threads", "max_transfers",
+    ]
+)
 
 
 class SentinelAPIManager(object):
 
     def _parse_args(self, **kwargs):
+        self._parse_config(self.config, **kwargs)
+
+    def _parse_config(self, config, **kwargs):
+        """Apply kwargs and defaults to config, return config
+        """
 
         user = kwargs.get("user")
         password = kwargs.get("password")
         url = kwargs.get("url")
 
+        mirrors = kwargs.get("mirrors")
+        if mirrors:
+            config["mirrors"] = mirrors
+        elif not config.get("mirrors"):
+            config["mirrors"] = {}
+
         if user and password and url:
             self.logger.info('Sufficient variables for connection string')
-        else:
+            # mirror passed explicitly is named by its URL and queried first
+            config["mirrors"] = {
+                url: {"user": user, "password": password, "url": url},
+                **config["mirrors"],
+            }
+        elif not config["mirrors"]:
             raise ValueError('No connection provided')
 
-        self.config["mirror"] = {}
-        self.config["mirror"]["user"] = user
-        self.config["mirror"]["password"] = password
-        self.config["mirror"]["url"] = url
+        # primary mirror
+        primary = next(iter(config["mirrors"]))
+        config["mirror"] = {}
+        config["mirror"]["user"] = config["mirrors"][primary]["user"]
+        config["mirror"]["password"] = config["mirrors"][primary]["password"]
+        config["mirror"]["url"] = config["mirrors"][primary]["url"]
 
         order = kwargs.get("order")
         if order:
-            self.config["order"] = order
+            config["order"] = order
 
         cloud = kwargs.get("cloud")
         if cloud:
-            self.config["cloud"] = cloud
-        elif "cloud" not in self.config:
-            self.config["cloud"] = 10.0
+            config["cloud"] = cloud
+        elif "cloud" not in config:
+            config["cloud"] = 10.0
 
         from_date = kwargs.get("from_date")
         to_date = kwargs.get("to_date")
-        if "date" not in self.config:
-            self.config["date"] = {}
+        if "date" not in config:
+            config["date"] = {}
         if from_date:
-            self.config["date"]["from"] = from_date
-        elif "from" not in self.config["date"]:
-            self.config["date"]["from"] = "NOW-356DAY"
+            config["date"]["from"] = from_date
+        elif "from" not in config["date"]:
+            config["date"]["from"] = "NOW-356DAY"
         if to_date:
-            self.config["date"]["to"] = to_date
-        elif "to" not in self.config["date"]:
-            self.config["date"]["to"] = "NOW"
+            config["date"]["to"] = to_date
+        elif "to" not in config["date"]:
+            config["date"]["to"] = "NOW"
 
         timeout = kwargs.get("timeout")
         if timeout:
-            self.config["timeout"] = timeout
-        elif "timeout" not in self.config:
-            self.config["timeout"] = 15.0
+            config["timeout"] = timeout
+        elif "timeout" not in config:
+            config["timeout"] = 15.0
 
         connections = kwargs.get("connections")
         if connections:
-            self.config["connections"] = connections
-        elif "connections" not in self.config:
-            self.config["connections"] = 2
+            config["connections"] = connections
+        elif "connections" not in config:
+            config["connections"] = 2
+
+        # number of concurrent downloads and queries
+        parallel = kwargs.get("parallel")
+        if parallel:
+            config["parallel"] = parallel
+        elif "parallel" not in config:
+            config["parallel"] = 4
+
+        # retries per mirror of a failed download
+        retry = kwargs.get("retry")
+        if retry is not None:
+            config["retry"] = retry
+        elif "retry" not in config:
+            config["retry"] = 0
+
+        # seconds between retries
+        retry_delay = kwargs.get("retry_delay")
+        if retry_delay is not None:
+            config["retry_delay"] = retry_delay
+        elif "retry_delay" not in config:
+            config["retry_delay"] = 10
+
+        # None: one extraction worker per CPU
+        extract_workers = kwargs.get("extract_workers")
+        if extract_workers:
+            config["extract_workers"] = extract_workers
+        elif "extract_workers" not in config:
+            config["extract_workers"] = None
+
+        # None: twice the number of extraction workers
+        extract_queue = kwargs.get("extract_queue")
+        if extract_queue:
+            config["extract_queue"] = extract_queue
+        elif "extract_queue" not in config:
+            config["extract_queue"] = None
+
+        # None: download in threads of the main process, see download_shards
+        download_processes = kwargs.get("download_processes")
+        if download_processes:
+            config["download_processes"] = download_processes
+        elif "download_processes" not in config:
+            config["download_processes"] = None
+
+        # None: parallel downloads spread over the download processes
+        download_threads = kwargs.get("download_threads")
+        if download_threads:
+            config["download_threads"] = download_threads
+        elif "download_threads" not in config:
+            config["download_threads"] = None
+
+        # split queries of more than this many result pages by date, one
+        # count request per query and mirror, 0 disables splitting
+        query_pages = kwargs.get("query_pages")
+        if query_pages is not None:
+            config["query_pages"] = query_pages
+        elif "query_pages" not in config:
+            config["query_pages"] = 0
+
+        # finished transfers remembered for later orders, see coalesce
+        max_transfers = kwargs.get("max_transfers")
+        if max_transfers is not None:
+            config["max_transfers"] = max_transfers
+        elif "max_transfers" not in config:
+            config["max_transfers"] = MAX_DONE
+
+        selection = kwargs.get("selection")
+        if selection:
+            config["selection"] = selection
+        elif "selection" not in config:
+            config["selection"] = "season"
+
+        selection_k = kwargs.get("selection_k")
+        if selection_k:
+            config["selection_k"] = selection_k
+
+        pipeline = kwargs.get("pipeline")
+        if pipeline:
+            config["pipeline"] = pipeline
+
+        dedupe = kwargs.get("dedupe")
+        if dedupe:
+            config["dedupe"] = dedupe
+
+        # index downloaded zips instead of extracting them, see zip_index
+        keep_zip = kwargs.get("keep_zip")
+        if keep_zip:
+            config["keep_zip"] = keep_zip
+
+        # check products against manifest.safe checksums, see verify
+        verify = kwargs.get("verify")
+        if verify:
+            config["verify"] = verify
+
+        verify_retries = kwargs.get("verify_retries")
+        if verify_retries is not None:
+            config["verify_retries"] = verify_retries
+        elif "verify_retries" not in config:
+            config["verify_retries"] = 1
+
+        # serve live metrics at http://localhost:<metrics_port>/metrics
+        metrics_port = kwargs.get("metrics_port")
+        if metrics_port is not None:
+            config["metrics_port"] = metrics_port
+
+        # write a Chrome trace of the run to this path
+        trace = kwargs.get("trace")
+        if trace:
+            config["trace"] = trace
+
+        # mirror latency and throughput history, see mirror_health
+        health_db = kwargs.get("health_db")
+        if health_db:
+            config["health_db"] = health_db
+        elif "health_db" not in config:
+            config["health_db"] = "mirror_health.json"
+
+        # seconds between background mirror probes, 0 disables probing
+        probe_interval = kwargs.get("probe_interval")
+        if probe_interval is not None:
+            config["probe_interval"] = probe_interval
+        elif "probe_interval" not in config:
+            config["probe_interval"] = 600
+
+        # MGRS tiles the mirrors are probed with
+        test = kwargs.get("test")
+        if test:
+            config["test"] = test
+        elif "test" not in config:
+            config["test"] = ["31UES", "32UQD", "32VNM", "33UWP", "34SGH", "35VLG", "32TQM"]
+
+        # download by workers of this queue, see work_queue
+        work_queue = kwargs.get("work_queue")
+        if work_queue:
+            config["work_queue"] = work_queue
+
+        # seconds without any worker before queued products are failed
+        work_queue_idle = kwargs.get("work_queue_idle")
+        if work_queue_idle is not None:
+            config["work_queue_idle"] = work_queue_idle
+        elif "work_queue_idle" not in config:
+            config["work_queue_idle"] = 600
+
+        # write a plan of the order to this path instead of downloading
+        plan = kwargs.get("plan")
+        if plan:
+            config["plan"] = plan
+
+        save_meta = kwargs.get("save_meta")
+        if save_meta:
+            config["save_meta"] = save_meta
 
         platformname = kwargs.get("platformname")
         if platformname:
-            self.config["platformname"] = "Sentinel-%d" % platformname
-        elif "platformname" not in self.config:
-            self.config["platformname"] = "Sentinel-2"
+            config["platformname"] = "Sentinel-%d" % platformname
+        elif "platformname" not in config:
+            config["platformname"] = "Sentinel-2"
 
         producttype = kwargs.get("producttype")
         if producttype:
-            self.config["producttype"] = producttype
-        elif "producttype" not in self.config:
-            if self.config["platformname"] == "Sentinel-1":
-                self.config["producttype"] = "SLC"
-            elif self.config["platformname"] == "Sentinel-2":
-                self.config["producttype"] = "S2MSI1C"
-            elif self.config["platformname"] == "Sentinel-3":
-                self.config["producttype"] = "SR_1_SRA___"
-
-    def __init__(self, **kwargs):
+            config["producttype"] = producttype
+        elif "producttype" not in config:
+            if config["platformname"] == "Sentinel-1":
+                config["producttype"] = "SLC"
+            elif config["platformname"] == "Sentinel-2":
+                config["producttype"] = "S2MSI1C"
+            elif config["platformname"] == "Sentinel-3":
+                config["producttype"] = "SR_1_SRA___"
+        return config
+
+    def order_config(self, **kwargs):
+        """Return a copy of the config with the options of a single order
+
+        Options of connections and pools (see SHARED_OPTIONS) are shared
+        by all orders and ignored here.
+        """
+        ignored = sorted(set(kwargs) & SHARED_OPTIONS)
+        if ignored:
+            self.logger.warning("Ignoring shared options of an order: %s", ", ".join(ignored))
+        options = {key: value for key, value in kwargs.items() if key not in SHARED_OPTIONS}
+        return self._parse_config(copy.deepcopy(self.config), **options)
+
+    def __init__(self, config_file=None, **kwargs):
 
         self.logger = logging.getLogger("single-mirror")
         if not self.logger.handlers:
@@ -93,40 +291,206 @@ class SentinelAPIManager(object):
             self.logger.addHandler(handler)
         self.logger.setLevel(logging.DEBUG)
 
-        self.config = {}
+        # Config file
+        if config_file:
+            from utils import load_yaml
+            self.config = load_yaml(config_file)
+        else:
+            self.config = {}
+        self.config_file = config_file
 
         # get config params
         # values passed via kwargs override values read from config file
         self._parse_args(**kwargs)
 
-        self._connections = {'mirror': 0}
+        self._connections = {name: 0 for name in self.config["mirrors"]}
+        self._connections_lock = threading.Lock()
+        # concurrent downloads of all queries sharing this manager
+        self.download_slots = threading.BoundedSemaphore(self.config["parallel"])
+        # products downloaded or in flight, shared by these queries
+        self.transfers = TransferRegistry(self.config["max_transfers"])
 
         # TODO Used to be a ProductDownloadList class
         self.download_list = ProductDownloadList()
 
-        self.proc_executor = ProcessPoolExecutor()
-        self.proc_futures = {}
-
-        self.api = {}
-        # self._connect()
-        self._connect_hard(kwargs.get("user"), kwargs.get("password"), kwargs.get("url"))
-
-    # Connects to a specific mirror
-    def _connect_hard(self, user, password, url):
-
-        self.logger.info('Connecting to ' + url + ' as ' + user + '\n')
+        self.metrics = Metrics()
+        # download lists of running queries, summed by the products gauge
+        self._download_lists = []
+        self._download_lists_lock = threading.Lock()
+        self.metrics.registry.add_collector(self._collect_metrics)
+        self.metrics_server = None
+        if self.config.get("metrics_port") is not None:
+            from metrics import MetricsServer
+            self.metrics_server = MetricsServer(self.metrics.registry, self.config["metrics_port"])
+            self.logger.info("Serving metrics at %s", self.metrics_server.url)
+
+        self.tracer = Tracer(enabled=bool(self.config.get("trace")))
+
+        self.health = MirrorHealth(self.config["health_db"])
+        self.health_monitor = None
+
+        # worker processes start with the first extraction
+        self.extractor = ExtractionStage(
+            workers=self.config["extract_workers"],
+            max_pending=self.config["extract_queue"],
+            metrics=self.metrics,
+            tracer=self.tracer,
+        )
+
+        self._api = {}
+        self._apis = None
+        self._connect_lock = threading.Lock()
+        self._downloader = None
+
+    def track_downloads(self, download_list):
+        """Count the products of a query's download list in the metrics
+        """
+        with self._download_lists_lock:
+            self._download_lists.append(download_list)
+
+    def untrack_downloads(self, download_list):
+        """Stop counting a download list passed to track_downloads
+        """
+        with self._download_lists_lock:
+            for idx, tracked in enumerate(self._download_lists):
+                if tracked is download_list:
+                    del self._download_lists[idx]
+                    break
+
+    def _collect_metrics(self):
+        """Set the products gauge from the download lists of all queries
+        """
+        with self._download_lists_lock:
+            # queries may share a list, count it once
+            lists = list({id(tracked): tracked for tracked in self._download_lists}.values())
+        states = Counter()
+        for download_list in lists:
+            states.update(download.state for download in list(download_list))
+        for state in DownloadState:
+            self.metrics.products.set(states[state], state=state.name)
+
+    @property
+    def downloader(self):
+        """ShardedDownloader of the "download_processes" option or None
+
+        Download processes are started on first access
+        """
+        if self._downloader is None and self.config["download_processes"]:
+            with self._connect_lock:
+                if self._downloader is None:
+                    from download_shards import ShardedDownloader
+                    processes = self.config["download_processes"]
+                    threads = self.config["download_threads"] or -(-self.config["parallel"] // processes)
+                    mirrors = {
+                        name: {key: mirror[key] for key in ("url", "user", "password")}
+                        for name, mirror in self.config["mirrors"].items()
+                    }
+                    self._downloader = ShardedDownloader(
+                        mirrors,
+                        processes,
+                        threads,
+                        timeout=self.config["timeout"],
+                        metrics=self.metrics,
+                        tracer=self.tracer,
+                    )
+                    self.logger.info(
+                        "Downloading in %d processes with %d threads each", processes, threads
+                    )
+        return self._downloader
+
+    @property
+    def apis(self):
+        """Connected mirrors by name, in configured order
+
+        Mirrors are connected on first access
+        """
+        if self._apis is None:
+            with self._connect_lock:
+                if self._apis is None:
+                    self._apis = self._connect()
+                    self._start_probes()
+        return self._apis
+
+    @property
+    def api(self):
+        """SentinelAPI of the primary mirror
+        """
+        if self._apis is None:
+            self.apis
+        return self._api
+
+    # Connect to all configured mirrors
+    def _connect(self):
+
+        apis = {}
         with ThreadPoolExecutor() as executor:
-            futures = {
-                executor.submit(self.hard_connection, user, password, url)
-            }
+            futures = {}
+            for name, mirror in self.config["mirrors"].items():
+                self.logger.info('Connecting to ' + mirror["url"] + ' as ' + mirror["user"] + '\n')
+                future = executor.submit(
+                    self.hard_connection, mirror["user"], mirror["password"], mirror["url"]
+                )
+                futures[future] = name
             for future in as_completed(futures):
+                name = futures[future]
                 res = future.result()
                 if res:
-                    self.api = res[0]
-                    self.config["mirror"]["num_available"] = res[1]
+                    apis[name] = res[0]
+                    self.config["mirrors"][name]["num_available"] = res[1]
+                    self.health.record(self.config["mirrors"][name]["url"], latency=res[2])
+                else:
+                    self.health.record(self.config["mirrors"][name]["url"], available=False)
+
+        for name in apis:
+            self.metrics.instrument(name, apis[name].session)
+        self.health.save()
+
+        # keep configured mirror order, first available mirror is the primary
+        apis = OrderedDict(
+            (name, apis[name]) for name in self.config["mirrors"] if name in apis
+        )
+        if apis:
+            primary = next(iter(apis))
+            self._api = apis[primary]
+            for key in ("user", "password", "url", "num_available"):
+                self.config["mirror"][key] = self.config["mirrors"][primary][key]
+            ranking = sorted(apis, key=self.mirror_score, reverse=True)
+            self.logger.info(
+                "Mirror ranking: %s",
+                ", ".join("%s (%.2f MB/s)" % (name, self.mirror_score(name)) for name in ranking),
+            )
+        return apis
+
+    def mirror_score(self, name):
+        """Expected throughput of a mirror in MB/s from its health history
+        """
+        return self.health.score(self.config["mirrors"][name]["url"])
+
+    def _probe_queries(self):
+        query = {
+            "platformname": self.config["platformname"],
+            "producttype": self.config["producttype"],
+        }
+        if self.config["platformname"] != "Sentinel-2" or not self.config["test"]:
+            return [query]
+        return [dict(query, tileid=tile) for tile in self.config["test"]]
+
+    def _start_probes(self):
+        """Re-probe connected mirrors in the background during the run
+        """
+        if not self.config["probe_interval"] or not self._apis:
+            return
+        self.health_monitor = HealthMonitor(
+            self.health,
+            {self.config["mirrors"][name]["url"]: api for name, api in self._apis.items()},
+            self._probe_queries(),
+            self.config["probe_interval"],
+        ).start()
 
     def hard_connection(self, user, password, url):
         global args
+        from sentinelsat import SentinelAPI, SentinelAPIError
+        from requests.exceptions import RequestException
         try:
             args = {
                 "date": (self.config["date"]["from"], self.config["date"]["to"]),
@@ -137,8 +501,9 @@ class SentinelAPIManager(object):
             api = SentinelAPI(
                 user, password, api_url=url, show_progressbars=False, timeout=self.config["timeout"]
             )
+            tic = perf_counter()
             count = api.count(**args)
-            return (api, count)
+            return (api, count, perf_counter() - tic)
 
         except (SentinelAPIError, RequestException) as err:
             self.logger.info(
@@ -182,6 +547,37 @@ def parse_args(args):
     parser.add_argument("--from", help="DHuS Initial Date", type=str)
     parser.add_argument("--to", help="DHuS End Date", type=str)
     parser.add_argument("--order", help="DHuS Order Identifier", type=str)
+    parser.add_argument("--parallel", help="Number of concurrent downloads", type=int)
+    parser.add_argument(
+        "--download-processes", help="Shard downloads over this many processes", type=int
+    )
+    parser.add_argument("--download-threads", help="Download threads per process", type=int)
+    parser.add_argument("--metrics-port", help="Serve live metrics on this port", type=int)
+    parser.add_argument("--trace", help="Write a Chrome trace JSON file", type=str)
+    parser.add_argument(
+        "--work-queue", help="Let workers of this SQLite queue download", type=str
+    )
+    parser.add_argument(
+        "--plan", help="Estimate the order and save a plan (.npy) instead of downloading", type=str
+    )
+    parser.add_argument("--retry", help="Retries per mirror of a failed download", type=int)
+    parser.add_argument(
+        "--query-pages", help="Split queries of more result pages by date, 0 disables", type=int
+    )
+    parser.add_argument("--config", help="YAML config file with mirrors", type=str)
+    parser.add_argument("--health-db", help="Mirror health history JSON file", type=str)
+    parser.add_argument(
+        "--probe-interval", help="Seconds between mirror probes, 0 disables", type=float
+    )
+    parser.add_argument(
+        "--pipeline", help="Download while searching", action="store_true"
+    )
+    parser.add_argument(
+        "--keep-zip", help="Index zip files instead of extracting them", action="store_true"
+    )
+    parser.add_argument(
+        "--verify", help="Check products against manifest.safe", action="store_true"
+    )
 
     return parser.parse_args(args)
 
@@ -204,17 +600,28 @@ def main():
     print('\nArguments:')
     for pair in cmd_args:
         if cmd_args.get(pair):
-            print(pair + ': ' + cmd_args.get(pair))
+            print(pair + ': ' + str(cmd_args.get(pair)))
         else:
             print(pair + ' not assigned')
 
     # API connection to Sentinel as object
     manager = SentinelAPIManager(
+        config_file=cmd_args.get('config'),
         user=cmd_args.get('user'), password=cmd_args.get('password'), url=cmd_args.get('url'),
         cloud=None, platformname=2, producttype='S2MSI1C'
-        , from_date=cmd_args.get('from'), to_date=cmd_args.get('to'), order=cmd_args.get('order')
+        , from_date=cmd_args.get('from'), to_date=cmd_args.get('to'), order=cmd_args.get('order'),
+        parallel=cmd_args.get('parallel'), retry=cmd_args.get('retry'),
+        query_pages=cmd_args.get('query_pages'),
+        metrics_port=cmd_args.get('metrics_port'), trace=cmd_args.get('trace'),
+        pipeline=cmd_args.get('pipeline'), keep_zip=cmd_args.get('keep_zip'),
+        verify=cmd_args.get('verify'), health_db=cmd_args.get('health_db'),
+        probe_interval=cmd_args.get('probe_interval'), plan=cmd_args.get('plan'),
+        work_queue=cmd_args.get('work_queue'),
+        download_processes=cmd_args.get('download_processes'),
+        download_threads=cmd_args.get('download_threads'),
     )
 
+    from query import Query
     query = Query(manager=manager, order=manager.config["order"])
     query.execute()
 
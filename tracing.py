@@ -0,0 +1,166 @@
+"""Span tracing with Chrome trace export
+
+Spans are recorded as complete ("X") events of the Chrome trace event
+format and saved as JSON, which can be opened in chrome://tracing or
+https://ui.perfetto.dev. Every thread and extraction worker process gets
+its own track, so idle worker slots show up as gaps.
+"""
+import os
+import json
+import threading
+from time import time
+from collections import deque
+
+
+class _Span(object):
+    """Context manager recording a span on exit
+    """
+
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.complete(self.name, self.cat, self.start, time(), **self.args)
+
+    def tag(self, **args):
+        """Add arguments to the span, e.g. results known only at the end
+        """
+        self.args.update(args)
+
+
+class _NullSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def tag(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Collect spans of a run
+
+    Parameters
+    ----------
+    enabled : bool
+        Disabled tracers record nothing and their spans cost a method call
+    max_events : int, optional
+        Only the newest events are kept, e.g. in long-running services,
+        track names are always kept
+
+    Example
+    -------
+    tracer = Tracer()
+    with tracer.span("download", "download", uuid=uuid, mirror=mirror):
+        ...
+    tracer.save("trace.json")
+    """
+
+    def __init__(self, enabled=True, max_events=None):
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self._events = deque(maxlen=max_events)
+        self._names = []  # thread and process name events
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def set_limit(self, max_events):
+        """Keep only the newest max_events events from now on, None keeps all
+        """
+        with self._lock:
+            self._events = deque(self._events, maxlen=max_events)
+
+    def span(self, name, cat, **args):
+        """Return a context manager recording a span on the current thread
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def complete(self, name, cat, start, stop, pid=None, tid=None, process="extraction worker", **args):
+        """Record a span from start to stop, both as time.time() values
+
+        pid and tid default to the current process and thread, spans of
+        other processes pass their pid and use it as tid as well. process
+        names the track of other processes.
+        """
+        if not self.enabled:
+            return
+        if tid is None:
+            tid = threading.get_ident()
+            thread = threading.current_thread().name
+        else:
+            thread = None
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": max(stop - start, 0.0) * 1e6,
+            "pid": pid or self.pid,
+            "tid": tid,
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+            if thread is not None and (self.pid, tid) not in self._threads:
+                self._threads.add((self.pid, tid))
+                self._names.append(self._meta("thread_name", self.pid, tid, thread))
+            elif pid and (pid, tid) not in self._threads:
+                self._threads.add((pid, tid))
+                self._names.append(self._meta("process_name", pid, tid, process))
+
+    def instant(self, name, cat, **args):
+        """Record a point in time, e.g. a product being requeued
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._events.append(
+                {
+                    "name": name,
+                    "cat": cat,
+                    "ph": "i",
+                    "s": "t",
+                    "ts": time() * 1e6,
+                    "pid": self.pid,
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    @staticmethod
+    def _meta(kind, pid, tid, name):
+        return {"name": kind, "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+
+    def __len__(self):
+        return len(self._events)
+
+    def save(self, fpath):
+        """Write recorded events as Chrome trace JSON
+        """
+        with self._lock:
+            events = self._names + list(self._events)
+        events.append(self._meta("process_name", self.pid, 0, "single-mirror"))
+        with open(fpath, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return fpath
@@ -1,11 +1,40 @@
 import csv
 import json
 import os
-import yaml
 import datetime
 import re
-from collections import Counter
+import shutil
+import struct
+from collections import Counter, OrderedDict
 import zipfile
+import numpy as np
+from product_name import get_tile
+
+_NOW_RE = re.compile(r"^NOW(?:-([0-9]+)DAYS?)?$")
+
+# (first day, last day, season) as (month, day) tuples
+# Dates from January 1st to March 20th belong to the previous year's winter
+_SEASONS = (
+    ((3, 21), (6, 20), "spring"),
+    ((6, 21), (9, 22), "summer"),
+    ((9, 23), (12, 20), "autumn"),
+    ((12, 21), (12, 31), "winter"),
+)
+SEASON_NAMES = tuple(season for _, _, season in _SEASONS)
+# first day of each season as month * 100 + day
+_SEASON_STARTS = np.array([start[0] * 100 + start[1] for start, _, _ in _SEASONS])
+# datetime.date(1970, 1, 1).toordinal()
+EPOCH_ORDINAL = 719163
+
+_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+
+def parse_size(size):
+    """Convert a DHuS size string like "1.09 GB" to bytes
+    """
+    value, unit = size.split()
+    return int(float(value) * _UNITS[unit.upper()])
+
 
 def get_season_year(idate):
     """From a given JSON response get Year and Season
@@ -21,23 +50,11 @@ def get_season_year(idate):
         tuple with (season, year)
     """
     year = idate.year
-    date = idate.date()
-    seasons = {
-        "last_winter": (datetime.date(year, 1, 1), datetime.date(year, 3, 20)),
-        "spring": (datetime.date(year, 3, 21), datetime.date(year, 6, 20)),
-        "summer": (datetime.date(year, 6, 21), datetime.date(year, 9, 22)),
-        "autumn": (datetime.date(year, 9, 23), datetime.date(year, 12, 20)),
-        "winter": (datetime.date(year, 12, 21), datetime.date(year, 12, 31)),
-    }
-    if seasons["spring"][0] <= date <= seasons["spring"][1]:
-        return ("spring", year)
-    if seasons["summer"][0] <= date <= seasons["summer"][1]:
-        return ("summer", year)
-    if seasons["autumn"][0] <= date <= seasons["autumn"][1]:
-        return ("autumn", year)
-    if seasons["winter"][0] <= date <= seasons["winter"][1]:
-        return ("winter", year)
-    if seasons["last_winter"][0] <= date <= seasons["last_winter"][1]:
+    day = (idate.month, idate.day)
+    for first, last, season in _SEASONS:
+        if first <= day <= last:
+            return (season, year)
+    if (1, 1) <= day <= (3, 20):
         return ("winter", year - 1)
     raise ValueError("Unable to find season for date {}".format(idate))
 
@@ -69,11 +86,55 @@ def get_year_season_map(meta):
         year_season_map[year][season].append(uuid)
     return year_season_map
 
+def rank_cloud_size(meta, uuids):
+    """Rank products by 1.25 x cloud rank + size rank
+
+    Lowest cloudcoverpercentage and highest filesize rank best, sizes
+    are compared in bytes (see parse_size), as in MetadataTable.select.
+    Ties go to the product ranked first by cloud cover.
+
+    Parameters
+    ----------
+    meta : dict
+        JSON data hub response
+    uuids : list
+        Product UUIDs to rank
+
+    Returns
+    -------
+    list
+        UUIDs, best product first
+    """
+    cloud = {}
+    size = {}
+    for uuid in uuids:
+        cloud[uuid] = meta[uuid]["cloudcoverpercentage"]
+        size[uuid] = parse_size(meta[uuid]["size"])
+    rank_cloud = Counter(
+        {
+            val[0]: 1.25 * idx
+            for idx, val in enumerate(
+                sorted(cloud.items(), key=lambda m: m[1], reverse=True), start=1
+            )
+        }
+    )
+    rank_size = Counter(
+        {
+            val[0]: idx
+            for idx, val in enumerate(
+                sorted(size.items(), key=lambda m: m[1]), start=1
+            )
+        }
+    )
+    rank = rank_cloud + rank_size
+    return [uuid for uuid, _ in rank.most_common()]
+
+
 def get_year_season_selection(meta):
     """
     Select product with:
         - lowest cloudcoverpercentage and
-        - highest filesize
+        - highest filesize (in bytes, see rank_cloud_size)
     per year and season
 
     Parameters
@@ -94,32 +155,110 @@ def get_year_season_selection(meta):
         for season in year_season_map[year]:
             if not year_season_map[year][season]:
                 continue
-            cloud = {}
-            size = {}
-            for uuid in year_season_map[year][season]:
-                cloud[uuid] = meta[uuid]["cloudcoverpercentage"]
-                size[uuid] = float(meta[uuid]["size"].split()[0])
-            rank_cloud = Counter(
-                {
-                    val[0]: 1.25 * idx
-                    for idx, val in enumerate(
-                        sorted(cloud.items(), key=lambda m: m[1], reverse=True), start=1
-                    )
-                }
-            )
-            rank_size = Counter(
-                {
-                    val[0]: idx
-                    for idx, val in enumerate(
-                        sorted(size.items(), key=lambda m: m[1]), start=1
-                    )
-                }
-            )
-            rank = rank_cloud + rank_size
-            best = rank.most_common(1)[0][0]
+            best = rank_cloud_size(meta, year_season_map[year][season])[0]
             selection[year].update({season: best})
     return selection
 
+def select_year_season(tile_idx, day, cloud, size):
+    """Columnar version of the year/season product selection
+
+    Ranks all products of all tiles in one pass. Products are scored per
+    tile, year and season by 1.25 x cloud rank + size rank, ties are
+    resolved exactly like get_year_season_selection.
+
+    Parameters
+    ----------
+    tile_idx : array_like
+        Tile index per product
+    day : array_like
+        Ingestion date per product as proleptic Gregorian ordinal
+    cloud : array_like
+        Cloud cover percentage per product
+    size : array_like
+        File size per product in bytes, see parse_size
+
+    Returns
+    -------
+    tuple
+        (best, tile_idx, year, season) arrays with one entry per tile, year
+        and season bucket. best is the position of the selected product,
+        season indexes ("spring", "summer", "autumn", "winter").
+        Buckets are ordered by first appearance of their tile and year,
+        then by season.
+    """
+    tile_idx = np.asarray(tile_idx, dtype=np.int64)
+    cloud = np.asarray(cloud, dtype=np.float64)
+    size = np.asarray(size, dtype=np.float64)
+    date = (np.asarray(day, dtype=np.int64) - EPOCH_ORDINAL).astype("datetime64[D]")
+    month_start = date.astype("datetime64[M]")
+    year = date.astype("datetime64[Y]").astype(np.int64) + 1970
+    month = month_start.astype(np.int64) % 12 + 1
+    month_day = month * 100 + (date - month_start).astype(np.int64) + 1
+
+    season = np.searchsorted(_SEASON_STARTS, month_day, side="right") - 1
+    last_winter = season < 0
+    season[last_winter] = 3
+    year[last_winter] -= 1
+
+    num = len(tile_idx)
+    pos = np.arange(num)
+    # order years by first appearance within their tile
+    tile_year = tile_idx * 100000 + year
+    _, first, year_rank = np.unique(tile_year, return_index=True, return_inverse=True)
+    year_rank = np.argsort(np.argsort(first, kind="stable"), kind="stable")[year_rank.ravel()]
+    _, group = np.unique(year_rank * 4 + season, return_inverse=True)
+    group = group.ravel()
+    starts = np.concatenate(([0], np.cumsum(np.bincount(group))[:-1]))
+
+    def rank_in_group(order):
+        ranks = np.empty(num, dtype=np.int64)
+        ranks[order] = pos - starts[group[order]] + 1
+        return ranks
+
+    rank_cloud = rank_in_group(np.lexsort((pos, -cloud, group)))
+    rank_size = rank_in_group(np.lexsort((pos, size, group)))
+    score = 1.25 * rank_cloud + rank_size
+    best = np.lexsort((rank_cloud, -score, group))[starts]
+    return best, tile_idx[best], year[best], season[best]
+
+
+def get_year_season_selection_all(meta):
+    """Run get_year_season_selection for all tiles at once
+
+    Sizes are ranked in bytes, as by rank_cloud_size.
+
+    Parameters
+    ----------
+    meta : dict
+        Mapping of MGRS tile to JSON data hub response
+
+    Returns
+    -------
+    dict
+        Nested dict with tile, year and season as keys
+        Tiles without products are left out
+    """
+    tiles = [tile for tile in meta if meta[tile]]
+    selection = {tile: {} for tile in tiles}
+    tile_idx, uuids, day, cloud, size = [], [], [], [], []
+    for idx, tile in enumerate(tiles):
+        for uuid in meta[tile]:
+            product = meta[tile][uuid]
+            if "ingestiondate" not in product:
+                continue
+            tile_idx.append(idx)
+            uuids.append(uuid)
+            day.append(product["ingestiondate"].toordinal())
+            cloud.append(product["cloudcoverpercentage"])
+            size.append(parse_size(product["size"]))
+    if not uuids:
+        return selection
+    for best, idx, year, season in zip(*select_year_season(tile_idx, day, cloud, size)):
+        years = selection[tiles[idx]]
+        years.setdefault(int(year), {})[SEASON_NAMES[season]] = uuids[best]
+    return selection
+
+
 def _match_year(x):
     """Match Year string
     """
@@ -131,7 +270,8 @@ def is_selection(meta):
     Return True if parameter "meta" is a nested dict with:
         - MGRS grid as first key
         - Year as second key
-        - ["spring", "summer", "autumn", "winter"] as third key
+        - a bucket label, e.g. ["spring", "summer", "autumn", "winter"],
+          as third key
     """
     for utm in meta:
         if not _match_UTM(utm):
@@ -139,12 +279,8 @@ def is_selection(meta):
         for year in meta[utm]:
             if not _match_year(year):
                 return False
-            return any(
-                [
-                    season in meta[utm][year]
-                    for season in ["spring", "summer", "autumn", "winter"]
-                ]
-            )
+            # third key depends on the selection policy, see selection.py
+            return isinstance(meta[utm][year], dict)
 
 
 def get_keys(meta):
@@ -159,12 +295,42 @@ def get_keys(meta):
         for val in meta[utm]:
             if selection:
                 for season in meta[utm][val]:
-                    keys.append((utm, meta[utm][val][season]))
+                    choice = meta[utm][val][season]
+                    if isinstance(choice, list):
+                        keys.extend((utm, uuid) for uuid in choice)
+                    else:
+                        keys.append((utm, choice))
             else:
                 keys.append((utm, val))
     return keys
 
 
+def merge_mirrors(response):
+    """Merge query responses of several mirrors by product UUID
+
+    Parameters
+    ----------
+    response : dict
+        Mapping of mirror name to data hub JSON response
+
+    Returns
+    -------
+    OrderedDict
+        Mapping of UUID to product dict
+        Key "mirrors" lists every mirror holding the product
+    """
+    merged = OrderedDict()
+    for mirror in response:
+        if not response[mirror]:
+            continue
+        for uuid in response[mirror]:
+            if uuid not in merged:
+                merged[uuid] = dict(response[mirror][uuid])
+                merged[uuid]["mirrors"] = []
+            merged[uuid]["mirrors"].append(mirror)
+    return merged
+
+
 def order_by_utm(response):
     """Order data hub JSON response by MGRS grid id
     """
@@ -176,9 +342,7 @@ def order_by_utm(response):
                 utms[utm] = {}
             utms[utm].update({uuid: response[uuid]})
         else:
-            utm = re.search(
-                "_T([0-9]{1,2}[A-Z]{3})_", response[uuid]["filename"]
-            ).groups(1)[0]
+            utm = get_tile(response[uuid]["filename"])
             response[uuid]["tileid"] = utm
             if utm not in utms:
                 utms[utm] = {}
@@ -204,12 +368,132 @@ def datetime_parser(dct):
     return dct
 
 
+# Product fields holding dates
+DATE_FIELDS = frozenset(
+    {
+        "beginposition",
+        "endposition",
+        "generationdate",
+        "ingestiondate",
+        "date",
+        "Creation Date",
+        "Ingestion Date",
+    }
+)
+
+
+def parse_datetime(value):
+    """Parse "YYYY-MM-DD hh:mm:ss[.ffffff]" strings to datetime
+
+    Fixed format fast path for datetime_parser
+    Returns value unchanged if it does not match the format
+    """
+    if (
+        len(value) < 19
+        or value[4] != "-"
+        or value[7] != "-"
+        or value[10] not in " T"
+        or value[13] != ":"
+        or value[16] != ":"
+    ):
+        return value
+    micro = 0
+    if len(value) > 19:
+        fraction = value[20:]
+        if value[19] != "." or not fraction.isdigit() or len(fraction) > 6:
+            return value
+        micro = int(fraction.ljust(6, "0"))
+    try:
+        return datetime.datetime(
+            int(value[0:4]),
+            int(value[5:7]),
+            int(value[8:10]),
+            int(value[11:13]),
+            int(value[14:16]),
+            int(value[17:19]),
+            micro,
+        )
+    except ValueError:
+        return value
+
+
+def _date_hook(date_fields):
+    """Return a JSON object_hook parsing the given date fields
+    """
+    if date_fields is None:
+        return datetime_parser
+
+    def hook(dct):
+        for key in dct.keys() & date_fields:
+            if isinstance(dct[key], str):
+                dct[key] = parse_datetime(dct[key])
+        return dct
+
+    return hook
+
+
 def is_utm(string):
     return all(list(map(_match_UTM, string.split(","))))
 
 
+def _parse_query_date(value):
+    """Cast an OpenSearch date constraint to datetime
+
+    Supports datetime/date objects, "YYYYMMDD", "YYYY-MM-DD",
+    "YYYY-MM-DDThh:mm:ssZ", "NOW" and "NOW-<n>DAY(S)"
+    Returns None for anything else (e.g. other DHuS date expressions)
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    if not isinstance(value, str):
+        return None
+    match = _NOW_RE.match(value)
+    if match:
+        now = datetime.datetime.utcnow()
+        return now - datetime.timedelta(days=int(match.group(1) or 0))
+    for fmt in ("%Y%m%d", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def split_date_range(start, end, parts):
+    """Split an OpenSearch date range into consecutive subranges
+
+    Neighbouring subranges share their boundary, as DHuS ranges are
+    inclusive. Duplicate products have to be merged by UUID.
+
+    Parameters
+    ----------
+    start : datetime.datetime, datetime.date or str
+        Lower bound of the date range
+    end : datetime.datetime, datetime.date or str
+        Upper bound of the date range
+    parts : int
+        Number of subranges
+
+    Returns
+    -------
+    list or None
+        List of (from, to) datetime tuples
+        None if the range can not be split
+    """
+    start = _parse_query_date(start)
+    end = _parse_query_date(end)
+    if start is None or end is None or end <= start or parts < 2:
+        return None
+    step = (end - start) / parts
+    bounds = [start + step * idx for idx in range(parts)] + [end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
 # Load YAML file to dict
 def load_yaml(fpath):
+    import yaml
     with open(fpath, "r") as f:
         data = yaml.safe_load(f)
     return data
@@ -228,15 +512,165 @@ def load_csv(fpath, skip_header=True):
 
 
 # Load JSON file, cast dates to datetime values
-def load_json(fpath):
+# date_fields=None casts every date-like string (slow)
+def load_json(fpath, date_fields=DATE_FIELDS):
     with open(fpath, "rb") as f:
-        data = json.load(f, object_hook=datetime_parser)
+        data = json.load(f, object_hook=_date_hook(date_fields))
     return data
 
 
+# Iterate over the objects of a JSON Lines file, cast dates to datetime values
+def iter_json_lines(fpath, date_fields=DATE_FIELDS):
+    decoder = json.JSONDecoder(object_hook=_date_hook(date_fields))
+    with open(fpath, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield decoder.decode(line)
+
+
+class _JSONStream(object):
+    """Buffered reader decoding one JSON value at a time
+    """
+
+    def __init__(self, f, decoder, chunk_size):
+        self.f = f
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+
+    def fill(self):
+        """Read more data, at least doubling the buffer to stay linear
+        """
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        """Skip whitespace and return next character, "" at end of file
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '%s' at offset %d" % (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decode the next value
+
+        A value ending at the end of the buffer might be truncated
+        (e.g. numbers), so it is decoded again after reading more data
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end < len(self.buf) or not self.fill():
+                self.pos = end
+                return value
+
+
+# Iterate over the (key, value) pairs of a top-level JSON object
+# without loading the whole document, cast dates to datetime values
+def iter_json_items(fpath, date_fields=DATE_FIELDS, chunk_size=1 << 20):
+    decoder = json.JSONDecoder(object_hook=_date_hook(date_fields))
+    with open(fpath, "r") as f:
+        stream = _JSONStream(f, decoder, chunk_size)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            yield key, stream.value()
+            if stream.peek() == "}":
+                return
+            stream.expect(",")
+
+
+# Buffer size for streaming compressed zip members
+_BUFFER = 1 << 20
+# Fixed part of a zip local file header
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+def member_offset(f, info):
+    """Return the byte offset of a zip member's data
+
+    Parameters
+    ----------
+    f : file object
+        Zip file opened in binary mode
+    info : zipfile.ZipInfo
+        Member of the zip file
+
+    Returns
+    -------
+    int
+        Offset of the first data byte, after the local file header
+    """
+    f.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+    if header[0] != b"PK\x03\x04":
+        raise zipfile.BadZipFile("Bad local file header of %s" % info.filename)
+    return info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1]
+
+
+def _copy_range(src, dst, offset, count):
+    """Copy count bytes starting at offset of src to the position of dst
+
+    Uses os.copy_file_range or os.sendfile, so data is copied by the
+    kernel. Falls back to os.pread if neither is supported by the file
+    system.
+    """
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    methods = ["copy_file_range", "sendfile", "pread"]
+    while count > 0:
+        try:
+            if methods[0] == "copy_file_range":
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset)
+            elif methods[0] == "sendfile":
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+            else:
+                copied = os.write(dst_fd, os.pread(src_fd, min(count, _BUFFER), offset))
+        except (AttributeError, OSError):
+            if len(methods) == 1:
+                raise
+            methods.pop(0)
+            continue
+        if not copied:
+            raise zipfile.BadZipFile("Unexpected end of zip file")
+        offset += copied
+        count -= copied
+
+
+def _member_path(dest, name):
+    """Return extraction path of a member, dropping absolute and ".." parts
+    """
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    return os.path.join(dest, *parts)
+
+
 def unzip(fpath, dest="."):
     """Unzip file
 
+    Stored members (most JP2 band files of SAFE products) are copied by
+    the kernel from their offset in the zip file. Deflated members are
+    streamed through a large buffer.
+    CRCs of stored members are not checked.
+
     Parameters
     ----------
     fpath : str
@@ -254,6 +688,18 @@ def unzip(fpath, dest="."):
 
     with open(fpath, "rb") as f:
         zf = zipfile.ZipFile(f)
-        out = zf.namelist()[0]
-        zf.extractall(path=dest)
-    return os.path.join(dest, out)
\ No newline at end of file
+        # top-level folder, the first member is not always a directory entry
+        out = zf.namelist()[0].split("/")[0]
+        for info in zf.infolist():
+            target = _member_path(dest, info.filename)
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as dst:
+                if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                    _copy_range(f, dst, member_offset(f, info), info.file_size)
+                else:
+                    with zf.open(info) as src:
+                        shutil.copyfileobj(src, dst, _BUFFER)
+    return os.path.join(dest, out)
@@ -0,0 +1,149 @@
+"""Check extracted or zipped products against their manifest.safe checksums
+"""
+import os
+import mmap
+import hashlib
+import zipfile
+import xml.etree.ElementTree as ET
+from zip_index import ZipReader
+
+MANIFEST = "manifest.safe"
+# Read size for files that can not be memory-mapped
+_BUFFER = 1 << 22
+
+
+def _local(tag):
+    """Strip the XML namespace of a tag
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def _hash(name):
+    """Return a hashlib object for a manifest checksumName, e.g. "MD5"
+    """
+    return hashlib.new(name.lower().replace("-", "_"))
+
+
+def parse_manifest(data):
+    """Return the checksums listed in a manifest.safe
+
+    Parameters
+    ----------
+    data : bytes
+        Content of manifest.safe
+
+    Returns
+    -------
+    list
+        (relative path, checksum name, hex digest) tuples
+    """
+    checksums = []
+    for stream in ET.fromstring(data).iter():
+        if _local(stream.tag) != "byteStream":
+            continue
+        href = checksum = None
+        for child in stream:
+            if _local(child.tag) == "fileLocation":
+                href = child.get("href")
+            elif _local(child.tag) == "checksum":
+                checksum = child
+        if href is None or checksum is None or not checksum.text:
+            continue
+        checksums.append(
+            (
+                os.path.normpath(href),
+                checksum.get("checksumName", "MD5"),
+                checksum.text.strip().lower(),
+            )
+        )
+    return checksums
+
+
+def file_digest(fpath, name="MD5"):
+    """Return the hex digest of a file, read via a memory map
+    """
+    digest = _hash(name)
+    with open(fpath, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+        except ValueError:
+            # empty file
+            pass
+        except OSError:
+            buf = bytearray(_BUFFER)
+            view = memoryview(buf)
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def verify_safe(safe_path):
+    """Check the files of an extracted product against its manifest
+
+    Parameters
+    ----------
+    safe_path : str
+        Path to the .SAFE folder
+
+    Returns
+    -------
+    list
+        Relative paths of missing or corrupt files, empty if the product
+        is intact
+    """
+    with open(os.path.join(safe_path, MANIFEST), "rb") as f:
+        checksums = parse_manifest(f.read())
+    bad = []
+    for href, name, expected in checksums:
+        fpath = os.path.join(safe_path, href)
+        if not os.path.isfile(fpath) or file_digest(fpath, name) != expected:
+            bad.append(href)
+    return bad
+
+
+def verify_zip(zip_path):
+    """Check the members of a zipped product against its manifest
+
+    Reads members in place via zip_index.ZipReader
+
+    Returns
+    -------
+    list
+        Relative paths of missing or corrupt members
+    """
+    with ZipReader(zip_path) as reader:
+        root = reader.root + "/"
+        bad = []
+        for href, name, expected in parse_manifest(bytes(reader.read(root + MANIFEST))):
+            member = root + href
+            if member not in reader:
+                bad.append(href)
+                continue
+            try:
+                data = reader.read(member)
+            except zipfile.BadZipFile:
+                bad.append(href)
+                continue
+            digest = _hash(name)
+            digest.update(data)
+            del data
+            if digest.hexdigest() != expected:
+                bad.append(href)
+    return bad
+
+
+def verify_product(fpath):
+    """Run verify_safe on folders and verify_zip on zip files
+
+    Returns
+    -------
+    tuple
+        fpath and list of missing or corrupt files
+    """
+    if os.path.isdir(fpath):
+        return fpath, verify_safe(fpath)
+    return fpath, verify_zip(fpath)
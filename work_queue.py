@@ -0,0 +1,716 @@
+"""Work queue distributing downloads over worker processes and nodes
+
+A coordinator (Query.get with the "work_queue" option) puts one item per
+product into a shared queue and waits for them. Workers on any node pull
+items, download and extract them with their own mirror connections and
+report the product paths back:
+
+    python work_queue.py worker --queue /shared/queue.db --config config.yaml
+    python work_queue.py status --queue /shared/queue.db
+
+Items are leased for "ttl" seconds and renewed by heartbeats while a
+worker holds them. Items of workers that stopped heart-beating are
+reclaimed by the coordinator and leased again, up to "max_attempts"
+times. Items no worker leases for "max_idle" seconds are failed.
+
+SQLiteQueue keeps the queue in a SQLite file, e.g. on a filesystem
+shared by all nodes; workers should run in a shared directory as well,
+so product paths are valid on every node. With MemoryQueue ("memory")
+the coordinator runs the workers as threads of its own process.
+Backends derive from WorkQueue and provide put, lease, heartbeat,
+complete, fail, reclaim, abandon and items.
+"""
+import os
+import sys
+import json
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from time import time, perf_counter
+from collections import OrderedDict, Counter, deque
+
+# Seconds a lease is valid without heartbeat
+LEASE_TTL = 120.0
+MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def node_name():
+    """Return a worker name unique on the network, host and pid
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """Base class of the work queue backends
+
+    Parameters
+    ----------
+    max_attempts : int
+        Leases of an item before it is marked as failed
+    """
+
+    # True if only workers of this process can reach the items
+    local = False
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+    def put(self, job, items):
+        raise NotImplementedError
+
+    def lease(self, worker, ttl=LEASE_TTL):
+        raise NotImplementedError
+
+    def reclaim(self, job=None):
+        raise NotImplementedError
+
+    def abandon(self, job, error):
+        raise NotImplementedError
+
+    def _update(self, item_id, owner, **values):
+        """Set values of an item leased by owner, return False if it is not
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, item_id, worker, ttl=LEASE_TTL):
+        """Renew a lease, return False if the worker lost it
+        """
+        return self._update(item_id, worker, lease_until=time() + ttl)
+
+    def complete(self, item_id, worker, result):
+        """Store the result of a leased item, return False if the lease was lost
+        """
+        return self._update(item_id, worker, state=DONE, result=result)
+
+    def fail(self, item_id, worker, error, retry=False):
+        """Mark a leased item as failed, or pending again with retry
+        """
+        state = PENDING if retry else FAILED
+        return self._update(item_id, worker, state=state, error=error, worker=None)
+
+    def items(self, job=None):
+        raise NotImplementedError
+
+    def progress(self, job=None):
+        """Return item counts by state and done items by worker
+        """
+        items = self.items(job)
+        return {
+            "states": dict(Counter(item["state"] for item in items)),
+            "workers": dict(Counter(item["worker"] for item in items if item["state"] == DONE)),
+        }
+
+    def close(self):
+        pass
+
+
+class MemoryQueue(WorkQueue):
+    """Work queue of a single process
+
+    Pending items wait in a FIFO of ids, leased items in a set, so a
+    lease does not scan the items of finished work.
+
+    Parameters
+    ----------
+    max_attempts : int
+        Leases of an item before it is marked as failed
+    """
+
+    local = True
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS):
+        super().__init__(max_attempts)
+        self._items = OrderedDict()  # item id -> dict
+        self._ready = deque()  # ids of pending items, may hold stale ids
+        self._leased = set()  # ids of leased items
+
+    def put(self, job, items):
+        """Add work items of a job, return their ids
+
+        Parameters
+        ----------
+        job : str
+            Job id, e.g. one per Query.get call
+        items : list
+            JSON serializable dicts, need a "uuid"
+        """
+        with self._lock:
+            ids = []
+            for item in items:
+                item_id = len(self._items) + 1
+                self._items[item_id] = {
+                    "id": item_id,
+                    "job": job,
+                    "uuid": item["uuid"],
+                    "payload": dict(item),
+                    "state": PENDING,
+                    "worker": None,
+                    "lease_until": 0.0,
+                    "attempts": 0,
+                    "result": None,
+                    "error": None,
+                }
+                self._ready.append(item_id)
+                ids.append(item_id)
+            return ids
+
+    def _expire(self, now, job=None):
+        """Return expired leases to pending, fail those out of attempts
+
+        Call with self._lock held. Returns the number of expired leases.
+        """
+        count = 0
+        for item_id in list(self._leased):
+            item = self._items[item_id]
+            if item["lease_until"] >= now or (job is not None and item["job"] != job):
+                continue
+            self._leased.discard(item_id)
+            if item["attempts"] >= self.max_attempts:
+                item.update(state=FAILED, error="lease of %s expired" % item["worker"])
+            else:
+                item.update(state=PENDING, worker=None)
+                # older than the items waiting, lease it first
+                self._ready.appendleft(item_id)
+            count += 1
+        return count
+
+    def lease(self, worker, ttl=LEASE_TTL):
+        """Lease the next pending or expired item
+
+        Returns
+        -------
+        dict or None
+            Item with "id", "job", "uuid", "payload" and "attempts"
+        """
+        now = time()
+        with self._lock:
+            self._expire(now)
+            while self._ready:
+                item = self._items[self._ready.popleft()]
+                if item["state"] != PENDING:
+                    continue  # abandoned
+                item.update(
+                    state=LEASED, worker=worker, lease_until=now + ttl, attempts=item["attempts"] + 1
+                )
+                self._leased.add(item["id"])
+                return dict(item)
+        return None
+
+    def reclaim(self, job=None):
+        """Return expired leases to pending, fail those out of attempts
+
+        Returns
+        -------
+        int
+            Number of reclaimed items
+        """
+        with self._lock:
+            return self._expire(time(), job)
+
+    def abandon(self, job, error):
+        """Fail the pending items of a job, return their number
+        """
+        count = 0
+        with self._lock:
+            for item_id in self._ready:
+                item = self._items[item_id]
+                if item["job"] == job and item["state"] == PENDING:
+                    item.update(state=FAILED, error=error)
+                    count += 1
+        return count
+
+    def _update(self, item_id, owner, **values):
+        with self._lock:
+            item = self._items.get(item_id)
+            if item is None or item["state"] != LEASED or item["worker"] != owner:
+                return False
+            item.update(values)
+            if item["state"] != LEASED:
+                self._leased.discard(item_id)
+            if item["state"] == PENDING:
+                self._ready.append(item_id)
+            return True
+
+    def items(self, job=None):
+        """Return items of a job, or all items
+        """
+        with self._lock:
+            return [dict(item) for item in self._items.values() if job is None or item["job"] == job]
+
+
+class SQLiteQueue(WorkQueue):
+    """Work queue in a SQLite file shared by processes and nodes
+
+    Every change runs in its own IMMEDIATE transaction, SQLite's file
+    locks serialize workers. Uses the rollback journal, WAL mode does not
+    work on network filesystems.
+
+    Parameters
+    ----------
+    fpath : str
+        SQLite database, created if missing
+    max_attempts : int
+        Leases of an item before it is marked as failed
+    timeout : float
+        Seconds to wait for a lock held by another process
+    """
+
+    _COLUMNS = ("id", "job", "uuid", "payload", "state", "worker", "lease_until", "attempts", "result", "error")
+
+    def __init__(self, fpath, max_attempts=MAX_ATTEMPTS, timeout=30.0):
+        super().__init__(max_attempts)
+        self.fpath = fpath
+        self._db = sqlite3.connect(
+            fpath, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT, uuid TEXT, payload TEXT, "
+                "state TEXT, worker TEXT, lease_until REAL, attempts INTEGER, "
+                "result TEXT, error TEXT)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS items_job ON items (job)")
+
+    def _transaction(self):
+        return _Transaction(self._db, self._lock)
+
+    def _row(self, row):
+        item = dict(zip(self._COLUMNS, row))
+        item["payload"] = json.loads(item["payload"])
+        if item["result"] is not None:
+            item["result"] = json.loads(item["result"])
+        return item
+
+    def put(self, job, items):
+        with self._transaction() as db:
+            ids = []
+            for item in items:
+                cursor = db.execute(
+                    "INSERT INTO items (job, uuid, payload, state, lease_until, attempts) "
+                    "VALUES (?, ?, ?, ?, 0, 0)",
+                    (job, item["uuid"], json.dumps(item), PENDING),
+                )
+                ids.append(cursor.lastrowid)
+            return ids
+
+    def lease(self, worker, ttl=LEASE_TTL):
+        now = time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET state = ?, error = 'lease of ' || worker || ' expired' "
+                "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, LEASED, now, self.max_attempts),
+            )
+            row = db.execute(
+                "SELECT %s FROM items WHERE state = ? OR (state = ? AND lease_until < ?) "
+                "ORDER BY id LIMIT 1" % ", ".join(self._COLUMNS),
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            item = self._row(row)
+            db.execute(
+                "UPDATE items SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (LEASED, worker, now + ttl, item["id"]),
+            )
+        item.update(state=LEASED, worker=worker, lease_until=now + ttl, attempts=item["attempts"] + 1)
+        return item
+
+    def reclaim(self, job=None):
+        now = time()
+        where = "state = ? AND lease_until < ?" + ("" if job is None else " AND job = ?")
+        args = (LEASED, now) + (() if job is None else (job,))
+        with self._transaction() as db:
+            failed = db.execute(
+                "UPDATE items SET state = ?, error = 'lease of ' || worker || ' expired' "
+                "WHERE %s AND attempts >= ?" % where,
+                (FAILED,) + args + (self.max_attempts,),
+            ).rowcount
+            pending = db.execute(
+                "UPDATE items SET state = ?, worker = NULL WHERE %s" % where, (PENDING,) + args
+            ).rowcount
+        return failed + pending
+
+    def abandon(self, job, error):
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE items SET state = ?, error = ? WHERE job = ? AND state = ?",
+                (FAILED, error, job, PENDING),
+            ).rowcount
+
+    def _update(self, item_id, owner, **values):
+        if "result" in values:
+            values["result"] = json.dumps(values["result"])
+        columns = ", ".join("%s = ?" % name for name in values)
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE items SET %s WHERE id = ? AND state = ? AND worker = ?" % columns,
+                tuple(values.values()) + (item_id, LEASED, owner),
+            )
+            return cursor.rowcount == 1
+
+    def items(self, job=None):
+        query = "SELECT %s FROM items" % ", ".join(self._COLUMNS)
+        with self._transaction() as db:
+            if job is None:
+                rows = db.execute(query + " ORDER BY id").fetchall()
+            else:
+                rows = db.execute(query + " WHERE job = ? ORDER BY id", (job,)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class _Transaction(object):
+    """BEGIN IMMEDIATE ... COMMIT, ROLLBACK on errors
+    """
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+def open_queue(location, max_attempts=MAX_ATTEMPTS):
+    """Return the queue backend of a location, "memory" or a SQLite path
+    """
+    if isinstance(location, WorkQueue):
+        return location
+    if location in (None, "", "memory"):
+        return MemoryQueue(max_attempts)
+    return SQLiteQueue(location, max_attempts)
+
+
+class Coordinator(object):
+    """Put a job's items into a queue and wait for them
+
+    Parameters
+    ----------
+    queue : WorkQueue
+    job : str, optional
+        Job id, unique per host and process by default
+    """
+
+    def __init__(self, queue, job=None):
+        self.queue = queue
+        self.job = job or "%s:%d" % (node_name(), int(time() * 1000))
+        self.logger = logging.getLogger("single-mirror")
+
+    def submit(self, items):
+        return self.queue.put(self.job, items)
+
+    def wait(self, interval=5.0, stop=None, max_idle=None):
+        """Log progress until all items are done or failed
+
+        Expired leases of workers that died are reclaimed at every check.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between progress checks
+        stop : threading.Event, optional
+            Stops waiting early
+        max_idle : float, optional
+            Pending items are failed once no worker held a lease or made
+            progress for this many seconds, None waits for workers forever
+
+        Returns
+        -------
+        list
+            Items of the job with state and result
+        """
+        stop = stop or threading.Event()
+        last = None
+        active = time()  # last time a worker held a lease or made progress
+        while True:
+            reclaimed = self.queue.reclaim(self.job)
+            if reclaimed:
+                self.logger.info("Work queue %s | Reclaimed %d expired leases", self.job, reclaimed)
+            progress = self.queue.progress(self.job)
+            states = progress["states"]
+            if states.get(LEASED) or progress != last:
+                active = time()
+            elif max_idle is not None and states.get(PENDING) and time() - active > max_idle:
+                error = "no worker leased items for %d sec" % max_idle
+                self.logger.error("Work queue %s | %s, giving up", self.job, error)
+                self.queue.abandon(self.job, error)
+                continue
+            if progress != last:
+                self.logger.info(
+                    "Work queue %s | %d pending, %d leased, %d done, %d failed%s",
+                    self.job,
+                    states.get(PENDING, 0),
+                    states.get(LEASED, 0),
+                    states.get(DONE, 0),
+                    states.get(FAILED, 0),
+                    " (%s)" % ", ".join("%s: %d" % pair for pair in sorted(progress["workers"].items()))
+                    if progress["workers"] else "",
+                )
+                last = progress
+            if not states.get(PENDING) and not states.get(LEASED):
+                break
+            if stop.wait(interval):
+                break
+        return self.queue.items(self.job)
+
+
+class Worker(object):
+    """Download and extract leased items with a manager's mirrors
+
+    Parameters
+    ----------
+    queue : WorkQueue
+    manager : SentinelAPIManager
+    name : str, optional
+        Worker name stored with leases, host and pid by default
+    parallel : int, optional
+        Items processed at the same time, the manager's "parallel" by default
+    ttl : float
+        Lease duration in seconds, renewed every ttl / 3 seconds
+    """
+
+    def __init__(self, queue, manager, name=None, parallel=None, ttl=LEASE_TTL):
+        self.queue = queue
+        self.manager = manager
+        self.name = name or node_name()
+        self.parallel = parallel or manager.config["parallel"]
+        self.ttl = ttl
+        self.logger = logging.getLogger("single-mirror")
+        self.processed = Counter()  # "done" / "failed" -> count
+        self._held = {}  # item id -> lease owner thread
+        self._queries = {}  # options -> Query, closed by run
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _query(self, options):
+        """Return a Query configured with an item's options
+        """
+        from query import Query
+        key = json.dumps(options, sort_keys=True)
+        with self._lock:
+            if key not in self._queries:
+                config = self.manager.order_config(**options)
+                self._queries[key] = Query(manager=self.manager, order=None, config=config)
+            return self._queries[key]
+
+    def process(self, item):
+        """Download, extract and verify an item's product
+
+        Returns
+        -------
+        dict
+            Paths and size of the product
+
+        Raises
+        ------
+        Exception
+            If the product could not be downloaded, extracted or verified
+        """
+        from product_download import ProductDownload, byte_to_MB
+        from zip_index import build_index
+        from verify import verify_product
+        from utils import unzip
+
+        payload = item["payload"]
+        query = self._query(payload.get("options", {}))
+        uuid, utm = item["uuid"], payload.get("utm")
+        download = ProductDownload(uuid, tuple(payload.get("index", (item["id"], item["id"]))), utm)
+        if payload.get("filename") and query._skip_present(download, payload["filename"]):
+            return self._result(download)
+
+        mirrors = [name for name in payload.get("mirrors") or [] if name in query.apis]
+        query._mirror_map[uuid] = mirrors or list(query.apis)
+        mirror = query.find_mirror(uuid)
+        if mirror is None:
+            query._forget(uuid)
+            raise RuntimeError("No mirror holds %s" % uuid)
+        with self.manager._connections_lock:
+            self.manager._connections[mirror] += 1
+        tic = perf_counter()
+        try:
+            response = query._download_thread(mirror, uuid, utm)
+        finally:
+            with self.manager._connections_lock:
+                self.manager._connections[mirror] -= 1
+            # queries are cached per option set, keep them from growing
+            query._forget(uuid)
+        # a fallback mirror may have served it
+        download.mirror = response.get("mirror", mirror)
+        download.size = byte_to_MB(response["size"])
+        download.zip_path = response["path"]
+        if response.get("downloaded_bytes"):
+            self.manager.health.record(
+                self.manager.config["mirrors"][download.mirror]["url"],
+                throughput=byte_to_MB(response["downloaded_bytes"]) / max(perf_counter() - tic, 1e-6),
+            )
+
+        tags = {"uuid": uuid, "tile": utm}
+        if query.keep_zip:
+            download.index_path = query._extractor.submit(build_index, download.zip_path, tags=tags).result()
+        else:
+            download.safe_path = query._extractor.submit(
+                unzip, download.zip_path, os.path.dirname(download.zip_path), tags=tags
+            ).result()
+        if query.verify:
+            _, bad = query._extractor.submit(
+                verify_product, download.safe_path or download.zip_path, tags=tags
+            ).result()
+            if bad:
+                raise ValueError("Verification failed: %s" % ", ".join(bad[:5]))
+        return self._result(download)
+
+    def _result(self, download):
+        return {
+            "node": socket.gethostname(),
+            "mirror": download.mirror,
+            "size": download.size,
+            "zip_path": download.zip_path,
+            "safe_path": download.safe_path,
+            "index_path": download.index_path,
+        }
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                held = list(self._held)
+            for item_id in held:
+                if not self.queue.heartbeat(item_id, self.name, self.ttl):
+                    self.logger.info("Worker %s | Lost lease of item %d", self.name, item_id)
+
+    def _run(self, idle):
+        while not self._stop.is_set():
+            item = self.queue.lease(self.name, self.ttl)
+            if item is None:
+                if idle is None or self._stop.wait(idle):
+                    break
+                continue
+            with self._lock:
+                self._held[item["id"]] = item
+            try:
+                result = self.process(item)
+            except Exception as err:
+                retry = item["attempts"] < self.queue.max_attempts
+                self.queue.fail(item["id"], self.name, "%s: %s" % (err.__class__.__name__, err), retry)
+                self.processed["failed"] += 1
+                self.logger.error("Worker %s | UUID %s | %s", self.name, item["uuid"], err)
+            else:
+                self.queue.complete(item["id"], self.name, result)
+                self.processed["done"] += 1
+                self.logger.info("Worker %s | UUID %s | Done", self.name, item["uuid"])
+            finally:
+                with self._lock:
+                    self._held.pop(item["id"], None)
+
+    def run(self, idle=5.0):
+        """Process items until stop is called
+
+        Parameters
+        ----------
+        idle : float or None
+            Seconds to wait while the queue is empty, None returns once
+            the queue is empty
+
+        Returns
+        -------
+        collections.Counter
+            Number of items done and failed
+        """
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        threads = [
+            threading.Thread(target=self._run, args=(idle,), name="worker-%d" % idx, daemon=True)
+            for idx in range(self.parallel)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1.0)
+        finally:
+            self._stop.set()
+            # release the queries of the option sets seen
+            with self._lock:
+                queries, self._queries = list(self._queries.values()), {}
+            for query in queries:
+                query.close()
+        return self.processed
+
+    def stop(self):
+        self._stop.set()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Distributed download work queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+    worker = commands.add_parser("worker", help="Download items of the queue")
+    worker.add_argument("--queue", help="SQLite work queue file", required=True, type=str)
+    worker.add_argument("--config", help="YAML config file with mirrors", type=str)
+    worker.add_argument("--user", help="Datahub username", type=str)
+    worker.add_argument("--password", help="Datahub password", type=str)
+    worker.add_argument("--url", help="Datahub URL", type=str)
+    worker.add_argument("--parallel", help="Items processed at the same time", type=int)
+    worker.add_argument("--ttl", help="Lease duration in seconds", default=LEASE_TTL, type=float)
+    worker.add_argument("--idle", help="Seconds to wait for work", default=5.0, type=float)
+    worker.add_argument("--exit-when-empty", help="Stop once the queue is empty", action="store_true")
+    status = commands.add_parser("status", help="Print progress of the queue")
+    status.add_argument("--queue", help="SQLite work queue file", required=True, type=str)
+    status.add_argument("--job", help="Only items of this job", type=str)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    queue = SQLiteQueue(args.queue)
+    if args.command == "status":
+        print(json.dumps(queue.progress(args.job), indent=2))
+        return 0
+
+    from single_mirror_manager import SentinelAPIManager
+    manager = SentinelAPIManager(
+        config_file=args.config,
+        user=args.user,
+        password=args.password,
+        url=args.url,
+        parallel=args.parallel,
+    )
+    worker = Worker(queue, manager, parallel=args.parallel, ttl=args.ttl)
+    try:
+        processed = worker.run(idle=None if args.exit_when_empty else args.idle)
+    except KeyboardInterrupt:
+        worker.stop()
+        processed = worker.processed
+    manager.extractor.shutdown()
+    manager.health.save()
+    print("Worker %s: %d done, %d failed" % (worker.name, processed["done"], processed["failed"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
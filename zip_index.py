@@ -0,0 +1,153 @@
+"""Read products in place from their downloaded zip file
+
+Instead of extracting a product, a small JSON index is written next to
+the zip file, listing the data offset, size and compression of every
+member. ZipReader memory-maps the zip and returns stored members (the
+JP2 band files of SAFE products) as zero-copy views.
+"""
+import os
+import json
+import mmap
+import zlib
+import tempfile
+import zipfile
+from utils import member_offset
+
+INDEX_SUFFIX = ".index.json"
+
+
+def index_path(fpath):
+    """Return path of the member index of a zip file
+    """
+    return fpath + INDEX_SUFFIX
+
+
+def build_index(fpath):
+    """Write the member index of a zip file
+
+    Parameters
+    ----------
+    fpath : str
+        Zip file path
+
+    Returns
+    -------
+    str
+        Path of the index file, see index_path
+    """
+    members = {}
+    with open(fpath, "rb") as f:
+        zf = zipfile.ZipFile(f)
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            members[info.filename] = {
+                "offset": member_offset(f, info),
+                "size": info.file_size,
+                "compressed_size": info.compress_size,
+                "compression": info.compress_type,
+                "crc": info.CRC,
+            }
+        root = zf.namelist()[0].split("/")[0]
+    out = index_path(fpath)
+    # readers never see a partially written index, extraction workers
+    # indexing the same zip do not share a temporary file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"zip": os.path.basename(fpath), "size": os.path.getsize(fpath), "root": root,
+                 "members": members},
+                f,
+            )
+        os.replace(tmp, out)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return out
+
+
+class ZipReader(object):
+    """Memory-mapped reader of a product zip file
+
+    Uses the index written by build_index, it is built on the fly if it
+    does not exist or does not match the zip file.
+
+    Example
+    -------
+    with ZipReader(path) as reader:
+        for name in reader.names(".jp2"):
+            band = reader.read(name)
+    """
+
+    def __init__(self, fpath, index=None):
+        self.path = fpath
+        index = index or index_path(fpath)
+        if not os.path.exists(index):
+            index = build_index(fpath)
+        with open(index, "r") as f:
+            data = json.load(f)
+        if data["size"] != os.path.getsize(fpath):
+            with open(build_index(fpath), "r") as f:
+                data = json.load(f)
+        self.root = data["root"]
+        self.members = data["members"]
+        self._file = open(fpath, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def names(self, suffix=None):
+        """Return member names, optionally only those ending with suffix
+        """
+        if suffix is None:
+            return list(self.members)
+        return [name for name in self.members if name.endswith(suffix)]
+
+    def read(self, name):
+        """Return the content of a member
+
+        Parameters
+        ----------
+        name : str
+            Member name as listed by names
+
+        Returns
+        -------
+        memoryview or bytes
+            Zero-copy view into the mapped zip file for stored members,
+            decompressed bytes for deflated members
+        """
+        member = self.members[name]
+        offset = member["offset"]
+        if member["compression"] == zipfile.ZIP_STORED:
+            return self._view[offset : offset + member["size"]]
+        if member["compression"] == zipfile.ZIP_DEFLATED:
+            data = self._view[offset : offset + member["compressed_size"]]
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        raise NotImplementedError(
+            "Compression method %d of %s is not supported" % (member["compression"], name)
+        )
+
+    def close(self):
+        """Release the memory map, views returned by read become invalid
+        """
+        if self._file is None:
+            return
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # views handed out by read are still in use, the map is
+            # released once they are garbage collected
+            pass
+        self._file.close()
+        self._file = None